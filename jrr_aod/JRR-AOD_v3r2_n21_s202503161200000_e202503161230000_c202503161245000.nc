@@ -0,0 +1 @@
+dummy
\ No newline at end of file
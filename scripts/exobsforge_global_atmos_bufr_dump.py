@@ -86,6 +86,9 @@ if __name__ == '__main__':
     # Combine configs together
     config = AttrDict(**config_env, **obsforge_dict)
     config = AttrDict(**config, **task_yaml['atmosbufrdump'])
+    # the resources of the task (walltime, geometry) are used to schedule the conversions
+    config = AttrDict(**config, **{key: value for key, value in config_yaml.get('atmosbufrdump', {}).items()
+                                   if key not in config})
 
     atmosBufrObs = AtmosBufrObsPrep(config)
     atmosBufrObs.initialize()
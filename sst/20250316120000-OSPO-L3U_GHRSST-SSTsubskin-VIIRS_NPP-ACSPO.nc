@@ -0,0 +1 @@
+fake content
\ No newline at end of file
@@ -1,9 +1,13 @@
 from logging import getLogger
+import os
+import shutil
 import sqlite3
+import threading
 from datetime import datetime, timedelta
 from wxflow.sqlitedb import SQLiteDB
 from wxflow import FileHandler
 from os.path import basename, join
+from pyobsforge.utils.staging import tmp_name
 
 logger = getLogger(__name__.split('.')[-1])
 
@@ -20,6 +24,8 @@ class BaseDatabase(SQLiteDB):
         """
         super().__init__(db_name)
         self.base_dir = base_dir
+        # The connection is held on the instance, serialize its use across threads
+        self._lock = threading.RLock()
         self.create_database()
 
     def create_database(self):
@@ -40,15 +46,16 @@ class BaseDatabase(SQLiteDB):
 
     def insert_record(self, query: str, params: tuple) -> None:
         """Insert a record into the database."""
-        self.connect()
-        cursor = self.connection.cursor()
-        try:
-            cursor.execute(query, params)
-            self.connection.commit()
-        except sqlite3.IntegrityError:
-            pass  # Skip duplicates
-        finally:
-            self.disconnect()
+        with self._lock:
+            self.connect()
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute(query, params)
+                self.connection.commit()
+            except sqlite3.IntegrityError:
+                pass  # Skip duplicates
+            finally:
+                self.disconnect()
 
     def insert_records(self, query: str, params_list: list[tuple]) -> None:
         """
@@ -57,23 +64,26 @@ class BaseDatabase(SQLiteDB):
         :param query: SQL query for inserting records.
         :param params_list: List of tuples containing the parameters for each record.
         """
-        self.connect()
-        cursor = self.connection.cursor()
-        try:
-            cursor.executemany(query, params_list)
-            self.connection.commit()
-        except sqlite3.IntegrityError:
-            pass  # Skip duplicates
-        finally:
-            self.disconnect()
+        with self._lock:
+            self.connect()
+            cursor = self.connection.cursor()
+            try:
+                cursor.executemany(query, params_list)
+                self.connection.commit()
+            except sqlite3.IntegrityError:
+                pass  # Skip duplicates
+            finally:
+                self.disconnect()
 
     def execute_query(self, query: str, params: tuple = None) -> list:
         """Execute a query and return the results."""
-        self.connect()
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        results = cursor.fetchall()
-        self.disconnect()
+        with self._lock:
+            self.connect()
+            cursor = self.connection.cursor()
+            cursor.execute(query, params or [])
+            results = cursor.fetchall()
+            self.connection.commit()
+            self.disconnect()
         return results
 
     def get_valid_files(self,
@@ -83,7 +93,8 @@ class BaseDatabase(SQLiteDB):
                         instrument: str = None,
                         satellite: str = None,
                         obs_type: str = None,
-                        check_receipt: str = "none") -> list:
+                        check_receipt: str = "none",
+                        shared_dir: str = None) -> list:
         """
         Retrieve and copy to dst_dir a list of observation files within a specified time window, possibly filtered by instrument,
         satellite, and observation type. The check_receipt parameter can be 'gdas', 'gfs', or 'none'. If 'gdas' or
@@ -97,9 +108,28 @@ class BaseDatabase(SQLiteDB):
         :param satellite: (Optional) Filter by satellite name.
         :param obs_type: (Optional) Filter by observation type.
         :param check_receipt: (Optional) Specify receipt time check ('gdas', 'gfs', or 'none').
+        :param shared_dir: (Optional) Directory shared with the other runs of the cycle. Files are copied there
+                           once and linked into dst_dir.
         :return: List of valid observation file paths in the destination directory.
         """
+        valid_files = self.query_valid_files(window_begin, window_end, instrument=instrument, satellite=satellite,
+                                             obs_type=obs_type, check_receipt=check_receipt)
+        return self.stage_files(valid_files, dst_dir, shared_dir=shared_dir)
 
+    def query_valid_files(self,
+                          window_begin: datetime,
+                          window_end: datetime,
+                          instrument: str = None,
+                          satellite: str = None,
+                          obs_type: str = None,
+                          check_receipt: str = "none") -> list:
+        """
+        Return the observation files within a specified time window, without copying them.
+
+        See get_valid_files for the parameters.
+
+        :return: List of valid observation file paths in the source directories.
+        """
         query = """
         SELECT filename FROM obs_files
         WHERE obs_time BETWEEN ? AND ?
@@ -129,16 +159,123 @@ class BaseDatabase(SQLiteDB):
                     continue
 
             valid_files.append(filename)
+        return valid_files
+
+    def stage_files(self, src_files: list, dst_dir: str, shared_dir: str = None) -> list:
+        """
+        Copy observation files to dst_dir, or link them from shared_dir (see stage_shared_files).
 
+        :param src_files: Observation files to stage.
+        :param dst_dir: Destination directory.
+        :param shared_dir: (Optional) Directory shared with the other runs of the cycle.
+        :return: List of the staged file paths in the destination directory.
+        """
         # Copy files to the destination directory
         dst_files = []
-        if len(valid_files) > 0:
+        if len(src_files) > 0:
             src_dst_obs_list = []  # list of [src_file, dst_file]
-            for src_file in valid_files:
+            for src_file in src_files:
                 dst_file = join(dst_dir, f"{basename(src_file)}")
                 dst_files.append(dst_file)
                 src_dst_obs_list.append([src_file, dst_file])
             FileHandler({'mkdir': [dst_dir]}).sync()
-            FileHandler({'copy': src_dst_obs_list}).sync()
+            if shared_dir:
+                self.stage_shared_files(src_dst_obs_list, shared_dir)
+            else:
+                FileHandler({'copy': src_dst_obs_list}).sync()
 
         return dst_files
+
+    @staticmethod
+    def stage_shared_files(src_dst_list: list, shared_dir: str) -> None:
+        """
+        Copy files into a directory shared across runs and link them to their destination.
+
+        A file already in shared_dir with the size and modification time of its source is
+        not copied again, so runs of the same cycle only stage the files the others did not.
+
+        :param src_dst_list: List of [src_file, dst_file].
+        :param shared_dir: Directory shared across runs.
+        """
+        os.makedirs(shared_dir, exist_ok=True)
+        ncopied = 0
+        for src_file, dst_file in src_dst_list:
+            shared_file = join(shared_dir, basename(src_file))
+            src_stat = os.stat(src_file)
+            try:
+                shared_stat = os.stat(shared_file)
+                up_to_date = (shared_stat.st_size, shared_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns)
+            except FileNotFoundError:
+                up_to_date = False
+            if not up_to_date:
+                # Copy under a temporary name so a concurrent run never links a partial file
+                tmp_file = tmp_name(shared_file)
+                shutil.copy2(src_file, tmp_file)
+                os.replace(tmp_file, shared_file)
+                ncopied += 1
+            if os.path.lexists(dst_file):
+                os.remove(dst_file)
+            os.symlink(os.path.abspath(shared_file), dst_file)
+        logger.info(f"Staged {len(src_dst_list)} files from {shared_dir}, {ncopied} copied from the source")
+
+
+class ConversionCatalog(BaseDatabase):
+    """
+    Catalog of the observation files converted into each output.
+
+    The catalog is kept next to the outputs it describes, in a directory that outlives the
+    runs, so a rerun of the cycle only converts the observation files that arrived since.
+    """
+
+    def __init__(self, db_name: str) -> None:
+        """
+        Initialize the catalog.
+
+        :param db_name: Name of the SQLite database.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(db_name)), exist_ok=True)
+        super().__init__(db_name, base_dir=None)
+
+    def create_database(self):
+        """
+        Create the table cataloging which observation files went into which output.
+
+        - `output_file`: The output the observation file was converted into.
+        - `filename`: The base name of the observation file.
+        """
+        query = """
+        CREATE TABLE IF NOT EXISTS converted_files (
+            output_file TEXT,
+            filename TEXT,
+            UNIQUE(output_file, filename)
+        )
+        """
+        self.execute_query(query)
+
+    def get_converted_files(self, output_file: str) -> set:
+        """
+        Return the base names of the observation files already converted into output_file.
+
+        :param output_file: Path to the converted output.
+        :return: Set of observation file base names.
+        """
+        query = "SELECT filename FROM converted_files WHERE output_file = ?"
+        return {row[0] for row in self.execute_query(query, (output_file,))}
+
+    def record_converted_files(self, output_file: str, filenames: list) -> None:
+        """
+        Catalog observation files as converted into output_file.
+
+        :param output_file: Path to the converted output.
+        :param filenames: Observation files, only their base names are recorded.
+        """
+        query = "INSERT OR IGNORE INTO converted_files (output_file, filename) VALUES (?, ?)"
+        self.insert_records(query, [(output_file, basename(filename)) for filename in filenames])
+
+    def forget_converted_files(self, output_file: str) -> None:
+        """
+        Remove the catalog entries of output_file, e.g. before it is converted from scratch.
+
+        :param output_file: Path to the converted output.
+        """
+        self.execute_query("DELETE FROM converted_files WHERE output_file = ?", (output_file,))
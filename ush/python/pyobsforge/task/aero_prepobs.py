@@ -2,13 +2,18 @@
 
 import glob
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
-from typing import Dict, Any
+from typing import Any, Dict, List
 
 from wxflow import (AttrDict, Task, add_to_datetime, to_timedelta,
                     logit, FileHandler)
 from pyobsforge.obsdb.jrr_aod_db import JrrAodDatabase
-from pyobsforge.task.run_nc2ioda import run_nc2ioda
+from pyobsforge.task.run_nc2ioda import prune_shared_stage, run_nc2ioda_chunked, shared_stage_dir
+from pyobsforge.utils.aod_prethin import prethin_granule
+from pyobsforge.utils.ioda import count_locations
+from pyobsforge.utils.staging import ScratchManager
 import pathlib
 
 logger = getLogger(__name__.split('.')[-1])
@@ -41,6 +46,9 @@ class AerosolObsPrep(Task):
                                          dcom_dir=self.task_config.DCOMROOT,
                                          obs_dir="jrr_aod")
 
+        # Bytes staged per platform, removed once converted as configured
+        self.scratch = ScratchManager.from_task_config(self.task_config)
+
     @logit(logger)
     def initialize(self) -> None:
         """
@@ -51,34 +59,109 @@ class AerosolObsPrep(Task):
     @logit(logger)
     def execute(self) -> None:
         """
+        Stage and convert the platforms concurrently, `aod_workers` at a time.
+        """
+        platforms = list(self.task_config.platforms)
+        num_workers = max(1, min(self.task_config.get('aod_workers', len(platforms)), len(platforms)))
+        logger.info(f"Processing platforms {platforms} with {num_workers} workers")
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = dict(zip(platforms, executor.map(self.process_platform, platforms)))
+
+        for platform, result in results.items():
+            logger.info(f"{platform}: {result['nfiles']} files, {result['nlocs']} obs, "
+                        f"return code {result['returncode']}, staged in {result['stage_time']:.1f} s, "
+                        f"pre-thinned in {result['prethin_time']:.1f} s, "
+                        f"converted in {result['convert_time']:.1f} s")
+
+    def process_platform(self, platform: str) -> Dict[str, Any]:
+        """
+        Stage the granules of a platform and convert them to ioda.
+
+        Args:
+            platform (str): Platform name, e.g. "npp".
+
+        Returns:
+            dict: Number of files and observations, return code of the conversion, staging,
+                  pre-thinning and conversion times in seconds.
+        """
+        logger.info(f"========= platform: {platform}")
+        result = {'nfiles': 0, 'nlocs': 0, 'returncode': None,
+                  'stage_time': 0.0, 'prethin_time': 0.0, 'convert_time': 0.0}
+        # each platform is its own obs space, staged and configured apart from the others
+        obs_space = f"jrr_aod_{platform}"
+        start = time.perf_counter()
+        input_files = self.jrr_aod_db.get_valid_files(window_begin=self.task_config.window_begin,
+                                                      window_end=self.task_config.window_end,
+                                                      dst_dir=obs_space,
+                                                      satellite=platform,
+                                                      shared_dir=shared_stage_dir(self.task_config, obs_space))
+        result['stage_time'] = time.perf_counter() - start
+        result['nfiles'] = len(input_files)
+        logger.info(f"number of valid files for {platform}: {len(input_files)}")
+        self.scratch.stage(obs_space, input_files)
+
+        if len(input_files) > 0 and self.task_config.get('aod_prethin', False):
+            start = time.perf_counter()
+            input_files = self.prethin(obs_space, input_files)
+            self.scratch.stage(obs_space, input_files)
+            result['prethin_time'] = time.perf_counter() - start
+
+        if len(input_files) > 0:
+            platform_out = 'n20' if platform == 'j01' else platform
+            output_file = f"{self.task_config['RUN']}.t{self.task_config['cyc']:02d}z.viirs_{platform_out}_aod.nc"
+            context = {'provider': 'VIIRSAOD',
+                       'window_begin': self.task_config.window_begin,
+                       'window_end': self.task_config.window_end,
+                       'thinning_threshold': self.task_config.thinning_threshold,
+                       'preqc': self.task_config.preqc,
+                       'input_files': input_files,
+                       'output_file': output_file}
+            for attr in ['binning_stride', 'binning_min_number_of_obs', 'binning_cressman_radius']:
+                try:
+                    context[attr] = self.task_config[attr]
+                except KeyError:
+                    pass
+            start = time.perf_counter()
+            result['returncode'] = run_nc2ioda_chunked(self.task_config, obs_space, context,
+                                                       self.task_config.get('nc2ioda_chunk_size', 0))
+            result['convert_time'] = time.perf_counter() - start
+            logger.info(f"run_nc2ioda result for {platform}: {result['returncode']}")
+            output_path = os.path.join(self.task_config['DATA'], output_file)
+            if os.path.exists(output_path):
+                result['nlocs'] = count_locations(output_path)
+            self.scratch.converted(obs_space, result['returncode'] == 0)
+        return result
+
+    def prethin(self, obs_space: str, input_files: List[str]) -> List[str]:
         """
-        for platform in self.task_config.platforms:
-            print(f"========= platform: {platform}")
-            input_files = self.jrr_aod_db.get_valid_files(window_begin=self.task_config.window_begin,
-                                                          window_end=self.task_config.window_end,
-                                                          dst_dir='jrr_aod',
-                                                          satellite=platform)
-            logger.info(f"number of valid files: {len(input_files)}")
-
-            if len(input_files) > 0:
-                print(f"number of valid files: {len(input_files)}")
-                obs_space = 'jrr_aod'
-                platform_out = 'n20' if platform == 'j01' else platform
-                output_file = f"{self.task_config['RUN']}.t{self.task_config['cyc']:02d}z.viirs_{platform_out}_aod.nc"
-                context = {'provider': 'VIIRSAOD',
-                           'window_begin': self.task_config.window_begin,
-                           'window_end': self.task_config.window_end,
-                           'thinning_threshold': self.task_config.thinning_threshold,
-                           'preqc': self.task_config.preqc,
-                           'input_files': input_files,
-                           'output_file': output_file}
-                for attr in ['binning_stride', 'binning_min_number_of_obs', 'binning_cressman_radius']:
-                    try:
-                        context[attr] = self.task_config[attr]
-                    except KeyError:
-                        pass
-                result = run_nc2ioda(self.task_config, obs_space, context)
-                logger.info(f"run_nc2ioda result: {result}")
+        Replace the granules of an obs space by compact copies holding only the bins with valid pixels.
+
+        The granules without any valid pixel are dropped, unless none has one, in which case
+        the first granule is kept so the conversion still writes its (empty) output.
+
+        Args:
+            obs_space (str): Obs space of the granules, the copies go to its `prethin` directory.
+            input_files (list): Staged granules of the obs space.
+
+        Returns:
+            list: Granules to convert.
+        """
+        prethin_dir = os.path.join(self.task_config['DATA'], obs_space, 'prethin')
+        os.makedirs(prethin_dir, exist_ok=True)
+        stride = self.task_config.get('binning_stride', 1)
+        prethinned = []
+        for input_file in input_files:
+            prethin_file = os.path.join(prethin_dir, os.path.basename(input_file))
+            if prethin_granule(input_file, prethin_file, self.task_config.preqc, stride) > 0:
+                prethinned.append(prethin_file)
+        if not prethinned:
+            prethinned = input_files[:1]
+
+        size_in = sum(os.path.getsize(f) for f in input_files)
+        size_out = sum(os.path.getsize(f) for f in prethinned)
+        logger.info(f"Pre-thinned {obs_space}: {len(prethinned)}/{len(input_files)} granules kept, "
+                    f"{size_in / 2**20:.1f} -> {size_out / 2**20:.1f} MiB")
+        return prethinned
 
     @logit(logger)
     def finalize(self) -> None:
@@ -119,3 +202,8 @@ class AerosolObsPrep(Task):
         # create an empty file to tell external processes the obs are ready
         ready_file = pathlib.Path(os.path.join(comout, f"{self.task_config['OPREFIX']}obsforge_aod_status.log"))
         ready_file.touch()
+
+        self.scratch.write_report(os.path.join(comout, f"{self.task_config['OPREFIX']}obsforge_aod_scratch.yaml"))
+
+        # the staged files and conversions of the past cycles are not needed anymore
+        prune_shared_stage(self.task_config)
@@ -5,24 +5,26 @@ import json
 import multiprocessing as mp
 import os
 import pathlib
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from logging import getLogger
-from typing import Dict, Any
+from typing import Any, Dict, List, Optional
 
 from wxflow import (AttrDict, Task, add_to_datetime, to_timedelta,
                     logit, FileHandler, Executable, YAMLFile, save_as_yaml)
 
-
-logger = getLogger(__name__.split('.')[-1])
+from pyobsforge.utils.ioda import summarize_ioda_file
+from pyobsforge.utils.manifest import ResultManifest
+from pyobsforge.utils.process import run_streamed
+from pyobsforge.utils.runtime_history import RuntimeHistory
+from pyobsforge.utils.scheduler import CoreBudgetScheduler, Job
+from pyobsforge.utils.staging import ScratchManager, cache_root, copy_files, link_from_versioned_cache
+from pyobsforge.utils.templates import parse_j2yaml_cached
 
 
-def mp_bufr_converter(ob_name, exec_cmd):
-    try:
-        logger.debug(f"Executing {exec_cmd}")
-        exec_cmd()
-    except Exception as e:
-        logger.warning(f"Conversion failed for {ob_name}")
-        logger.warning(f"Execution failed for {exec_cmd}: {e}")
-        logger.debug("Exception details", exc_info=True)
+logger = getLogger(__name__.split('.')[-1])
 
 
 class AtmosBufrObsPrep(Task):
@@ -51,19 +53,23 @@ class AtmosBufrObsPrep(Task):
         # task_config is everything that this task should need
         self.task_config = AttrDict(**self.task_config, **local_dict)
 
+        # the BUFR inputs are read in place, only the disk usage of DATA is reported
+        self.scratch = ScratchManager.from_task_config(self.task_config)
+
     @logit(logger)
     def initialize(self) -> None:
         """
         Initialize an atmospheric BUFR observation prep task.
 
         Steps:
-        - Collect input BUFR, mapping, and script files
-        - Stage files into the working directory
+        - Collect input BUFR, mapping, and script files, the BUFR files are read in place
+        - Link the scripts and auxiliary files from a versioned cache into the working directory
+        - Render the mapping files with the reference time of the cycle
         - Register observations for bufr2netcdf conversion
         """
         self.script2netcdf_obs = {}
-        copylist = []
-        sub_dir_list = []
+        static_list = []
+        mapping_list = []
 
         for ob_name, ob_data in self.task_config.observations.items():
             logger.debug(f"Processing observation: {ob_name}: {ob_data}")
@@ -73,7 +79,6 @@ class AtmosBufrObsPrep(Task):
             mapping_files = ob_data.get('mapping_file', [])
             script_files = ob_data.get('script_file', [])
             aux_files = ob_data.get('aux_file', [])
-            preserve_rel_path = ob_data.get('preserve_rel_path', None)
 
             if isinstance(input_files, str):
                 input_files = [input_files]
@@ -84,21 +89,13 @@ class AtmosBufrObsPrep(Task):
 
             staged_inputs, staged_mappings, staged_scripts = [], [], []
 
-            # Stage BUFR input files
+            # BUFR input files are read in place, which also keeps the
+            # <RUN>.<YYYYMMDD>/<HH>/atmos structure some scripts rely on
             for f in input_files:
                 src = os.path.join(self.task_config.COMIN_OBSPROC, f"{self.task_config.OPREFIX}{f}")
-                dest = os.path.join(self.task_config.DATA, os.path.basename(src))
-                if preserve_rel_path:  # TODO A hack temporary to preserve directory structure if needed
-                    comin_obsproc = self.task_config.COMIN_OBSPROC
-                    # Take the last 3 parts of the comin_obsproc path
-                    last_three = os.path.join(*comin_obsproc.split(os.sep)[-3:])
-                    sub_dir_tmp = os.path.join(self.task_config.DATA, last_three)
-                    logger.debug(f"Creating subdirectory for input path: {sub_dir_tmp}")
-                    if sub_dir_tmp not in sub_dir_list:
-                        sub_dir_list.append(sub_dir_tmp)
-                    dest = os.path.join(sub_dir_tmp, os.path.basename(src))
-                copylist.append([src, dest])
-                staged_inputs.append(dest)
+                if not os.path.exists(src):
+                    logger.warning(f"Input file {src} not found for {ob_name}")
+                staged_inputs.append(src)
 
             # Stage mapping files
             for f in mapping_files:
@@ -106,7 +103,7 @@ class AtmosBufrObsPrep(Task):
                     self.task_config.HOMEobsforge, "sorc", "spoc", "dump", "config", "atmosphere", f
                 )
                 dest = os.path.join(self.task_config.DATA, os.path.basename(src))
-                copylist.append([src, dest])
+                mapping_list.append([src, dest])
                 staged_mappings.append(dest)
 
             # Stage script files
@@ -115,14 +112,14 @@ class AtmosBufrObsPrep(Task):
                     self.task_config.HOMEobsforge, "sorc", "spoc", "dump", "scripts", "atmosphere", f
                 )
                 dest = os.path.join(self.task_config.DATA, os.path.basename(src))
-                copylist.append([src, dest])
+                static_list.append([src, dest])
                 staged_scripts.append(dest)
 
             # Stage auxiliary files if any
             for f in aux_files:
                 src = os.path.join(self.task_config.HOMEobsforge, "sorc", "spoc", "dump", "aux", f)
                 dest = os.path.join(self.task_config.DATA, os.path.basename(src))
-                copylist.append([src, dest])
+                static_list.append([src, dest])
 
             # Prepare input string for the script
             input_str = staged_inputs
@@ -137,28 +134,74 @@ class AtmosBufrObsPrep(Task):
             # Register observation config (always as lists)
             self.script2netcdf_obs[ob_name] = {
                 'input_str': input_str,
+                'input_files': staged_inputs,
                 'output_file': [os.path.join(self.task_config.DATA, ob_data['output_file'])],
                 'script_file': staged_scripts,
                 'mpi': ob_data.get('mpi', 1),
             }
 
-        # Stage all files
-        if sub_dir_list:
-            logger.debug(f"Creating subdirectories: {sub_dir_list}")
-            FileHandler({'mkdir': sub_dir_list}).sync()
-        FileHandler({'copy_opt': copylist}).sync()
+        # Link the scripts and auxiliary files, shared by the observations and across runs
+        static_list = list({dest: [src, dest] for src, dest in static_list}.values())
+        missing = [src for src, _ in static_list if not os.path.exists(src)]
+        for src in missing:
+            logger.warning(f"Static file {src} not found")
+        static_list = [[src, dest] for src, dest in static_list if src not in missing]
+        static_cache_dir = self.static_cache_dir()
+        if static_cache_dir:
+            link_from_versioned_cache(static_list, static_cache_dir)
+        else:
+            FileHandler({'copy_opt': static_list}).sync()
+
+        # Render the mapping files with the reference time of the cycle
+        for src, dest in mapping_list:
+            self.render_mapping(src, dest)
+
+    def static_cache_dir(self) -> Optional[str]:
+        """
+        Return the directory of the versioned cache of the scripts and auxiliary files.
+
+        The cache is `static_cache_dir`, by default under the cache root (see cache_root) so
+        the runs of all the cycles share it. None when `static_cache_dir` is empty, the files
+        are then copied.
 
-        # For now, as a hack, edit the mapping files to point to the correct reference time
-        # We should eventually modify them in SPOC to use Jinja templates
-        for dest in staged_mappings:
-            yaml_file = YAMLFile(dest)
+        Returns:
+            str: Directory of the cache.
+        """
+        cache_dir = self.task_config.get('static_cache_dir')
+        if cache_dir is None:
+            cache_dir = os.path.join(cache_root(self.task_config), "atmos_bufr_static")
+        return cache_dir or None
+
+    def render_mapping(self, src: str, dest: str) -> None:
+        """
+        Write a mapping file into DATA with the reference time of the cycle.
+
+        A mapping file written as a Jinja template gets `referenceTime` and `current_cycle`
+        in its context. The reference time of the other ones is set in the
+        bufr/variables/timestamp/timeoffset section.
+
+        Args:
+            src (str): Source mapping file.
+            dest (str): Rendered mapping file.
+        """
+        if not os.path.exists(src):
+            logger.warning(f"Mapping file {src} not found")
+            return
+        reference_time = self.task_config.current_cycle.strftime('%Y-%m-%dT%H:%M:%SZ')
+        with open(src) as f:
+            templated = '{{' in f.read()
+        if templated:
+            yaml_file = parse_j2yaml_cached(src, {'referenceTime': reference_time,
+                                                  'current_cycle': self.task_config.current_cycle})
+        else:
+            yaml_file = YAMLFile(src)
             try:
-                yaml_file['bufr']['variables']['timestamp']['timeoffset']['referenceTime'] = \
-                    self.task_config.current_cycle.strftime('%Y-%m-%dT%H:%M:%SZ')
-                yaml_file.save(f"{dest}.tmp")
-                os.replace(f"{dest}.tmp", dest)
+                yaml_file['bufr']['variables']['timestamp']['timeoffset']['referenceTime'] = reference_time
             except Exception as e:
-                logger.warning(f"Failed to update {dest}: {e}")
+                logger.warning(f"Failed to update {src}: {e}")
+        if os.path.lexists(dest):
+            os.remove(dest)
+        yaml_file.save(dest)
 
     @logit(logger)
     def execute(self) -> None:
@@ -169,8 +212,10 @@ class AtmosBufrObsPrep(Task):
 
         # Loop through BUFR to netCDF observations and convert them
 
-        exec_cmd_list = []
-        mpi_count = 0
+        jobs = []
+        history = self.runtime_history()
+        self.manifest = ResultManifest()
+        self.summaries = {}
         for ob_name, ob_data in self.script2netcdf_obs.items():
             input_str = ob_data['input_str']
             output_file = ob_data['output_file']
@@ -182,42 +227,212 @@ class AtmosBufrObsPrep(Task):
             mpi = ob_data.get('mpi', 1)
             logger.info(f"Converting {input_str} to {output_file} using {script_file} and MPI={mpi}")
             if mpi > 1:
-                mpi_count += int(mpi)
                 logger.info(f"Using MPI with {mpi} ranks for {ob_name}")
                 if self.task_config.MPI_LAUNCHER.lower() == 'mpiexec':
-                    exec_cmd = Executable("mpiexec")
-                    args = [
-                        "-n", str(mpi),
-                        "python", script_file,
-                        "--input", input_str,
-                        "--output", output_file,
-                    ]
+                    cmd = ["mpiexec", "-n", str(mpi)]
                 else:  # default to srun
-                    exec_cmd = Executable("srun")
-                    args = [
+                    cmd = [
+                        "srun",
                         "--export", "All",
                         "-n", str(mpi),
                         "--mem", "0G",              # no memory limit
                         "--time", "00:30:00",
-                        "python", script_file,
-                        "--input", input_str,
-                        "--output", output_file,
                     ]
+                cmd += ["python", script_file]
             else:
-                exec_cmd = Executable('python')
-                args = [script_file, '--input', input_str, '--output', output_file]
+                cmd = ['python', script_file]
+            for arg in [['--input'], input_str, ['--output'], output_file]:
+                cmd += arg if isinstance(arg, list) else [arg]
+
+            # the longest conversions are started first, as expected from the past runs,
+            # else from their input size per rank
+            input_bytes = sum(os.path.getsize(f) for f in ob_data.get('input_files', []) if os.path.exists(f))
+            ob_data['input_bytes'] = input_bytes
+            weight = history.estimate(ob_name, input_bytes, mpi) if history else None
+            if weight is None:
+                weight = input_bytes / max(1, int(mpi))
+            jobs.append(Job(ob_name, int(mpi), self.convert_observation, (ob_name, cmd), weight=weight))
+
+        # run everything in parallel, without using more ranks than the cores of the task
+        core_budget = self.core_budget()
+        num_workers = max(1, min(len(jobs), core_budget))
+        logger.info(f"Running {len(jobs)} conversions within {core_budget} cores on {num_workers} threads")
+        scheduler = CoreBudgetScheduler(core_budget)
+        # the threads only wait on their converter process
+        with ThreadPoolExecutor(num_workers) as executor:
+            scheduler.run(executor, jobs)
+        scheduler.write_timeline(os.path.join(self.task_config.DATA, "atmos_bufr_timeline.log"))
+        self.write_summary(scheduler.timeline)
+
+        if history:
+            self.record_history(history, scheduler.timeline, core_budget)
+
+    def convert_observation(self, ob_name: str, cmd: List[str]) -> int:
+        """
+        Run the converter of an observation type.
 
-            for arg in args:
-                exec_cmd.add_default_arg(arg)
+        The output of the converter goes to `<ob_name>.log` in DATA and to the task logger.
+        The converter is killed past `script2netcdf_timeout` seconds if it is set, with the
+        ranks started by its MPI launcher, which are sent SIGTERM `script2netcdf_kill_grace`
+        seconds (default 30) before SIGKILL. The files it wrote are recorded in the result manifest.
 
-            exec_cmd_list.append((ob_name, exec_cmd))
+        Args:
+            ob_name (str): Observation type.
+            cmd (list): Command running the converter.
+
+        Returns:
+            int: Return code of the converter.
+        """
+        log_file = os.path.join(self.task_config.DATA, f"{ob_name}.log")
+        prefix = f"[{ob_name}] "
+        logger.debug(f"Executing {' '.join(cmd)}")
+        started = time.time()
+        try:
+            returncode, stderr_tail = run_streamed(cmd,
+                                                   log_file,
+                                                   cwd=self.task_config.DATA,
+                                                   timeout=self.task_config.get('script2netcdf_timeout'),
+                                                   prefix=prefix,
+                                                   task_logger=logger,
+                                                   kill_grace=self.task_config.get('script2netcdf_kill_grace', 30))
+        except Exception as e:
+            logger.warning(f"Conversion failed for {ob_name}")
+            logger.warning(f"Execution failed for {cmd}: {e}")
+            logger.debug("Exception details", exc_info=True)
+            return -1
+        if returncode != 0:
+            stderr = "\n".join(stderr_tail)
+            logger.warning(f"{prefix}Conversion failed with return code {returncode}, see {log_file}")
+            logger.warning(f"{prefix}Standard Error (last {len(stderr_tail)} lines): \n{stderr}")
+            return returncode
+        self.record_outputs(ob_name, started)
+        return returncode
+
+    def record_outputs(self, ob_name: str, started: float) -> None:
+        """
+        Record the files written by the converter of an observation type in the result manifest,
+        along with their summary statistics.
 
-        # get parallel processing info
-        num_workers = min(len(exec_cmd_list) + mpi_count + 5, max(1, mp.cpu_count() - 1))
-        logger.info(f"Number of worker processes to use: {num_workers} (CPU cores available: {mp.cpu_count()})")
-        # run everything in parallel
-        with mp.Pool(num_workers) as pool:
-            pool.starmap(mp_bufr_converter, exec_cmd_list)
+        The outputs are the regular files matching the output template of the observation
+        type, its split fields (e.g. {splits/satId}) being wildcards, written since the
+        converter started.
+
+        Args:
+            ob_name (str): Observation type.
+            started (float): Time the converter started.
+        """
+        pattern = re.sub(r"\{[^}]*\}", "*", self.script2netcdf_obs[ob_name]['output_file'][0])
+        for output_file in sorted(glob.glob(pattern)):
+            if os.path.islink(output_file) or not os.path.isfile(output_file):
+                continue
+            # mtime may only have a resolution of a second
+            if os.path.getmtime(output_file) < int(started):
+                continue
+            save_file = f"{self.task_config['OPREFIX']}{os.path.basename(output_file)}"
+            try:
+                summary = summarize_ioda_file(output_file)
+            except Exception as e:
+                logger.warning(f"Unable to summarize {output_file}: {e}")
+                summary = {'nlocs': None}
+            self.summaries[save_file] = summary
+            self.manifest.record(output_file, summary['nlocs'], obs_type=ob_name, save_file=save_file)
+
+    def write_summary(self, timeline: List[Job]) -> None:
+        """
+        Log the return code and wall time of each conversion and write them to
+        atmos_bufr_returncodes.yaml in DATA.
+
+        Args:
+            timeline (list): Jobs run by the scheduler.
+        """
+        summary = {}
+        for job in sorted(timeline, key=lambda job: job.name):
+            returncode = -1 if job.error is not None else job.result
+            summary[job.name] = {'returncode': returncode, 'mpi': job.cores, 'walltime': round(job.elapsed, 1)}
+            logger.info(f"{job.name:<12} return code {returncode:>4} in {job.elapsed:8.1f} s on {job.cores} ranks")
+        failed = [name for name, entry in summary.items() if entry['returncode'] != 0]
+        if failed:
+            logger.warning(f"{len(failed)} of {len(summary)} conversions failed: {failed}")
+        save_as_yaml(summary, os.path.join(self.task_config.DATA, "atmos_bufr_returncodes.yaml"))
+
+    def core_budget(self) -> int:
+        """
+        Return the number of cores the conversions may use at once.
+
+        The budget is `core_budget` if set, else the cores allocated to the job by the
+        batch system, else the cores of the node.
+
+        Returns:
+            int: Number of cores.
+        """
+        for key in ['core_budget', 'NCPUS', 'SLURM_CPUS_ON_NODE']:
+            if self.task_config.get(key):
+                return int(self.task_config[key])
+        ppn = re.search(r"ppn=(\d+)", str(self.task_config.get('TASK_GEOM_ATMOS_BUFR_DUMP', '')))
+        if ppn:
+            return int(ppn.group(1))
+        return mp.cpu_count()
+
+    def runtime_history(self) -> Optional[RuntimeHistory]:
+        """
+        Return the history of the conversions of past runs, None if it is disabled.
+
+        The history is kept in `runtime_history_db`, by default under the cache root (see
+        cache_root) so the runs of all the cycles share it, unlike DATAROOT which is set per
+        cycle by the workflow.
+
+        Returns:
+            RuntimeHistory: The history.
+        """
+        db_name = self.task_config.get('runtime_history_db')
+        if db_name is None:
+            db_name = os.path.join(cache_root(self.task_config), "atmos_bufr_runtime_history.db")
+        if not db_name:
+            return None
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(db_name)), exist_ok=True)
+            return RuntimeHistory(db_name)
+        except Exception as e:
+            logger.warning(f"Runtime history {db_name} is not available: {e}")
+            return None
+
+    def record_history(self, history: RuntimeHistory, timeline: list, core_budget: int) -> None:
+        """
+        Record the conversions of this run into the history and suggest their MPI ranks.
+
+        The suggested ranks minimize the estimated total wall time within the core budget,
+        they are logged and written to atmos_bufr_mpi_suggestions.yaml in DATA.
+
+        Args:
+            history (RuntimeHistory): History of the conversions.
+            timeline (list): Jobs run by the scheduler.
+            core_budget (int): Number of cores the conversions may use at once.
+        """
+        cycle = self.task_config.current_cycle.strftime('%Y%m%d%H')
+        for job in timeline:
+            ob_data = self.script2netcdf_obs[job.name]
+            success = job.succeeded
+            nobs = [entry['nlocs'] for entry in self.manifest.entries.values() if entry['obs_type'] == job.name]
+            nobs = sum(nobs) if nobs and None not in nobs else None
+            history.record(job.name, cycle, ob_data['input_bytes'], nobs, job.cores, job.elapsed, success)
+
+        walltime = self.task_config.get('WALLTIME_ATMOS_BUFR_DUMP')
+        walltime_limit = None
+        if walltime:
+            try:
+                if not isinstance(walltime, timedelta):
+                    walltime = to_timedelta(str(walltime))
+                walltime_limit = walltime.total_seconds()
+            except (TypeError, ValueError) as e:
+                # only the suggestions depend on it, the conversions are already done
+                logger.warning(f"Ignoring the walltime {walltime!r} in the MPI suggestions: {e}")
+        jobs = {job.name: (self.script2netcdf_obs[job.name]['input_bytes'], job.cores) for job in timeline}
+        suggestions, estimate = history.suggest_mpi(jobs, core_budget, walltime_limit)
+        if estimate is None:
+            return
+        logger.info(f"Suggested MPI ranks (estimated wall time {estimate:.0f} s): {suggestions}")
+        save_as_yaml({'estimated walltime': round(estimate, 1), 'mpi': suggestions},
+                     os.path.join(self.task_config.DATA, "atmos_bufr_mpi_suggestions.yaml"))
 
     @logit(logger)
     def finalize(self) -> None:
@@ -227,23 +442,27 @@ class AtmosBufrObsPrep(Task):
         This method will finalize an atmospheric BUFR observation prep task.
         This includes:
         - Creating an output directory in COMOUT
-        - Copying output IODA files to COMOUT
-        - Creating a "ready" file in COMOUT to signal that the observations are ready
+        - Copying the output IODA files recorded in the result manifest to COMOUT, along with the manifest
+        - Creating a "ready" file in COMOUT to signal that the observations are ready, holding the
+          summary statistics of the files computed by the conversions (summary_engine: python),
+          or from ioda-dump.x (summary_engine: ioda-dump)
+        - Writing the disk usage report of DATA to COMOUT
         """
         comout = os.path.join(self.task_config['COMROOT'],
                               self.task_config['PSLOT'],
                               f"{self.task_config.RUN}.{self.task_config.current_cycle.strftime('%Y%m%d')}",
                               f"{self.task_config.cyc:02d}",
                               'atmos')
-        # get a list of files to copy out
-        output_files = glob.glob(os.path.join(self.task_config.DATA, "*.nc"))
+        # copy out the files recorded in the result manifest by the conversions
         copy_list = []
-        for output_file in output_files:
-            filename = os.path.basename(output_file)
-            if 'Coeff' not in filename:
-                destination_file = os.path.join(comout, f"{self.task_config['OPREFIX']}{filename}")
-                copy_list.append([output_file, destination_file])
-        FileHandler({'mkdir': [comout], 'copy_opt': copy_list}).sync()
+        comout_manifest = ResultManifest()
+        for output_file, entry in self.manifest.items():
+            copy_list.append([output_file, os.path.join(comout, entry['save_file'])])
+            comout_manifest.entries[entry['save_file']] = {key: value for key, value in entry.items() if key != 'save_file'}
+        FileHandler({'mkdir': [comout]}).sync()
+        copy_files(copy_list, self.task_config.get('copy_workers', 4))
+        comout_manifest.save(os.path.join(comout, f"{self.task_config['OPREFIX']}obsforge_atmos_bufr_manifest.yaml"))
+        self.scratch.write_report(os.path.join(comout, f"{self.task_config['OPREFIX']}obsforge_atmos_bufr_scratch.yaml"))
 
         # create a summary stats file to tell external processes the obs are ready
         ready_file = pathlib.Path(os.path.join(comout, f"{self.task_config['OPREFIX']}obsforge_atmos_bufr_status.log"))
@@ -256,6 +475,15 @@ class AtmosBufrObsPrep(Task):
             'input directory': str(comout),
             'output file': str(ready_file),
         }
+        if self.task_config.get('summary_engine', 'python') == 'python':
+            summary_dict['files'] = {save_file: self.summaries[save_file] for save_file in sorted(self.summaries)}
+            summary_dict['nlocs'] = sum(summary['nlocs'] or 0 for summary in self.summaries.values())
+            logger.info(f"Creating summary file {ready_file}")
+            # written under a temporary name, the ready file only appears once complete
+            save_as_yaml(summary_dict, f"{ready_file}.tmp")
+            os.replace(f"{ready_file}.tmp", ready_file)
+            return
+
         save_as_yaml(summary_dict, os.path.join(self.task_config.DATA, "stats.yaml"))
         exec_cmd = Executable(os.path.join(self.task_config.HOMEobsforge, "build", "bin", "ioda-dump.x"))
         exec_cmd.add_default_arg(os.path.join(self.task_config.DATA, "stats.yaml"))
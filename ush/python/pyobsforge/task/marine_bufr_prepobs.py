@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import glob
+import hashlib
 from logging import getLogger
+import multiprocessing
+import os
 from os import path
 import pathlib
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from wxflow import (
     AttrDict,
     Executable,
@@ -13,12 +19,16 @@ from wxflow import (
     to_isotime,
     to_timedelta,
     logit,
-    parse_j2yaml,
-    parse_yaml,
     save_as_yaml,
 )
 from pyobsforge.task.sfcshp import SfcShp
-import netCDF4
+from pyobsforge.utils.templates import parse_j2yaml_cached
+from pyobsforge.utils.ioda import concat_insitu_files, count_locations
+from pyobsforge.utils.manifest import ResultManifest
+from pyobsforge.utils.process import run_streamed
+from pyobsforge.utils import b2i_worker
+from pyobsforge.utils.conversion_cache import ConversionCache
+from pyobsforge.utils.staging import ScratchManager, cache_root
 
 logger = getLogger(__name__.split('.')[-1])
 
@@ -54,6 +64,9 @@ class MarineBufrObsPrep(Task):
 
         self.task_config = AttrDict(**self.task_config, **local_dict)
 
+        # Bytes of the local bufr dumps per provider, removed once converted as configured
+        self.scratch = ScratchManager.from_task_config(self.task_config)
+
     @logit(logger)
     def initialize(self) -> None:
         """
@@ -64,9 +77,14 @@ class MarineBufrObsPrep(Task):
 
         obs_cycle_dict = AttrDict({key: self.task_config[key] for key in ['DATA', 'OBSPROC_COMROOT', 'RUN', 'ocean_basin']})
         bufr_files_to_copy = []
+        cache = self.bufr2ioda_cache()
         RUN = self.task_config.RUN
         cycstr = self.task_config.cycstr
 
+        # the sfcshp dumps are split once, into the subsets of all the providers
+        sfcshp_dump_tags = {provider.get('dump_tag') for provider in providers}
+        sfcshp_split = set()
+
         for provider in providers:
 
             try:
@@ -97,22 +115,23 @@ class MarineBufrObsPrep(Task):
                     'obs_cycle': obs_cycle,
                     'obs_cycle_PREFIX': f"{obs_cycle_dict['RUN']}.t{obs_cycle_cyc}z."
                 })
-                obs_cycle_config = parse_j2yaml(self.task_config.bufr2ioda_config_temp, obs_cycle_dict)
+                obs_cycle_config = parse_j2yaml_cached(self.task_config.bufr2ioda_config_temp, obs_cycle_dict)
 
                 if (not sfcshp.is_ready()) and sfcshp.has_provider_for(provider["dump_tag"]):
                     # construct sfcshp_filename using j2yaml
-                    sfcshp_cycle_dict = obs_cycle_dict
-                    sfcshp_cycle_dict['dump_tag'] = 'sfcshp'
-                    sfcshp_cycle_config = parse_j2yaml(self.task_config.bufr2ioda_config_temp, sfcshp_cycle_dict)
+                    sfcshp_cycle_dict = dict(obs_cycle_dict, dump_tag='sfcshp')
+                    sfcshp_cycle_config = parse_j2yaml_cached(self.task_config.bufr2ioda_config_temp, sfcshp_cycle_dict)
                     sfcshp_filename = sfcshp_cycle_config.dump_filename
 
-                    if path.exists(sfcshp_filename):
-                        # split and rename
+                    if sfcshp_filename in sfcshp_split:
+                        logger.debug(f"{sfcshp_filename} already split")
+                    elif path.exists(sfcshp_filename):
+                        # split straight into the local dump files of the providers
                         cycle = obs_cycle_config.cycle_datetime[-2:]
                         sfcshp = SfcShp(sfcshp_filename, cycle=cycle)
-                        sfcshp.split()  # result is in cwd
-                        sfcshp.rename(self.task_config.bufr2ioda_config_temp, sfcshp_cycle_dict)
+                        sfcshp.split_for(self.task_config.bufr2ioda_config_temp, sfcshp_cycle_dict, sfcshp_dump_tags)
                         sfcshp.set_ready()
+                        sfcshp_split.add(sfcshp_filename)
                     else:
                         logger.warning(f"sfcshp not found: {sfcshp_filename}")
 
@@ -120,16 +139,28 @@ class MarineBufrObsPrep(Task):
                 # and conversion
                 # if the bufr file exists in RUNDIR (because it was split from
                 # sfcshp in OBSPROC_COMROOT), set it up for conversion
+                # the cycles converted by a previous run are reused from the cache,
+                # without copying their bufr file again
                 logger.debug(f"Looking for {obs_cycle_config.dump_filename}...")
                 if path.exists(obs_cycle_config.dump_filename):
+                    ioda_files_to_concat.append(obs_cycle_config.ioda_filename)
+                    cache_key = None
+                    if cache:
+                        cache_key = self.bufr2ioda_cache_key(provider['name'], obs_cycle_config, obs_cycle_config.dump_filename)
+                        if cache.fetch(cache_key, path.join(self.task_config.DATA, obs_cycle_config.ioda_filename)):
+                            continue
                     save_as_yaml(obs_cycle_config, obs_cycle_config.bufr2ioda_yaml)
                     bufr_files_to_copy.append([obs_cycle_config.dump_filename, obs_cycle_config.local_dump_filename])
-                    obs_cycles_to_convert.append(obs_cycle_config)
-                    ioda_files_to_concat.append(obs_cycle_config.ioda_filename)
+                    obs_cycles_to_convert.append(dict(obs_cycle_config, cache_key=cache_key))
                 elif path.exists(obs_cycle_config.local_dump_filename):
-                    save_as_yaml(obs_cycle_config, obs_cycle_config.bufr2ioda_yaml)
-                    obs_cycles_to_convert.append(obs_cycle_config)
                     ioda_files_to_concat.append(obs_cycle_config.ioda_filename)
+                    cache_key = None
+                    if cache:
+                        cache_key = self.bufr2ioda_cache_key(provider['name'], obs_cycle_config, obs_cycle_config.local_dump_filename)
+                        if cache.fetch(cache_key, path.join(self.task_config.DATA, obs_cycle_config.ioda_filename)):
+                            continue
+                    save_as_yaml(obs_cycle_config, obs_cycle_config.bufr2ioda_yaml)
+                    obs_cycles_to_convert.append(dict(obs_cycle_config, cache_key=cache_key))
                 else:
                     logger.warning(f"Unable to setup conversion for {obs_cycle_config.data_format}")
 
@@ -155,89 +186,266 @@ class MarineBufrObsPrep(Task):
                 concat_configs.append(concat_config)
             provider['concat_configs'] = concat_configs
 
-        save_as_yaml(providers, "providers.yaml")
+        # the providers are kept on the task for execute and finalize,
+        # providers.yaml is only written for debugging
+        self.providers = providers
+        self.manifest = ResultManifest()
+        if self.task_config.get('save_providers_yaml', False):
+            save_as_yaml(providers, "providers.yaml")
 
         # fetch available bufr files and make COMIN_OBSPROC
         FileHandler({'copy_opt': bufr_files_to_copy}).sync()
         FileHandler({'mkdir': [self.task_config.COMIN_OBSPROC]}).sync()
+        for provider in providers:
+            self.scratch.stage(provider['name'], [obs_cycle_config['local_dump_filename']
+                                                  for obs_cycle_config in provider['obs_cycles_to_convert']])
 
     @logit(logger)
     def execute(self) -> None:
         """
+        Convert the BUFR dumps of all the providers and cycles with a bounded pool of
+        `bufr2ioda_workers` concurrent converters. Each provider is concatenated as soon
+        as its own conversions are done, while the conversions of the others go on.
+
+        With `bufr2ioda_in_process`, the converters run inside long-lived worker processes
+        that import them once, instead of a new python interpreter per conversion. Their
+        output then only goes to the task logger and `bufr2ioda_timeout` does not apply.
+        The conversions lost with a crashed worker process are run again as subprocesses.
         """
         logger.info("running execute")
-        HOMEobsforge = self.task_config.HOMEobsforge
-        providers = parse_yaml("providers.yaml")
+        providers = self.providers
+        cache = self.bufr2ioda_cache()
+
+        num_workers = max(1, self.task_config.get('bufr2ioda_workers', 4))
+        subprocess_executor = ThreadPoolExecutor(max_workers=num_workers)
+        if self.task_config.get('bufr2ioda_in_process', False):
+            if self.task_config.get('bufr2ioda_timeout') is not None:
+                logger.warning("bufr2ioda_timeout does not apply to the converters run in process")
+            b2i_dir = path.join(self.task_config.HOMEobsforge, 'utils', 'b2i')
+            executor = ProcessPoolExecutor(max_workers=num_workers,
+                                           mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=b2i_worker.init_worker,
+                                           initargs=(b2i_dir,))
+
+            def submit(provider_name, obs_cycle_config):
+                return executor.submit(b2i_worker.convert, provider_name, obs_cycle_config['bufr2ioda_yaml'])
+        else:
+            executor = subprocess_executor
+
+            def submit(provider_name, obs_cycle_config):
+                return executor.submit(self.convert_obs_cycle, provider_name, obs_cycle_config)
+
+        with subprocess_executor, executor:
+            pending = {}
+            for provider in providers:
+                futures = [submit(provider['name'], obs_cycle_config)
+                           for obs_cycle_config in provider['obs_cycles_to_convert']]
+                pending[provider['name']] = (provider, futures)
+
+            while pending:
+                for provider_name, (provider, futures) in list(pending.items()):
+                    # a crashed worker process breaks the pool and all its pending conversions
+                    for i, (future, obs_cycle_config) in enumerate(zip(futures, provider['obs_cycles_to_convert'])):
+                        if future.done() and isinstance(future.exception(), BrokenProcessPool):
+                            logger.warning(f"Worker process lost, converting {obs_cycle_config['bufr2ioda_yaml']} "
+                                           "in a subprocess")
+                            futures[i] = subprocess_executor.submit(self.convert_obs_cycle, provider_name, obs_cycle_config)
+                    if all(future.done() for future in futures):
+                        del pending[provider_name]
+                        failed = [future for future in futures if future.exception() is not None or future.result() != 0]
+                        if failed:
+                            logger.warning(f"{len(failed)} of {len(futures)} conversions failed for {provider_name}")
+                        if cache:
+                            for future, obs_cycle_config in zip(futures, provider['obs_cycles_to_convert']):
+                                if future not in failed and obs_cycle_config.get('cache_key'):
+                                    cache.store(obs_cycle_config['cache_key'],
+                                                path.join(self.task_config.DATA, obs_cycle_config['ioda_filename']))
+                        # for each variable in the converted ioda file, concat all of the
+                        # converted ioda files in the window
+                        self.concat_provider(provider)
+                        self.scratch.converted(provider_name, not failed)
+                running = [future for _, futures in pending.values() for future in futures if not future.done()]
+                if running:
+                    wait(running, return_when=FIRST_COMPLETED)
+
+        if cache:
+            cache.prune(self.task_config.get('bufr2ioda_cache_max_age', 72))
+
+    def bufr2ioda_cache(self) -> Optional[ConversionCache]:
+        """
+        Returns the cache of the converted cycles kept across runs and cycles, in
+        `bufr2ioda_cache_dir` (defaults to bufr2ioda_cache under the cache root, see
+        cache_root), or None if `bufr2ioda_cache` is disabled.
+        """
+        if not self.task_config.get('bufr2ioda_cache', True):
+            return None
+        cache_dir = self.task_config.get('bufr2ioda_cache_dir') or path.join(cache_root(self.task_config), 'bufr2ioda_cache')
+        return ConversionCache(cache_dir)
 
-        for provider in providers:
-            provider_name = provider['name']
-            logger.info(f"Processing provider: {provider_name}")
-            # TODO(AFE) set this in providers
-            bufrconverter = f"{HOMEobsforge}/utils/b2i/bufr2ioda_{provider_name}.py"
-
-            obs_cycle_configs = provider['obs_cycles_to_convert']
-            for obs_cycle_config in obs_cycle_configs:
-
-                converter = Executable('python')
-                converter.add_default_arg(bufrconverter)
-                converter.add_default_arg('-c')
-                converter.add_default_arg(obs_cycle_config['bufr2ioda_yaml'])
-                try:
-                    logger.debug(f"Executing {converter}")
-                    converter()
-                except Exception as e:
-                    logger.warning(f"Converter failed for {provider_name}")
-                    logger.warning(f"Execution failed for {converter}: {e}")
-                    logger.debug("Exception details", exc_info=True)
-                    continue  # skip to the next obs_cycle_config
-
-            # for each variable in the converted ioda file, concat all of the
-            # converted ioda files in the window
-            for concat_config in provider['concat_configs']:
-                final_input_files = []
-                for input_file in concat_config['input files']:
-                    if path.exists(input_file):
-                        final_input_files.append(input_file)
-                concat_config.update({'input files': final_input_files})
-                save_as_yaml(concat_config, concat_config['concat config file'])
-                concater = Executable(self.task_config.OCNOBS2IODAEXEC)
-                concater.add_default_arg(concat_config['concat config file'])
-                try:
-                    logger.debug(f"Executing {concater}")
-                    concater()
-                except Exception as e:
-                    logger.warning(f"Concatenation failed for {concat_config['provider_var']}")
-                    logger.warning(f"Execution failed for {concater}: {e}")
-                    logger.debug("Exception details", exc_info=True)
-                    continue  # skip to the next obs_cycle_config
+    def bufr2ioda_cache_key(self, provider_name: str, obs_cycle_config: Dict[str, Any], dump_file: str) -> str:
+        """
+        Key of the conversion of a cycle, from its configuration, its bufr file and the converter.
+
+        The bufr files of OBSPROC_COMROOT are identified by their path, size and modification
+        time, the ones split in the run directory (from sfcshp) by their content. The paths
+        into the run directory are left out of the key, as they change from a run to the next.
+
+        Args:
+            provider_name (str): Provider name.
+            obs_cycle_config (dict): Rendered bufr2ioda configuration of the cycle.
+            dump_file (str): bufr file of the cycle.
+
+        Returns:
+            str: Key of the conversion.
+        """
+        config = {key: value for key, value in obs_cycle_config.items()
+                  if key not in ['dump_directory', 'ioda_directory', 'local_dump_filename', 'bufr2ioda_yaml']}
+        if path.abspath(dump_file).startswith(path.abspath(self.task_config.DATA)):
+            with open(dump_file, 'rb') as f:
+                config['dump identity'] = hashlib.sha256(f.read()).hexdigest()
+        else:
+            stat = os.stat(dump_file)
+            config['dump identity'] = f"{path.abspath(dump_file)}:{stat.st_size}:{stat.st_mtime_ns}"
+        config['converter version'] = self.bufr2ioda_version()
+        bufrconverter = path.join(self.task_config.HOMEobsforge, 'utils', 'b2i', f"bufr2ioda_{provider_name}.py")
+        return ConversionCache.compute_key(config, [], bufrconverter)
+
+    def bufr2ioda_version(self) -> str:
+        """
+        Digest of the sources of the bufr2ioda converters, so the cached cycles are converted
+        again when any of the converters or of their shared modules changes.
+        """
+        if getattr(self, '_bufr2ioda_version', None) is None:
+            b2i_dir = path.join(self.task_config.HOMEobsforge, 'utils', 'b2i')
+            digest = hashlib.sha256()
+            for source in sorted(glob.glob(path.join(b2i_dir, '*.py')) + glob.glob(path.join(b2i_dir, 'b2iconverter', '*.py'))):
+                with open(source, 'rb') as f:
+                    digest.update(path.relpath(source, b2i_dir).encode())
+                    digest.update(f.read())
+            self._bufr2ioda_version = digest.hexdigest()
+        return self._bufr2ioda_version
+
+    def convert_obs_cycle(self, provider_name: str, obs_cycle_config: Dict[str, Any]) -> int:
+        """
+        Convert the BUFR dump of one cycle of a provider to ioda.
+
+        The output of the converter goes to `<bufr2ioda yaml>.log` and to the task logger.
+
+        Args:
+            provider_name (str): Provider name.
+            obs_cycle_config (dict): Rendered bufr2ioda configuration of the cycle.
+
+        Returns:
+            int: Return code of the converter.
+        """
+        # TODO(AFE) set this in providers
+        bufrconverter = f"{self.task_config.HOMEobsforge}/utils/b2i/bufr2ioda_{provider_name}.py"
+        bufr2ioda_yaml = obs_cycle_config['bufr2ioda_yaml']
+        log_file = f"{path.splitext(bufr2ioda_yaml)[0]}.log"
+        prefix = f"[{path.basename(path.splitext(bufr2ioda_yaml)[0])}] "
+        logger.info(f"Converting {obs_cycle_config['local_dump_filename']} with {bufrconverter}")
+        try:
+            returncode, stderr_tail = run_streamed(['python', bufrconverter, '-c', bufr2ioda_yaml],
+                                                   log_file,
+                                                   timeout=self.task_config.get('bufr2ioda_timeout'),
+                                                   prefix=prefix,
+                                                   task_logger=logger)
+        except Exception as e:
+            logger.warning(f"Converter failed for {provider_name}")
+            logger.warning(f"Execution failed for {bufrconverter}: {e}")
+            logger.debug("Exception details", exc_info=True)
+            return -1
+        if returncode != 0:
+            stderr = "\n".join(stderr_tail)
+            logger.warning(f"{prefix}Converter failed for {provider_name} with return code {returncode}, see {log_file}")
+            logger.warning(f"{prefix}Standard Error (last {len(stderr_tail)} lines): \n{stderr}")
+        return returncode
+
+    def concat_provider(self, provider: Dict[str, Any]) -> None:
+        """
+        Concatenate the converted ioda files of a provider into one ioda file per variable.
+
+        With the python `concat_engine`, the converted files are read once for all the
+        variables of the provider, instead of once per variable with the ioda converter.
+
+        Args:
+            provider (dict): Provider configuration, with its concatenation configurations.
+        """
+        if self.task_config.get('concat_engine', 'python') != 'python':
+            self.concat_provider_with_converter(provider)
+            return
+        concat_configs = provider['concat_configs']
+        if not concat_configs:
+            return
+        # All the variables of a provider are concatenated from the same files
+        input_files = [input_file for input_file in concat_configs[0]['input files'] if path.exists(input_file)]
+        output_files = {concat_config['variable']: concat_config['output file'] for concat_config in concat_configs}
+        try:
+            nlocs = concat_insitu_files(input_files, output_files,
+                                        concat_configs[0]['window begin'], concat_configs[0]['window end'],
+                                        concat_configs[0]['error ratio'])
+        except Exception as e:
+            logger.warning(f"Concatenation failed for {provider['name']}: {e}")
+            logger.debug("Exception details", exc_info=True)
+            return
+        for concat_config in concat_configs:
+            if concat_config['variable'] in nlocs:
+                self.manifest.record(concat_config['output file'], nlocs[concat_config['variable']],
+                                     save_file=concat_config['save file'])
+
+    def concat_provider_with_converter(self, provider: Dict[str, Any]) -> None:
+        """
+        Concatenate the converted ioda files of a provider with one run of the ioda
+        converter per variable.
+
+        Args:
+            provider (dict): Provider configuration, with its concatenation configurations.
+        """
+        for concat_config in provider['concat_configs']:
+            final_input_files = []
+            for input_file in concat_config['input files']:
+                if path.exists(input_file):
+                    final_input_files.append(input_file)
+            concat_config.update({'input files': final_input_files})
+            save_as_yaml(concat_config, concat_config['concat config file'])
+            concater = Executable(self.task_config.OCNOBS2IODAEXEC)
+            concater.add_default_arg(concat_config['concat config file'])
+            try:
+                logger.debug(f"Executing {concater}")
+                concater()
+                nlocs = count_locations(concat_config['output file'])
+            except Exception as e:
+                logger.warning(f"Concatenation failed for {concat_config['provider_var']}")
+                logger.warning(f"Execution failed for {concater}: {e}")
+                logger.debug("Exception details", exc_info=True)
+                continue  # skip to the next concat_config
+            self.manifest.record(concat_config['output file'], nlocs, save_file=concat_config['save file'])
 
     @logit(logger)
     def finalize(self) -> None:
         """
+        Copy the concatenated ioda files recorded in the result manifest to COMIN_OBSPROC,
+        along with the manifest, with the obs count and checksum of each file.
         """
         logger.info("running finalize")
 
-        providers = parse_yaml("providers.yaml")
-
         ioda_files_to_copy = []
-
-        for provider in providers:
-            for concat_config in provider['concat_configs']:
-                ioda_filename = concat_config['output file']
-                logger.info(f"ioda_filename: {ioda_filename}")
-                source_ioda_filename = path.join(self.task_config.DATA, ioda_filename)
-                if path.exists(source_ioda_filename):
-                    destination_ioda_filename = path.join(self.task_config.COMIN_OBSPROC, concat_config['save file'])
-                    # Only append if source_ioda_filename is a valid NetCDF4 file
-                    try:
-                        with netCDF4.Dataset(source_ioda_filename, 'r'):
-                            ioda_files_to_copy.append([source_ioda_filename, destination_ioda_filename])
-                    except Exception:
-                        logger.warning(f"Skipping invalid file: {source_ioda_filename}")
+        comin_manifest = ResultManifest()
+        for ioda_filename, entry in self.manifest.items():
+            logger.info(f"ioda_filename: {ioda_filename}, {entry['nlocs']} locations")
+            source_ioda_filename = path.join(self.task_config.DATA, ioda_filename)
+            destination_ioda_filename = path.join(self.task_config.COMIN_OBSPROC, entry['save_file'])
+            ioda_files_to_copy.append([source_ioda_filename, destination_ioda_filename])
+            comin_manifest.entries[entry['save_file']] = {key: value for key, value in entry.items() if key != 'save_file'}
 
         FileHandler({'copy_opt': ioda_files_to_copy}).sync()
+        comin_manifest.save(path.join(self.task_config.COMIN_OBSPROC,
+                                      f"{self.task_config['PREFIX']}obsforge_marine_bufr_manifest.yaml"))
 
         # create an empty file to tell external processes the obs are ready
         ready_file = pathlib.Path(path.join(self.task_config.COMIN_OBSPROC,
                                             f"{self.task_config['PREFIX']}obsforge_marine_bufr_status.log"))
         ready_file.touch()
+
+        self.scratch.write_report(path.join(self.task_config.COMIN_OBSPROC,
+                                            f"{self.task_config['PREFIX']}obsforge_marine_bufr_scratch.yaml"))
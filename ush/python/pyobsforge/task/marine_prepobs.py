@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
 from logging import getLogger
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 from wxflow import AttrDict, Task, add_to_datetime, to_timedelta, logit, FileHandler
 from pyobsforge.task.providers import ProviderConfig
-from multiprocessing import Process, Manager
-from os.path import join
+from pyobsforge.task.run_nc2ioda import prune_shared_stage, run_nc2ioda_batch
+from pyobsforge.utils.staging import ScratchManager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import join, exists
 from datetime import timedelta
 import glob
 from os.path import basename
 import pathlib
+import queue
+import threading
+import time
 
 logger = getLogger(__name__.split('.')[-1])
 
@@ -36,6 +41,8 @@ class MarineObsPrep(Task):
         self.task_config = AttrDict(**self.task_config, **local_dict)
 
         # Initialize the Providers
+        self.provider_names = ["ghrsst", "rads", "nesdis_amsr2", "nesdis_mirs",
+                               "nesdis_jpssrr", "smap", "smos"]
         self.ghrsst = ProviderConfig.from_task_config("ghrsst", self.task_config)
         self.rads = ProviderConfig.from_task_config("rads", self.task_config)
         self.nesdis_amsr2 = ProviderConfig.from_task_config("nesdis_amsr2", self.task_config)
@@ -45,56 +52,176 @@ class MarineObsPrep(Task):
         self.smos = ProviderConfig.from_task_config("smos", self.task_config)
 
         # Initialize the list of processed ioda files
-        # TODO: Does not work. This should be a list of gathered ioda files that are created
-        #       across all processes
         self.ioda_files = []
 
+        # Bytes staged per obs space, removed once converted as configured
+        self.scratch = ScratchManager.from_task_config(self.task_config)
+
     @logit(logger)
     def initialize(self) -> None:
         """
+        Update the provider databases with new files.
+
+        Each provider scans its own DCOM directories into its own database, and the scans are
+        dominated by filesystem metadata latency, so the providers are ingested concurrently.
+        """
+        num_workers = self.task_config.get('ingest_workers', len(self.provider_names))
+        logger.info(f"Ingesting {len(self.provider_names)} providers with {num_workers} workers")
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            futures = {executor.submit(self.ingest_provider, name): name for name in self.provider_names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    elapsed = future.result()
+                    logger.info(f"Ingested {name} in {elapsed:.2f} s")
+                except Exception as e:
+                    logger.error(f"Ingest failed for {name}: {e}")
+                    raise
+        logger.info(f"Ingested all providers in {time.perf_counter() - start:.2f} s")
+
+    def ingest_provider(self, provider: str) -> float:
+        """
+        Ingest the new files of a single provider into its database.
+
+        Args:
+            provider (str): Provider name, e.g. "ghrsst".
+
+        Returns:
+            float: Wall time of the ingest, in seconds.
         """
-        # Update the database with new files
-        self.ghrsst.db.ingest_files()
-        self.rads.db.ingest_files()
-        self.nesdis_amsr2.db.ingest_files()
-        self.nesdis_mirs.db.ingest_files()
-        self.nesdis_jpssrr.db.ingest_files()
-        self.smap.db.ingest_files()
-        self.smos.db.ingest_files()
+        start = time.perf_counter()
+        getattr(self, provider).db.ingest_files()
+        return time.perf_counter() - start
 
     @logit(logger)
     def execute(self) -> None:
         """
+        Stage and convert all the observation spaces.
+
+        Staging (database query and copy of the granules) and conversion run as a two stage
+        pipeline connected by a bounded queue: the staging workers hand each staged obs space
+        to the conversion workers, so the converter of one obs space runs while the granules
+        of the next ones are still being copied. A conversion worker converts up to
+        nc2ioda_batch_size of the queued obs spaces with a single launch of the converter.
         """
-        with Manager() as manager:
-            # Use a Manager list to share ioda_files across processes
-            shared_ioda_files = manager.list()
-
-            processes = []
-            for provider, obs_spaces in self.task_config.providers.items():
-                logger.info(f"========= provider: {provider}")
-                for obs_space in obs_spaces["list"]:
-                    logger.info(f"========= obs_space: {obs_space}")
-
-                    # Start a new process
-                    process = Process(target=self.process_obs_space,
-                                      args=(provider, obs_space, shared_ioda_files))
-                    process.start()
-                    processes.append(process)
-
-            # Wait for all processes to complete
-            for process in processes:
-                process.join()
-
-            # Convert the Manager list to a regular list
-            self.ioda_files = list(shared_ioda_files)
-            logger.info(f"Final ioda_files: {self.ioda_files}")
+        staging_workers = max(1, self.task_config.get('staging_workers', 4))
+        conversion_workers = max(1, self.task_config.get('conversion_workers', 8))
+        batch_size = max(1, self.task_config.get('nc2ioda_batch_size', 1))
+        queue_size = max(1, self.task_config.get('pipeline_queue_size', conversion_workers * batch_size))
+        logger.info(f"Pipeline: {staging_workers} staging workers, {conversion_workers} conversion workers, "
+                    f"queue size {queue_size}, batches of up to {batch_size} obs spaces")
 
-    @logit(logger)
-    def process_obs_space(self,
-                          provider: str,
-                          obs_space: str,
-                          shared_ioda_files) -> None:
+        staged = queue.Queue(maxsize=queue_size)
+        ioda_files = []
+        ioda_files_lock = threading.Lock()
+
+        def convert_worker() -> None:
+            done = False
+            while not done:
+                item = staged.get()
+                if item is None:
+                    return
+                # Gather whatever else is already staged into a batch
+                batch = [item]
+                while len(batch) < batch_size:
+                    try:
+                        item = staged.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        done = True
+                        break
+                    batch.append(item)
+                try:
+                    self.convert_batch(batch)
+                except Exception as e:
+                    logger.error(f"Conversion failed for {[obs_space for _, obs_space, _ in batch]}: {e}")
+                    for _, obs_space, _ in batch:
+                        self.scratch.converted(obs_space, False)
+                    continue
+                for _, obs_space, context in batch:
+                    output_file = context.get('merge_into', context['output_file'])
+                    converted = exists(join(self.task_config['DATA'], output_file))
+                    if converted:
+                        with ioda_files_lock:
+                            ioda_files.append(output_file)
+                    self.scratch.converted(obs_space, converted)
+
+        def stage(provider: str, obs_space: str) -> None:
+            kwargs = self.obs_space_kwargs(provider, obs_space)
+            if kwargs is None:
+                return
+            context = getattr(self, provider).stage_obs_space(**kwargs)
+            if context is not None:
+                self.scratch.stage(obs_space, context['input_files'])
+                # Blocks while the conversion workers are behind
+                staged.put((provider, obs_space, context))
+
+        converters = [threading.Thread(target=convert_worker, name=f"convert-{i}")
+                      for i in range(conversion_workers)]
+        for converter in converters:
+            converter.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=staging_workers) as executor:
+                futures = {}
+                for provider, obs_spaces in self.task_config.providers.items():
+                    logger.info(f"========= provider: {provider}")
+                    for obs_space in obs_spaces["list"]:
+                        logger.info(f"========= obs_space: {obs_space}")
+                        futures[executor.submit(stage, provider, obs_space)] = obs_space
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Staging failed for {futures[future]}: {e}")
+        finally:
+            # One sentinel per conversion worker, queued behind the staged obs spaces
+            for _ in converters:
+                staged.put(None)
+            for converter in converters:
+                converter.join()
+
+        self.ioda_files = sorted(ioda_files)
+        logger.info(f"Final ioda_files: {self.ioda_files}")
+
+    def convert_batch(self, batch: List[Tuple[str, str, dict]]) -> None:
+        """
+        Convert a batch of staged observation spaces.
+
+        A single obs space goes through its provider, a larger batch is converted with a single
+        launch of the ioda converter. Incremental and chunked obs spaces always go through their
+        provider, which merges their increment or chunks after the conversion.
+
+        Args:
+            batch (list): (provider, obs_space, context) of the staged obs spaces.
+        """
+        batched = [(provider, obs_space, context) for provider, obs_space, context in batch
+                   if not (getattr(self, provider).is_incremental(obs_space) or getattr(self, provider).is_chunked(context))]
+        if len(batched) < 2:
+            batched = []
+        for provider, obs_space, context in batch:
+            if (provider, obs_space, context) not in batched:
+                getattr(self, provider).convert_obs_space(self.task_config, obs_space, context)
+        if batched:
+            contexts = {obs_space: context for _, obs_space, context in batched}
+            batch_name = join(batched[0][1], f"{batched[0][1]}_batch")
+            result = run_nc2ioda_batch(self.task_config, batch_name, contexts)
+            logger.info(f"run_nc2ioda_batch result: {result}")
+
+    def obs_space_kwargs(self, provider: str, obs_space: str) -> Optional[Dict[str, Any]]:
+        """
+        Build the keyword arguments of ProviderConfig.stage_obs_space for an observation space.
+
+        Args:
+            provider (str): Provider name as listed in the task configuration.
+            obs_space (str): Observation space name.
+
+        Returns:
+            dict: Keyword arguments, or None if the provider is not supported.
+        """
         output_file = f"{self.task_config['RUN']}.t{self.task_config['cyc']:02d}z.{obs_space}.nc"
 
         # Process GHRSST
@@ -115,8 +242,7 @@ class MarineObsPrep(Task):
                 'window_end': self.task_config.window_end,
                 'task_config': self.task_config
             }
-            result = self.ghrsst.process_obs_space(**kwargs)
-            return result
+            return kwargs
 
         # Process RADS
         if provider == "rads":
@@ -136,8 +262,7 @@ class MarineObsPrep(Task):
                 'window_end': window_end,
                 'task_config': self.task_config
             }
-            result = self.rads.process_obs_space(**kwargs)
-            return result
+            return kwargs
 
         # Process NESDIS_AMSR2
         if provider == "nesdis_amsr2":
@@ -160,8 +285,7 @@ class MarineObsPrep(Task):
                 'window_end': window_end,
                 'task_config': self.task_config
             }
-            result = self.nesdis_amsr2.process_obs_space(**kwargs)
-            return result
+            return kwargs
 
         # Process NESDIS_MIRS
         if provider == "nesdis_mirs":
@@ -181,8 +305,7 @@ class MarineObsPrep(Task):
                 'window_end': self.task_config.window_end,
                 'task_config': self.task_config
             }
-            result = self.nesdis_mirs.process_obs_space(**kwargs)
-            return result
+            return kwargs
 
         # Process NESDIS_JPSSRR
         if provider == "nesdis_jpssrr":
@@ -199,8 +322,7 @@ class MarineObsPrep(Task):
                 'window_end': self.task_config.window_end,
                 'task_config': self.task_config
             }
-            result = self.nesdis_jpssrr.process_obs_space(**kwargs)
-            return result
+            return kwargs
 
         # Process SMAP
         if provider == "smap":
@@ -219,8 +341,7 @@ class MarineObsPrep(Task):
                 'window_end': self.task_config.window_end,
                 'task_config': self.task_config
             }
-            result = self.smap.process_obs_space(**kwargs)
-            return result
+            return kwargs
 
         # Process SMOS SSS
         if provider == "smos":
@@ -239,10 +360,10 @@ class MarineObsPrep(Task):
                 'window_end': self.task_config.window_end,
                 'task_config': self.task_config
             }
-            result = self.smos.process_obs_space(**kwargs)
-            return result
+            return kwargs
         else:
             logger.error(f"Provider {provider} not supported")
+            return None
 
     @logit(logger)
     def finalize(self) -> None:
@@ -283,3 +404,8 @@ class MarineObsPrep(Task):
         # create an empty file to tell external processes the obs are ready
         ready_file = pathlib.Path(join(comout, f"{self.task_config['PREFIX']}obsforge_marine_status.log"))
         ready_file.touch()
+
+        self.scratch.write_report(join(comout, f"{self.task_config['PREFIX']}obsforge_marine_scratch.yaml"))
+
+        # the staged files and conversions of the past cycles are not needed anymore
+        prune_shared_stage(self.task_config)
@@ -6,10 +6,17 @@ from pyobsforge.obsdb.nesdis_mirs_db import NesdisMirsDatabase
 from pyobsforge.obsdb.nesdis_jpssrr_db import NesdisJpssrrDatabase
 from pyobsforge.obsdb.smap_db import SmapDatabase
 from pyobsforge.obsdb.smos_db import SmosDatabase
-from typing import Any
+from typing import Any, Optional, Union
 from dataclasses import dataclass
+from os import remove, replace
+from os.path import basename, exists, join
+from shutil import copy2
 from wxflow import AttrDict
-from pyobsforge.task.run_nc2ioda import run_nc2ioda
+from pyobsforge.obsdb.obsdb import ConversionCatalog
+from pyobsforge.task.run_nc2ioda import run_nc2ioda_chunked, shared_stage_dir
+from pyobsforge.utils.conversion_cache import ConversionCache
+from pyobsforge.utils.ioda import concat_ioda_files
+from pyobsforge.utils.staging import cache_root, tmp_name
 
 logger = getLogger(__name__.split('.')[-1])
 
@@ -49,10 +56,20 @@ class QCConfig:
 
 
 class ProviderConfig:
-    def __init__(self, qc_config: QCConfig, db: Any, ocean_basin: Any = None):  # Replace `Any` with a more specific type if desired
+    def __init__(self, qc_config: QCConfig, db: Any, ocean_basin: Any = None,  # Replace `Any` with a more specific type if desired
+                 incremental: Union[bool, list] = False, chunk_size: int = 0, incremental_dir: Optional[str] = None):
         self.qc_config = qc_config
         self.db = db
         self.ocean_basin = ocean_basin
+        # True for all the obs spaces of the provider, or a list of obs spaces
+        self.incremental = incremental
+        # Number of granules converted per chunk, 0 to convert an obs space at once
+        self.chunk_size = chunk_size
+        # The outputs of the incremental obs spaces and their catalog, kept across the runs of the cycle
+        self.incremental_dir = incremental_dir
+        self.catalog = None
+        if incremental and incremental_dir:
+            self.catalog = ConversionCatalog(join(incremental_dir, "converted_files.db"))
 
     @classmethod
     def from_task_config(cls, provider_name: str, task_config: AttrDict) -> "ProviderConfig":
@@ -86,13 +103,55 @@ class ProviderConfig:
             raise NotImplementedError(f"DB setup for provider {provider_name} not yet implemented")
 
         ocean_basin = getattr(task_config, "ocean_basin", None)
-        return cls(qc_config=qc, db=db, ocean_basin=ocean_basin)
+        incremental = task_config.providers[provider_name].get("incremental", False)
+        chunk_size = task_config.providers[provider_name].get("chunk size", 0)
+        incremental_dir = None
+        if incremental:
+            incremental_root = task_config.get('incremental_dir') or join(cache_root(task_config), 'marine_incremental')
+            incremental_dir = join(incremental_root, f"{task_config.RUN}.{task_config.current_cycle.strftime('%Y%m%d%H')}",
+                                   provider_name)
+        return cls(qc_config=qc, db=db, ocean_basin=ocean_basin, incremental=incremental, chunk_size=chunk_size,
+                   incremental_dir=incremental_dir)
+
+    def is_incremental(self, obs_space: str) -> bool:
+        """
+        Whether an observation space only converts the granules that are not yet in its output.
+        """
+        if self.catalog is None:
+            return False
+        if isinstance(self.incremental, (list, tuple)):
+            return obs_space in self.incremental
+        return bool(self.incremental)
+
+    def kept_output(self, output_file: str) -> str:
+        """
+        Path where the output of an incremental obs space is kept across the runs of the cycle.
+        """
+        return join(self.incremental_dir, basename(output_file))
+
+    def is_chunked(self, context: dict) -> bool:
+        """
+        Whether a staged observation space is converted as several chunks of granules.
+        """
+        return 0 < self.chunk_size < len(context['input_files'])
 
     def process_obs_space(self, **kwargs) -> None:
         """
         Process a single observation space by querying the database for valid files,
         copying them to the appropriate directory, and running the ioda converter.
 
+        Args:
+            **kwargs: Keyword arguments, see stage_obs_space.
+        """
+        context = self.stage_obs_space(**kwargs)
+        if context is not None:
+            self.convert_obs_space(kwargs.get('task_config'), kwargs.get('obs_space'), context)
+
+    def stage_obs_space(self, **kwargs) -> Optional[dict]:
+        """
+        Stage a single observation space by querying the database for valid files and
+        copying them to the appropriate directory.
+
         Args:
             **kwargs: Keyword arguments including:
                 provider: Provider name
@@ -104,6 +163,15 @@ class ProviderConfig:
                 window_begin: Beginning of time window
                 window_end: End of time window
                 task_config: Task configuration
+
+        Returns:
+            dict: Context to render the ioda converter configuration, or None if the
+                  obs space is empty.
+
+        In incremental mode, the granules already cataloged as converted into the output kept
+        by the previous runs of the cycle (see kept_output) are neither staged nor converted.
+        The kept output is copied into DATA and the new granules are converted into an
+        increment that convert_obs_space merges into it, then keeps for the next run.
         """
         # Extract parameters from kwargs
         provider = kwargs.get('provider')
@@ -117,39 +185,95 @@ class ProviderConfig:
         task_config = kwargs.get('task_config')
 
         # Query the database for valid files
-        input_files = self.db.get_valid_files(window_begin=window_begin,
+        src_files = self.db.query_valid_files(window_begin=window_begin,
                                               window_end=window_end,
-                                              dst_dir=obs_space,
                                               instrument=instrument,
                                               satellite=platform,
                                               obs_type=obs_type)
-        logger.info(f"number of valid files: {len(input_files)}")
-
-        # Process the observations if the obs space is not empty
-        if len(input_files) > 0:
-            # Configure the ioda converter
-            context = {'provider': provider.upper(),
-                       'window_begin': window_begin,
-                       'window_end': window_end,
-                       'input_files': input_files,
-                       'output_file': output_file}
-
-            # Add global ocean_basin if present
-            if getattr(self, "ocean_basin", None):
-                context["ocean_basin"] = self.ocean_basin
-
-            # Only add QC config attributes if they exist
-            if hasattr(self.qc_config, 'bounds_min'):
-                context['bounds_min'] = self.qc_config.bounds_min
-            if hasattr(self.qc_config, 'error_ratio'):
-                context['error_ratio'] = self.qc_config.error_ratio
-            if hasattr(self.qc_config, 'bounds_max'):
-                context['bounds_max'] = self.qc_config.bounds_max
-            if hasattr(self.qc_config, 'binning_stride'):
-                context['binning_stride'] = self.qc_config.binning_stride
-            if hasattr(self.qc_config, 'binning_min_number_of_obs'):
-                context['binning_min_number_of_obs'] = self.qc_config.binning_min_number_of_obs
-            result = run_nc2ioda(task_config, obs_space, context)
-            logger.info(f"run_nc2ioda result: {result}")
-        else:
+        logger.info(f"number of valid files: {len(src_files)}")
+
+        # Nothing to convert if the obs space is empty
+        if len(src_files) == 0:
             logger.warning(f"No valid files found for {obs_space} with {instrument} on {platform}")
+            return None
+
+        merge_into = None
+        if self.is_incremental(obs_space):
+            # the granules already in the kept output are neither staged nor converted again
+            kept_output = self.kept_output(output_file)
+            converted = self.catalog.get_converted_files(kept_output) if exists(kept_output) else set()
+            new_files = [f for f in src_files if basename(f) not in converted]
+            if len(converted) > 0:
+                # the output of the previous runs, this run appends the new granules to it
+                copy2(kept_output, join(task_config['DATA'], output_file))
+            if len(new_files) == 0:
+                logger.info(f"No new files for {obs_space} since the last conversion of {output_file}")
+                return None
+            if len(converted) > 0:
+                logger.info(f"Converting {len(new_files)} new files for {obs_space}, "
+                            f"{len(converted)} already in {output_file}")
+                src_files = new_files
+                merge_into = output_file
+                output_file = join(obs_space, f"{obs_space}_increment.nc")
+
+        input_files = self.db.stage_files(src_files, obs_space, shared_dir=shared_stage_dir(task_config, obs_space))
+
+        # Configure the ioda converter
+        context = {'provider': provider.upper(),
+                   'window_begin': window_begin,
+                   'window_end': window_end,
+                   'input_files': input_files,
+                   'output_file': output_file}
+        if merge_into is not None:
+            context['merge_into'] = merge_into
+
+        # Add global ocean_basin if present
+        if getattr(self, "ocean_basin", None):
+            context["ocean_basin"] = self.ocean_basin
+
+        # Only add QC config attributes if they exist
+        if hasattr(self.qc_config, 'bounds_min'):
+            context['bounds_min'] = self.qc_config.bounds_min
+        if hasattr(self.qc_config, 'error_ratio'):
+            context['error_ratio'] = self.qc_config.error_ratio
+        if hasattr(self.qc_config, 'bounds_max'):
+            context['bounds_max'] = self.qc_config.bounds_max
+        if hasattr(self.qc_config, 'binning_stride'):
+            context['binning_stride'] = self.qc_config.binning_stride
+        if hasattr(self.qc_config, 'binning_min_number_of_obs'):
+            context['binning_min_number_of_obs'] = self.qc_config.binning_min_number_of_obs
+        return context
+
+    def convert_obs_space(self, task_config: AttrDict, obs_space: str, context: dict) -> None:
+        """
+        Run the ioda converter on a staged observation space, by chunks of `chunk size`
+        granules converted in parallel if the provider sets it.
+
+        Args:
+            task_config: Task configuration
+            obs_space: Observation space name
+            context: Context returned by stage_obs_space
+        """
+        result = run_nc2ioda_chunked(task_config, obs_space, context, self.chunk_size)
+        logger.info(f"run_nc2ioda result: {result}")
+
+        if self.is_incremental(obs_space) and result == 0:
+            output_path = join(task_config['DATA'], context['output_file'])
+            if 'merge_into' in context:
+                # Append the increment to the output of the previous conversions
+                merged_path = join(task_config['DATA'], context['merge_into'])
+                if exists(output_path):
+                    concat_ioda_files([merged_path, output_path], merged_path)
+                    ConversionCache().invalidate(merged_path)
+                    ConversionCache().invalidate(output_path)
+                    remove(output_path)
+                output_path = merged_path
+            kept_output = self.kept_output(output_path)
+            if 'merge_into' not in context:
+                self.catalog.forget_converted_files(kept_output)
+            if exists(output_path):
+                # Keep the output for the next runs, under a temporary name until complete
+                tmp_output = tmp_name(kept_output)
+                copy2(output_path, tmp_output)
+                replace(tmp_output, kept_output)
+            self.catalog.record_converted_files(kept_output, context['input_files'])
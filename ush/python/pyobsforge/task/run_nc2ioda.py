@@ -1,41 +1,302 @@
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from logging import getLogger
-import subprocess
-from wxflow import save_as_yaml, parse_j2yaml
-from os.path import join
+from wxflow import save_as_yaml
+from os.path import basename, exists, isdir, join, splitext
+from typing import Optional
+from pyobsforge.utils.process import run_streamed
+from pyobsforge.utils.templates import parse_j2yaml_cached
+from pyobsforge.utils.conversion_cache import ConversionCache
+from pyobsforge.utils.ioda import concat_ioda_files
+from pyobsforge.utils.staging import cache_root
 
 logger = getLogger(__name__.split('.')[-1])
 
+# Converters running at once in the process, shared by the obs spaces and their chunks
+_converter_slots = {}
+_converter_slots_lock = threading.Lock()
 
-def run_nc2ioda(task_config: dict, obs_space: str, context: dict) -> int:
+
+def render_nc2ioda_config(task_config: dict, context: dict) -> dict:
+    """
+    Renders the nc2ioda Jinja2 template into the configuration of a single observation space.
+
+    Args:
+        task_config (dict): Configuration dictionary containing paths and settings for the task.
+        context (dict): Context dictionary with variables to render the Jinja2 template.
+
+    Returns:
+        dict: The rendered converter configuration.
+    """
+    jinja_template = join(task_config['HOMEobsforge'], "parm", "nc2ioda", "nc2ioda.yaml.j2")
+    return parse_j2yaml_cached(jinja_template, context)
+
+
+def nc2ioda_executable(task_config: dict) -> str:
+    """
+    Returns the path to the obs provider to ioda converter.
+    """
+    return join(task_config['HOMEobsforge'], 'build', 'bin', 'obsforge_obsprovider2ioda.x')
+
+
+def nc2ioda_cache(task_config: dict) -> Optional[ConversionCache]:
+    """
+    Returns the conversion cache of the task, or None if `nc2ioda_cache` is disabled.
+
+    The cache is `nc2ioda_cache_dir`, else under `shared_stage_dir` so the runs sharing their
+    staging also share their conversions, else under the cache root kept across runs (see
+    cache_root). DATA is new for every job, so the outputs are only reused from there.
+    """
+    if not task_config.get('nc2ioda_cache', True):
+        return None
+    cache_dir = task_config.get('nc2ioda_cache_dir')
+    if cache_dir is None:
+        if task_config.get('shared_stage_dir'):
+            cache_dir = join(task_config['shared_stage_dir'], 'nc2ioda_cache')
+        else:
+            cache_dir = join(cache_root(task_config), 'nc2ioda_cache')
+    return ConversionCache(cache_dir)
+
+
+def shared_stage_dir(task_config: dict, obs_space: str) -> Optional[str]:
+    """
+    Returns the directory where the gdas and gfs runs of the cycle share the staged files
+    of an observation space, or None if `shared_stage_dir` is not set.
+    """
+    if not task_config.get('shared_stage_dir'):
+        return None
+    return join(task_config['shared_stage_dir'], task_config['current_cycle'].strftime('%Y%m%d%H'), obs_space)
+
+
+def prune_shared_stage(task_config: dict) -> None:
+    """
+    Remove what the runs of past cycles left in the directories shared across runs.
+
+    The cycles of `shared_stage_dir` more than `shared_stage_max_age` hours (default 48)
+    before the current cycle are removed, and the outputs of the nc2ioda cache not stored
+    or reused for `nc2ioda_cache_max_age` hours (default 72).
+    """
+    cache = nc2ioda_cache(task_config)
+    if cache:
+        cache.prune(task_config.get('nc2ioda_cache_max_age', 72))
+    if not task_config.get('shared_stage_dir') or not isdir(task_config['shared_stage_dir']):
+        return
+    oldest = task_config['current_cycle'] - timedelta(hours=task_config.get('shared_stage_max_age', 48))
+    nremoved = 0
+    for name in sorted(os.listdir(task_config['shared_stage_dir'])):
+        try:
+            cycle = datetime.strptime(name, '%Y%m%d%H')
+        except ValueError:
+            continue  # e.g. nc2ioda_cache
+        if cycle < oldest:
+            shutil.rmtree(join(task_config['shared_stage_dir'], name), ignore_errors=True)
+            nremoved += 1
+    if nremoved > 0:
+        logger.info(f"Removed {nremoved} cycles older than {oldest:%Y%m%d%H} from {task_config['shared_stage_dir']}")
+
+
+def _conversion_key(task_config: dict, yaml_config: dict) -> str:
+    return ConversionCache.compute_key(yaml_config, yaml_config['input files'],
+                                       nc2ioda_executable(task_config), base_dir=task_config['DATA'])
+
+
+def run_nc2ioda(task_config: dict, obs_space: str, context: dict, name: Optional[str] = None) -> int:
     """
     Executes the nc2ioda conversion process using a Jinja2 template and a YAML configuration.
 
+    The converter output is streamed to `<obs_space>/<name>_nc2ioda.log` and to the task
+    logger. The converter is killed after `nc2ioda_timeout` seconds if set in the task
+    configuration, and the last `nc2ioda_stderr_lines` lines of its standard error are
+    reported on failure. The conversion is skipped if the same configuration, inputs and
+    converter already produced the output (see ConversionCache).
+
     Args:
         task_config (dict): Configuration dictionary containing paths and settings for the task.
         obs_space (str): Observation space identifier used to generate file paths.
         context (dict): Context dictionary with variables to render the Jinja2 template.
+        name (str): (Optional) Name of the configuration and log files, defaults to obs_space.
 
     Returns:
-        int: Returns 0 upon successful execution. Logs errors and warnings for failures.
+        int: Return code of the converter. Logs errors for failures.
     """
-    jinja_template = join(task_config['HOMEobsforge'], "parm", "nc2ioda", "nc2ioda.yaml.j2")
-    yaml_config = parse_j2yaml(jinja_template, context)
-    nc2ioda_yaml = join(task_config['DATA'], obs_space, f"{obs_space}_nc2ioda.yaml")
+    name = name or obs_space
+    yaml_config = render_nc2ioda_config(task_config, context)
+    output_file = join(task_config['DATA'], yaml_config['output file'])
+    cache = nc2ioda_cache(task_config)
+    if cache:
+        key = _conversion_key(task_config, yaml_config)
+        if cache.fetch(key, output_file):
+            return 0
+        cache.invalidate(output_file)
+
+    nc2ioda_yaml = join(task_config['DATA'], obs_space, f"{name}_nc2ioda.yaml")
     save_as_yaml(yaml_config, nc2ioda_yaml)
 
     # Run the ioda converter
-    nc2ioda_exe = join(task_config['HOMEobsforge'], 'build', 'bin', 'obsforge_obsprovider2ioda.x')
-    try:
-        result = subprocess.run([nc2ioda_exe, nc2ioda_yaml],
-                                cwd=task_config['DATA'],
-                                capture_output=True,
-                                text=True)
-        logger.info(f"Standard Output: \n{result.stdout}")
-        # TODO (G): Figure out what to do with failures.
-        #           Ignore failures for now and just issue a warning
-        if result.returncode != 0:
-            logger.error(f"Standard Error: \n{result.stderr}")
+    # TODO (G): Figure out what to do with failures.
+    #           Ignore failures for now and just report them
+    log_file = join(task_config['DATA'], obs_space, f"{name}_nc2ioda.log")
+    returncode = _run_converter(task_config, nc2ioda_yaml, log_file, prefix=f"[{name}] ")
+    if cache and returncode == 0:
+        cache.store(key, output_file)
+    return returncode
+
+
+def run_nc2ioda_chunked(task_config: dict, obs_space: str, context: dict, chunk_size: int,
+                        name: Optional[str] = None) -> int:
+    """
+    Executes the nc2ioda conversion of a large observation space as chunks of granules
+    converted in parallel, then merged into the output of the obs space.
+
+    Each chunk is converted with run_nc2ioda into `<obs_space>/<output>.chunkNNN.nc`, so
+    the chunks are cached independently and a rerun only converts the chunks whose granules
+    changed. Up to `nc2ioda_chunk_workers` chunks are converted at once, within the limit of
+    converters of the whole task (see converter_slots). The chunk outputs
+    are concatenated in order with concat_ioda_files, which renumbers the locations.
+    Binning and thinning are applied within each chunk.
+
+    Args:
+        task_config (dict): Configuration dictionary containing paths and settings for the task.
+        obs_space (str): Observation space identifier used to generate file paths.
+        context (dict): Context dictionary with variables to render the Jinja2 template.
+        chunk_size (int): Number of input files per chunk, the obs space is converted
+                          at once if it is not larger than a chunk.
+        name (str): (Optional) Name of the configuration and log files when converted at once,
+                    defaults to obs_space.
+
+    Returns:
+        int: Return code of the first failed chunk, or 0. Logs errors for failures.
+    """
+    input_files = context['input_files']
+    if chunk_size <= 0 or len(input_files) <= chunk_size:
+        return run_nc2ioda(task_config, obs_space, context, name=name)
+
+    chunk_contexts = []
+    output_name = splitext(basename(context['output_file']))[0]
+    for start in range(0, len(input_files), chunk_size):
+        chunk_name = f"{output_name}.chunk{start // chunk_size:03d}"
+        chunk_contexts.append((chunk_name, dict(context,
+                                                input_files=input_files[start:start + chunk_size],
+                                                output_file=join(obs_space, f"{chunk_name}.nc"))))
+    logger.info(f"Converting {len(input_files)} files of {obs_space} as {len(chunk_contexts)} chunks")
+
+    num_workers = max(1, min(task_config.get('nc2ioda_chunk_workers', 4), len(chunk_contexts)))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        returncodes = list(executor.map(lambda item: run_nc2ioda(task_config, obs_space, item[1], name=item[0]),
+                                        chunk_contexts))
+    failed = [returncode for returncode in returncodes if returncode != 0]
+    if failed:
+        logger.error(f"{len(failed)} of {len(chunk_contexts)} chunks of {obs_space} failed, not merging")
+        return failed[0]
+
+    # Chunks without observations may not have written an output
+    chunk_files = [join(task_config['DATA'], chunk_context['output_file']) for _, chunk_context in chunk_contexts]
+    chunk_files = [chunk_file for chunk_file in chunk_files if exists(chunk_file)]
+    if chunk_files:
+        output_file = join(task_config['DATA'], context['output_file'])
+        ConversionCache().invalidate(output_file)
+        concat_ioda_files(chunk_files, output_file)
+    return 0
+
+
+def run_nc2ioda_batch(task_config: dict, batch_name: str, contexts: dict) -> int:
+    """
+    Executes the nc2ioda conversion of several observation spaces with a single launch of the
+    converter, so the process startup is paid once per batch instead of once per obs space.
+
+    The configurations of the obs spaces are rendered from the same Jinja2 template as in
+    run_nc2ioda and gathered under the "obs spaces" key of a single YAML configuration.
+    The converter goes on with the next obs spaces when one fails and removes its output,
+    so on failure the obs spaces without an output are converted again one at a time with
+    run_nc2ioda, which reports them individually. If the converter was killed, none of the
+    outputs can be trusted and all the obs spaces are converted again.
+
+    Args:
+        task_config (dict): Configuration dictionary containing paths and settings for the task.
+        batch_name (str): Identifier of the batch used to generate the configuration file name.
+        contexts (dict): Context dictionary to render the Jinja2 template, keyed by obs space.
+
+    Returns:
+        int: Return code of the converter, or of the first failed obs space converted again.
+             Logs errors for failures.
+    """
+    cache = nc2ioda_cache(task_config)
+    obs_space_configs = {}
+    keys = {}
+    for obs_space, context in contexts.items():
+        obs_space_config = render_nc2ioda_config(task_config, context)
+        output_file = join(task_config['DATA'], obs_space_config['output file'])
+        if cache:
+            keys[output_file] = _conversion_key(task_config, obs_space_config)
+            if cache.fetch(keys[output_file], output_file):
+                continue
+            cache.invalidate(output_file)
+        obs_space_configs[obs_space] = obs_space_config
+    if not obs_space_configs:
         return 0
-    except subprocess.CalledProcessError as e:
-        logger.warning(f"ioda converter failed with error {e}, \
-            return code {e.returncode}")
+
+    # The outputs left by a previous run would pass for converted obs spaces
+    for obs_space_config in obs_space_configs.values():
+        output_file = join(task_config['DATA'], obs_space_config['output file'])
+        if exists(output_file):
+            os.remove(output_file)
+
+    yaml_config = {'obs spaces': list(obs_space_configs.values())}
+    nc2ioda_yaml = join(task_config['DATA'], f"{batch_name}_nc2ioda.yaml")
+    save_as_yaml(yaml_config, nc2ioda_yaml)
+    logger.info(f"Converting {list(obs_space_configs.keys())} with {nc2ioda_yaml}")
+
+    # Run the ioda converter once for the whole batch
+    log_file = join(task_config['DATA'], f"{batch_name}_nc2ioda.log")
+    returncode = _run_converter(task_config, nc2ioda_yaml, log_file, prefix=f"[{batch_name}] ")
+    failed = []
+    for obs_space, obs_space_config in obs_space_configs.items():
+        output_file = join(task_config['DATA'], obs_space_config['output file'])
+        if returncode == 0 or (returncode > 0 and exists(output_file)):
+            if cache:
+                cache.store(keys[output_file], output_file)
+        else:
+            failed.append(obs_space)
+    if not failed:
+        return returncode
+
+    logger.warning(f"Converting {failed} of {batch_name} again one at a time")
+    returncodes = [run_nc2ioda(task_config, obs_space, contexts[obs_space]) for obs_space in failed]
+    return next((returncode for returncode in returncodes if returncode != 0), 0)
+
+
+def converter_slots(task_config: dict) -> threading.BoundedSemaphore:
+    """
+    Returns the semaphore limiting the converters running at once in the process.
+
+    The obs spaces converted in parallel by the task and the chunks converted in parallel
+    within each of them all take a slot, so no more than `nc2ioda_max_converters` (default 8)
+    converters run at once whatever the number of workers at each level.
+    """
+    max_converters = max(1, int(task_config.get('nc2ioda_max_converters', 8)))
+    with _converter_slots_lock:
+        if max_converters not in _converter_slots:
+            _converter_slots[max_converters] = threading.BoundedSemaphore(max_converters)
+        return _converter_slots[max_converters]
+
+
+def _run_converter(task_config: dict, nc2ioda_yaml: str, log_file: str, prefix: str) -> int:
+    """
+    Runs the converter on a rendered configuration, streaming its output to `log_file`.
+    """
+    with converter_slots(task_config):
+        returncode, stderr_tail = run_streamed([nc2ioda_executable(task_config), nc2ioda_yaml],
+                                               log_file,
+                                               cwd=task_config['DATA'],
+                                               timeout=task_config.get('nc2ioda_timeout'),
+                                               tail_lines=task_config.get('nc2ioda_stderr_lines', 50),
+                                               prefix=prefix,
+                                               task_logger=logger)
+    if returncode != 0:
+        stderr = "\n".join(stderr_tail)
+        logger.error(f"{prefix}ioda converter failed with return code {returncode}, see {log_file}")
+        logger.error(f"{prefix}Standard Error (last {len(stderr_tail)} lines): \n{stderr}")
+    return returncode
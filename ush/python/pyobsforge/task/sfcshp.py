@@ -1,8 +1,9 @@
+import mmap
 import os
 import subprocess
 import logging
 from functools import wraps
-from wxflow import parse_j2yaml
+from pyobsforge.utils.templates import parse_j2yaml_cached
 
 logger = logging.getLogger(__name__.split('.')[-1])
 
@@ -24,6 +25,57 @@ def logit(logger):
     return decorator
 
 
+# Data category of the messages holding the BUFR tables (DX tables) of NCEP files
+TABLE_CATEGORY = 11
+
+
+def iter_bufr_messages(data):
+    """
+    Iterate over the BUFR messages of a buffer.
+
+    Bytes between messages are skipped. A message is delimited by its "BUFR" start, its
+    length from Section 0 and its "7777" end.
+
+    Args:
+        data: Buffer holding the BUFR file (bytes or mmap).
+
+    Yields:
+        bytes: One BUFR message.
+    """
+    pos = data.find(b"BUFR")
+    while pos != -1:
+        if pos + 8 > len(data):
+            raise ValueError(f"Truncated BUFR message at byte {pos}")
+        length = int.from_bytes(data[pos + 4:pos + 7], "big")
+        end = pos + length
+        if length < 8 or end > len(data) or data[end - 4:end] != b"7777":
+            raise ValueError(f"Invalid BUFR message of length {length} at byte {pos}")
+        yield data[pos:end]
+        pos = data.find(b"BUFR", end)
+
+
+def message_subset(message):
+    """
+    Return the category, local subcategory and NCEP subset name of a BUFR message.
+
+    The category and local subcategory are read from Section 1, whose layout depends on
+    the BUFR edition. NCEP names a subset NC<category><local subcategory>.
+
+    Args:
+        message: One BUFR message.
+
+    Returns:
+        tuple: (category, subcategory, subset name)
+    """
+    edition = message[7]
+    section1 = message[8:]
+    if edition >= 4:
+        category, subcategory = section1[10], section1[12]
+    else:
+        category, subcategory = section1[8], section1[9]
+    return category, subcategory, f"NC{category:03d}{subcategory:03d}"
+
+
 class BufrFile:
     def __init__(self, bufr_file=None, work_dir=None, cycle=None):
         self.isready = False
@@ -76,6 +128,49 @@ class BufrFile:
 
         return self.split_files
 
+    @logit(logger)
+    def split_to(self, targets):
+        """
+        Split the BUFR file by subset, reading it once and writing only the requested subsets.
+
+        The messages of a requested subset are written to its target file, preceded by the
+        table messages found before them, so each file can be decoded on its own.
+
+        Args:
+            targets (dict): Output file, keyed by subset name (e.g. NC001102).
+
+        Returns:
+            dict: Number of data messages written, keyed by subset name.
+        """
+        outputs = {}
+        nmessages = {}
+        tables = []
+        try:
+            with open(self.bufr_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for message in iter_bufr_messages(data):
+                    category, _, subset = message_subset(message)
+                    if category == TABLE_CATEGORY:
+                        tables.append(message)
+                        for output in outputs.values():
+                            output.write(message)
+                        continue
+                    if subset not in targets:
+                        continue
+                    if subset not in outputs:
+                        outputs[subset] = open(targets[subset], "wb")
+                        for table in tables:
+                            outputs[subset].write(table)
+                        nmessages[subset] = 0
+                    outputs[subset].write(message)
+                    nmessages[subset] += 1
+        finally:
+            for output in outputs.values():
+                output.close()
+
+        for subset, count in nmessages.items():
+            logger.info(f"Wrote {count} messages of {subset} to {targets[subset]}")
+        return nmessages
+
     @logit(logger)
     def rename(self, b2i_template, sfcshp_cycle_dict):
         """
@@ -98,7 +193,7 @@ class BufrFile:
             # construct the new filename
             ob_cycle_dict = sfcshp_cycle_dict
             ob_cycle_dict['dump_tag'] = obs_type
-            ob_cycle_config = parse_j2yaml(b2i_template, ob_cycle_dict)
+            ob_cycle_config = parse_j2yaml_cached(b2i_template, ob_cycle_dict)
             ob_filename = ob_cycle_config.local_dump_filename
 
             try:
@@ -130,6 +225,43 @@ class BufrFile:
 
         return name in self.subset_mapping.values()
 
+    @logit(logger)
+    def split_for(self, b2i_template, sfcshp_cycle_dict, dump_tags):
+        """
+        Split the BUFR file into the subsets of the given dump tags, written directly
+        under their final names from the j2 template.
+
+        Falls back to split and rename if the file cannot be split natively.
+
+        Args:
+            b2i_template (str): bufr2ioda j2 template giving the local dump file names.
+            sfcshp_cycle_dict (dict): Context of the template for the cycle.
+            dump_tags (iterable): Dump tags of the providers (e.g. "dbuoyb").
+
+        Returns:
+            dict: Final file name, keyed by subset name.
+        """
+        if not hasattr(self, 'subset_mapping'):
+            raise NotImplementedError("Subclass must define subset_mapping dict")
+
+        targets = {}
+        for subset, obs_type in self.subset_mapping.items():
+            if obs_type in dump_tags:
+                ob_cycle_dict = dict(sfcshp_cycle_dict, dump_tag=obs_type)
+                targets[subset] = parse_j2yaml_cached(b2i_template, ob_cycle_dict).local_dump_filename
+
+        try:
+            nmessages = self.split_to(targets)
+        except ValueError as e:
+            logger.warning(f"Native split of {self.bufr_file} failed ({e}), using split_by_subset")
+            self.split()
+            return self.rename(b2i_template, sfcshp_cycle_dict)
+
+        self.renamed_files = {subset: targets[subset] for subset in nmessages}
+        if not self.renamed_files:
+            logger.warning(f"No subsets of {sorted(dump_tags)} found in {self.bufr_file}")
+        return self.renamed_files
+
 
 class SfcShp(BufrFile):
     subset_mapping = {
@@ -175,3 +175,32 @@ def test_get_valid_files_receipt(db):
 
     # TODO (G): Giving up for now on trying to mock the receipt time, will revisit later
     assert len(valid_files) == 2
+
+
+def test_get_valid_files_shared_dir(db, temp_obs_dir):
+    db.ingest_files()
+    da_cycle = "20250316120000"
+    window_begin = datetime.strptime(da_cycle, "%Y%m%d%H%M%S") - timedelta(hours=3)
+    window_end = datetime.strptime(da_cycle, "%Y%m%d%H%M%S") + timedelta(hours=1)
+    shared_dir = os.path.join(temp_obs_dir, "shared", "sst")
+
+    # Two runs of the same cycle stage from the shared directory
+    staged = []
+    for run in ['gdas', 'gfs']:
+        dst_dir = os.path.join(temp_obs_dir, run, "sst")
+        valid_files = db.get_valid_files(window_begin=window_begin,
+                                         window_end=window_end,
+                                         dst_dir=dst_dir,
+                                         instrument="VIIRS",
+                                         satellite="NPP",
+                                         obs_type="SSTsubskin",
+                                         shared_dir=shared_dir)
+        assert len(valid_files) == 2
+        assert all(os.path.islink(f) for f in valid_files)
+        staged.append({os.path.basename(f): os.stat(f).st_ino for f in valid_files})
+
+    # Both runs see the same copies
+    assert staged[0] == staged[1]
+    assert sorted(os.listdir(shared_dir)) == sorted(staged[0])
+    with open(os.path.join(shared_dir, sorted(staged[0])[0])) as f:
+        assert f.read() == "fake content"
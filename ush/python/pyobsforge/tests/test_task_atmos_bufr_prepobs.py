@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+
+from wxflow import AttrDict
+
+from pyobsforge.task.atmos_bufr_prepobs import AtmosBufrObsPrep
+
+# An mpi launcher ignoring SIGTERM, whose ranks hold its output pipes
+LAUNCHER = """
+import signal, subprocess, sys, time
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+ranks = [subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)']) for _ in range(2)]
+with open(sys.argv[1], 'w') as f:
+    f.write(' '.join(str(rank.pid) for rank in ranks))
+print('launched', flush=True)
+time.sleep(60)
+"""
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def test_convert_observation_timeout(tmp_path):
+    task = AtmosBufrObsPrep.__new__(AtmosBufrObsPrep)
+    task.task_config = AttrDict(DATA=str(tmp_path), script2netcdf_timeout=2, script2netcdf_kill_grace=1)
+    pid_file = os.path.join(tmp_path, "ranks.pid")
+
+    start = time.monotonic()
+    returncode = task.convert_observation("atms", [sys.executable, "-c", LAUNCHER, pid_file])
+    assert returncode == -9
+    # the scheduler thread is released right after the timeout and the grace period
+    assert time.monotonic() - start < 10
+    with open(pid_file) as f:
+        ranks = [int(pid) for pid in f.read().split()]
+    # SIGKILL is delivered asynchronously
+    deadline = time.monotonic() + 5
+    while any(is_running(pid) for pid in ranks) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert not any(is_running(pid) for pid in ranks)
+    with open(os.path.join(tmp_path, "atms.log")) as f:
+        assert f.read().splitlines() == ["launched"]
@@ -0,0 +1,80 @@
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+netCDF4 = pytest.importorskip("netCDF4")
+
+import pyobsforge.task.providers as providers  # noqa: E402
+from pyobsforge.task.providers import ProviderConfig, QCConfig  # noqa: E402
+from pyobsforge.utils.ioda import count_locations  # noqa: E402
+
+
+class FakeDatabase:
+    """Database returning all its granules, recording the ones staged"""
+    def __init__(self, files):
+        self.files = files
+        self.staged = []
+
+    def query_valid_files(self, window_begin, window_end, **filters):
+        return list(self.files)
+
+    def stage_files(self, src_files, dst_dir, shared_dir=None):
+        os.makedirs(dst_dir, exist_ok=True)
+        for src_file in src_files:
+            shutil.copy2(src_file, dst_dir)
+        self.staged.append([os.path.basename(src_file) for src_file in src_files])
+        return [os.path.join(dst_dir, os.path.basename(src_file)) for src_file in src_files]
+
+
+def fake_nc2ioda(task_config, obs_space, context, chunk_size):
+    """One location per granule"""
+    nlocs = len(context['input_files'])
+    with netCDF4.Dataset(os.path.join(task_config['DATA'], context['output_file']), 'w') as ds:
+        ds.createDimension('Location', nlocs)
+        ds.createVariable('Location', 'i4', ('Location',))[:] = np.arange(nlocs)
+        ds.setncattr_string('obs_source_files', [os.path.basename(f) for f in context['input_files']])
+        ds.createGroup('MetaData').createVariable('latitude', 'f4', ('Location',))[:] = np.arange(nlocs)
+    return 0
+
+
+def test_incremental_across_runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(providers, "run_nc2ioda_chunked", fake_nc2ioda)
+    dcom = os.path.join(tmp_path, "dcom")
+    os.makedirs(dcom)
+    granules = []
+    for i in range(3):
+        granules.append(os.path.join(dcom, f"granule{i}.nc"))
+        with open(granules[-1], "w") as f:
+            f.write(str(i))
+
+    kept_dir = os.path.join(tmp_path, "kept")
+    output_file = "gdas.t00z.sst_viirs_n21_l3u.nc"
+
+    def run(job, ngranules):
+        # every job starts in a new DATA, as set up by the j-job
+        data = os.path.join(tmp_path, job)
+        os.makedirs(data)
+        monkeypatch.chdir(data)
+        db = FakeDatabase(granules[:ngranules])
+        provider = ProviderConfig(QCConfig.from_dict({}), db, incremental=True, incremental_dir=kept_dir)
+        task_config = {'DATA': data, 'current_cycle': datetime(2025, 10, 1)}
+        context = provider.stage_obs_space(provider="ghrsst", obs_space="sst_viirs_n21_l3u", output_file=output_file,
+                                           window_begin=None, window_end=None, task_config=task_config)
+        if context is not None:
+            provider.convert_obs_space(task_config, "sst_viirs_n21_l3u", context)
+        return db, os.path.join(data, output_file)
+
+    db, output = run("job1", 2)
+    assert db.staged == [["granule0.nc", "granule1.nc"]] and count_locations(output) == 2
+
+    # only the new granule is staged and converted, then appended to the kept output
+    db, output = run("job2", 3)
+    assert db.staged == [["granule2.nc"]] and count_locations(output) == 3
+    assert count_locations(os.path.join(kept_dir, output_file)) == 3
+
+    # nothing new, the kept output is still delivered
+    db, output = run("job3", 3)
+    assert db.staged == [] and count_locations(output) == 3
@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from pyobsforge.task import run_nc2ioda
+from pyobsforge.task.run_nc2ioda import prune_shared_stage
+
+
+def test_prune_shared_stage(tmp_path):
+    shared_dir = os.path.join(tmp_path, "shared_stage")
+    for cycle in ("2025100100", "2025100206", "2025100218", "2025100300"):
+        os.makedirs(os.path.join(shared_dir, cycle, "sst_viirs_n20_l3u"))
+    old_output = os.path.join(shared_dir, "nc2ioda_cache", "ab", "abcdef.nc")
+    new_output = os.path.join(shared_dir, "nc2ioda_cache", "cd", "cdef01.nc")
+    for path in (old_output, new_output):
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("ioda")
+    os.utime(old_output, (0, 0))
+
+    task_config = {'shared_stage_dir': shared_dir, 'current_cycle': datetime(2025, 10, 3, 0),
+                   'shared_stage_max_age': 24}
+    prune_shared_stage(task_config)
+    assert sorted(os.listdir(shared_dir)) == ["2025100206", "2025100218", "2025100300", "nc2ioda_cache"]
+    assert not os.path.exists(old_output)
+    assert os.path.exists(new_output)
+
+    # nothing shared
+    prune_shared_stage({'current_cycle': datetime(2025, 10, 3, 0), 'nc2ioda_cache': False})
+
+
+def test_converter_slots(tmp_path, monkeypatch):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def fake_run_streamed(cmd, log_file, **kwargs):
+        with lock:
+            running.append(cmd[1])
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(cmd[1])
+        return 0, []
+
+    monkeypatch.setattr(run_nc2ioda, 'run_streamed', fake_run_streamed)
+    task_config = {'HOMEobsforge': str(tmp_path), 'DATA': str(tmp_path), 'nc2ioda_max_converters': 3}
+
+    # obs spaces converted in parallel, each by chunks in parallel
+    def convert_obs_space(obs_space):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            return list(executor.map(lambda chunk: run_nc2ioda._run_converter(task_config, f"{obs_space}.{chunk}.yaml",
+                                                                              "log", prefix=""), range(4)))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        returncodes = sum(executor.map(convert_obs_space, range(4)), [])
+    assert returncodes == [0] * 16
+    assert max(peak) == 3
+
+
+def test_run_nc2ioda_batch_failure(tmp_path, monkeypatch):
+    def fake_render(task_config, context):
+        return {'provider': 'GHRSST', 'input files': [], 'output file': context['output_file']}
+
+    def fake_run_converter(task_config, nc2ioda_yaml, log_file, prefix):
+        # the second obs space fails, the converter goes on with the third one
+        for output_file in ("sst_a.nc", "sst_c.nc"):
+            with open(os.path.join(tmp_path, output_file), "w") as f:
+                f.write("ioda")
+        return 1
+
+    reconverted = []
+    monkeypatch.setattr(run_nc2ioda, 'render_nc2ioda_config', fake_render)
+    monkeypatch.setattr(run_nc2ioda, '_run_converter', fake_run_converter)
+    monkeypatch.setattr(run_nc2ioda, 'run_nc2ioda', lambda task_config, obs_space, context: reconverted.append(obs_space) or 0)
+    task_config = {'DATA': str(tmp_path), 'nc2ioda_cache': False}
+    contexts = {name: {'output_file': f"{name}.nc"} for name in ("sst_a", "sst_b", "sst_c")}
+
+    # an output left by a previous run does not pass for a converted obs space
+    with open(os.path.join(tmp_path, "sst_b.nc"), "w") as f:
+        f.write("stale")
+    assert run_nc2ioda.run_nc2ioda_batch(task_config, "batch", contexts) == 0
+    assert reconverted == ["sst_b"]
+
+    # a killed converter leaves no trusted output
+    reconverted.clear()
+    monkeypatch.setattr(run_nc2ioda, '_run_converter', lambda *args, **kwargs: -9)
+    assert run_nc2ioda.run_nc2ioda_batch(task_config, "batch", contexts) == 0
+    assert reconverted == ["sst_a", "sst_b", "sst_c"]
@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+from pyobsforge.task.sfcshp import SfcShp, iter_bufr_messages, message_subset
+
+
+def bufr_message(category, subcategory, payload=b"", edition=4):
+    # Section 1 only carries what the splitter reads, the other sections are a payload
+    if edition >= 4:
+        section1 = bytes([0, 0, 22, 0, 0, 7, 0, 0, 0, 0, category, 0, subcategory]) + bytes(9)
+    else:
+        section1 = bytes([0, 0, 18, 0, 0, 7, 0, 0, category, subcategory]) + bytes(8)
+    body = section1 + payload + b"7777"
+    return b"BUFR" + (8 + len(body)).to_bytes(3, "big") + bytes([edition]) + body
+
+
+def test_message_subset():
+    for edition in (3, 4):
+        message = bufr_message(1, 102, edition=edition)
+        assert message_subset(message) == (1, 102, "NC001102")
+
+
+def test_iter_bufr_messages():
+    messages = [bufr_message(11, 1), bufr_message(1, 2, b"BUFR inside"), bufr_message(1, 102, edition=3)]
+    data = b"pad" + messages[0] + messages[1] + b"\0\0" + messages[2]
+    assert [bytes(m) for m in iter_bufr_messages(data)] == messages
+
+    with pytest.raises(ValueError):
+        list(iter_bufr_messages(messages[0][:-1]))
+
+
+def test_split_for(tmp_path):
+    table = bufr_message(11, 1, b"table")
+    dbuoyb = [bufr_message(1, 102, b"dbuoyb 1"), bufr_message(1, 102, b"dbuoyb 2")]
+    ships = bufr_message(1, 1, b"ships")
+    sfcshp_file = os.path.join(tmp_path, "gdas.t00z.sfcshp.tm00.bufr_d")
+    with open(sfcshp_file, "wb") as f:
+        f.write(table + dbuoyb[0] + ships + dbuoyb[1])
+
+    template = os.path.join(tmp_path, "bufr2ioda.yaml.j2")
+    with open(template, "w") as f:
+        f.write("local_dump_filename: '{{ DATA }}/{{ RUN }}.t{{ cyc }}z.{{ dump_tag }}.tm00.bufr_d'\n")
+
+    sfcshp = SfcShp(sfcshp_file, cycle="00")
+    cycle_dict = {'DATA': str(tmp_path), 'RUN': "gdas", 'cyc': "00", 'dump_tag': "sfcshp"}
+    renamed = sfcshp.split_for(template, cycle_dict, {"dbuoyb", "mbuoyb"})
+
+    dbuoyb_file = os.path.join(tmp_path, "gdas.t00z.dbuoyb.tm00.bufr_d")
+    assert renamed == {"NC001102": dbuoyb_file}
+    assert cycle_dict['dump_tag'] == "sfcshp"
+    with open(dbuoyb_file, "rb") as f:
+        assert f.read() == table + dbuoyb[0] + dbuoyb[1]
+    assert not os.path.exists(os.path.join(tmp_path, "gdas.t00z.ships.tm00.bufr_d"))
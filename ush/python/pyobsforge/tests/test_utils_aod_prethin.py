@@ -0,0 +1,78 @@
+import os
+import time
+
+import netCDF4
+import numpy as np
+
+from pyobsforge.utils.aod_prethin import AOD_MISSING, VARIABLES, kept_indices, prethin_granule, valid_pixels
+from pyobsforge.utils.conversion_cache import ConversionCache
+
+
+def write_granule(path, aod550, qcall):
+    rows, columns = aod550.shape
+    with netCDF4.Dataset(path, 'w') as dataset:
+        dataset.setncattr('time_coverage_end', '2025-10-01T00:01:24Z')
+        dataset.createDimension('Rows', rows)
+        dataset.createDimension('Columns', columns)
+        lat, lon = np.meshgrid(np.linspace(-10, 10, rows), np.linspace(170, 190, columns), indexing='ij')
+        values = {'Latitude': lat, 'Longitude': (lon + 180) % 360 - 180, 'AOD550': aod550,
+                  'QCAll': qcall, 'QCPath': np.ones_like(qcall)}
+        for name in VARIABLES:
+            dtype = 'i1' if name.startswith('QC') else 'f4'
+            dataset.createVariable(name, dtype, ('Rows', 'Columns'))[:] = values[name]
+        # not read by the converter
+        dataset.createVariable('AOD_channel', 'f4', ('Rows', 'Columns'))[:] = aod550
+
+
+def binned(path, preqc, stride):
+    """Simple-average superobs of the converter, as (lat, lon, aod) of the bins with obs"""
+    with netCDF4.Dataset(path) as dataset:
+        data = {name: dataset.variables[name][:] for name in VARIABLES}
+    mask = valid_pixels(data['AOD550'], data['QCAll'], preqc)
+    superobs = []
+    for i in range(0, mask.shape[0], stride):
+        for j in range(0, mask.shape[1], stride):
+            block = mask[i:i + stride, j:j + stride]
+            if block.any():
+                superobs.append(tuple(data[name][i:i + stride, j:j + stride][block].mean()
+                                      for name in ('Latitude', 'Longitude', 'AOD550')))
+    return superobs
+
+
+def test_kept_indices():
+    valid = np.array([0, 0, 0, 1, 0, 0, 0, 0, 0, 1], dtype=bool)
+    assert kept_indices(valid).tolist() == [3, 9]
+    assert kept_indices(valid, stride=4).tolist() == [0, 1, 2, 3, 8, 9]
+
+
+def test_prethin_granule(tmp_path):
+    rng = np.random.default_rng(0)
+    aod550 = rng.uniform(0, 1, (70, 90)).astype(np.float32)
+    qcall = rng.integers(0, 4, (70, 90)).astype(np.int8)
+    # cloudy rows and columns
+    aod550[20:45, :] = AOD_MISSING
+    aod550[:, 60:] = AOD_MISSING
+    src_file = os.path.join(tmp_path, "granule.nc")
+    write_granule(src_file, aod550, qcall)
+
+    for stride in (1, 11):
+        dst_file = os.path.join(tmp_path, f"prethin_{stride}.nc")
+        nvalid = prethin_granule(src_file, dst_file, preqc=1, stride=stride)
+        assert nvalid == np.count_nonzero(valid_pixels(aod550, qcall, 1))
+        with netCDF4.Dataset(dst_file) as dataset:
+            assert set(dataset.variables) == set(VARIABLES)
+            assert dataset.getncattr('time_coverage_end') == '2025-10-01T00:01:24Z'
+            assert dataset.dimensions['Rows'].size < 70 and dataset.dimensions['Columns'].size < 90
+        assert binned(dst_file, 1, stride) == binned(src_file, 1, stride)
+
+        # prethinned again by the next run, the conversion key does not change
+        key = ConversionCache.compute_key({}, [dst_file], "converter.x")
+        time.sleep(0.01)
+        prethin_granule(src_file, dst_file, preqc=1, stride=stride)
+        assert os.stat(dst_file).st_mtime_ns == os.stat(src_file).st_mtime_ns
+        assert ConversionCache.compute_key({}, [dst_file], "converter.x") == key
+
+    # no valid pixel, no copy
+    write_granule(src_file, aod550, np.full_like(qcall, 3))
+    assert prethin_granule(src_file, os.path.join(tmp_path, "night.nc"), preqc=1) == 0
+    assert not os.path.exists(os.path.join(tmp_path, "night.nc"))
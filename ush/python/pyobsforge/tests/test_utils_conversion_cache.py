@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from pyobsforge.utils.conversion_cache import ConversionCache
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    input_files = []
+    for name in ["a.nc", "b.nc"]:
+        path = os.path.join(tmp_path, name)
+        with open(path, "w") as f:
+            f.write(name)
+        input_files.append(path)
+    return input_files
+
+
+def test_compute_key(inputs):
+    config = {'provider': 'GHRSST', 'input files': inputs, 'output file': 'gdas.t00z.sst.nc'}
+    key = ConversionCache.compute_key(config, inputs, "converter.x")
+
+    # The output name does not matter, the inputs and the configuration do
+    assert key == ConversionCache.compute_key(dict(config, **{'output file': 'gfs.t00z.sst.nc'}),
+                                              inputs, "converter.x")
+    assert key != ConversionCache.compute_key(dict(config, provider='RADS'), inputs, "converter.x")
+    os.utime(inputs[0], ns=(0, 0))
+    assert key != ConversionCache.compute_key(config, inputs, "converter.x")
+
+
+def test_fetch_in_place(tmp_path):
+    output_file = os.path.join(tmp_path, "out.nc")
+    cache = ConversionCache()
+    assert not cache.fetch("abc", output_file)
+
+    with open(output_file, "w") as f:
+        f.write("ioda")
+    cache.store("abc", output_file)
+    assert cache.fetch("abc", output_file)
+    assert not cache.fetch("def", output_file)
+
+    cache.invalidate(output_file)
+    assert not cache.fetch("abc", output_file)
+
+
+def test_fetch_from_cache_dir(tmp_path):
+    cache = ConversionCache(cache_dir=os.path.join(tmp_path, "cache"))
+    output_file = os.path.join(tmp_path, "run1.nc")
+    with open(output_file, "w") as f:
+        f.write("ioda")
+    cache.store("abc", output_file)
+
+    other_output = os.path.join(tmp_path, "run2.nc")
+    assert cache.fetch("abc", other_output)
+    with open(other_output) as f:
+        assert f.read() == "ioda"
+
+
+def test_prune(tmp_path):
+    cache_dir = os.path.join(tmp_path, "cache")
+    cache = ConversionCache(cache_dir)
+    for key in ["aaa", "bbb"]:
+        output_file = os.path.join(tmp_path, f"{key}.nc")
+        with open(output_file, "w") as f:
+            f.write(key)
+        cache.store(key, output_file)
+    os.utime(os.path.join(cache_dir, "aa", "aaa.nc"), (0, 0))
+
+    assert cache.prune(max_age_hours=24) == 1
+    assert not os.path.exists(os.path.join(cache_dir, "aa", "aaa.nc"))
+    assert os.path.exists(os.path.join(cache_dir, "bb", "bbb.nc"))
+    assert ConversionCache().prune(max_age_hours=24) == 0
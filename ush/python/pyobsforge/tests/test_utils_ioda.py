@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import pytest
+
+netCDF4 = pytest.importorskip("netCDF4")
+
+from pyobsforge.utils.ioda import (MISSING_FLOAT, MISSING_LONG, concat_insitu_files, concat_ioda_files,  # noqa: E402
+                                   count_locations, summarize_ioda_file)
+
+
+def write_ioda(path, values, sources):
+    """Write a minimal ioda file with a Location and a Channel dimension."""
+    with netCDF4.Dataset(path, 'w') as ds:
+        ds.createDimension('Location', len(values))
+        ds.createDimension('Channel', 1)
+        ds.createVariable('Location', 'i4', ('Location',))[:] = np.arange(len(values))
+        ds.createVariable('Channel', 'i4', ('Channel',))[:] = [4]
+        ds.setncattr_string('obs_source_files', sources)
+        meta = ds.createGroup('MetaData')
+        meta.createVariable('latitude', 'f4', ('Location',), fill_value=-9999.)[:] = values
+        meta.createVariable('dateTime', 'i8', ('Location',))[:] = np.arange(len(values))
+        meta['dateTime'].units = 'seconds since 1970-01-01T00:00:00Z'
+        meta.createVariable('sequenceNumber', 'i4', ('Location',))[:] = np.arange(len(values))
+        obs = ds.createGroup('ObsValue')
+        obs.createVariable('aerosolOpticalDepth', 'f4', ('Location', 'Channel'))[:] = np.reshape(values, (-1, 1))
+
+
+def test_concat_ioda_files(tmp_path):
+    file1 = os.path.join(tmp_path, 'a.nc')
+    file2 = os.path.join(tmp_path, 'b.nc')
+    write_ioda(file1, [1., 2., 3.], ['g1.nc'])
+    write_ioda(file2, [4., 5.], ['g2.nc', 'g1.nc'])
+
+    output = os.path.join(tmp_path, 'out.nc')
+    assert concat_ioda_files([file1, file2], output) == 5
+    assert count_locations(output) == 5
+
+    with netCDF4.Dataset(output) as ds:
+        np.testing.assert_array_equal(ds['Location'][:], np.arange(5))
+        np.testing.assert_array_equal(ds['Channel'][:], [4])
+        np.testing.assert_array_equal(ds['MetaData/latitude'][:], [1., 2., 3., 4., 5.])
+        np.testing.assert_array_equal(ds['MetaData/sequenceNumber'][:], np.arange(5))
+        np.testing.assert_array_equal(ds['ObsValue/aerosolOpticalDepth'][:, 0], [1., 2., 3., 4., 5.])
+        assert ds['MetaData/dateTime'].units == 'seconds since 1970-01-01T00:00:00Z'
+        assert list(ds.getncattr('obs_source_files')) == ['g1.nc', 'g2.nc']
+    assert sorted(os.listdir(tmp_path)) == ['a.nc', 'b.nc', 'out.nc']
+
+
+def test_concat_ioda_files_in_place(tmp_path):
+    file1 = os.path.join(tmp_path, 'a.nc')
+    file2 = os.path.join(tmp_path, 'b.nc')
+    write_ioda(file1, [1., 2.], ['g1.nc'])
+    write_ioda(file2, [3.], ['g2.nc'])
+    concat_ioda_files([file1, file2], file1)
+    assert count_locations(file1) == 3
+
+
+def write_insitu(path, datetimes, with_depth=True):
+    """Write a minimal in situ ioda file with temperature and salinity."""
+    n = len(datetimes)
+    with netCDF4.Dataset(path, 'w') as ds:
+        ds.createDimension('Location', n)
+        meta = ds.createGroup('MetaData')
+        meta.createVariable('latitude', 'f4', ('Location',))[:] = np.arange(n)
+        meta.createVariable('longitude', 'f4', ('Location',))[:] = -np.arange(n)
+        meta.createVariable('dateTime', 'i8', ('Location',))[:] = datetimes
+        meta.createVariable('oceanBasin', 'i4', ('Location',))[:] = np.ones(n)
+        if with_depth:
+            meta.createVariable('depth', 'f4', ('Location',))[:] = np.full(n, 10.)
+        for group, dtype in [('ObsValue', 'f4'), ('ObsError', 'f4'), ('PreQC', 'i4')]:
+            grp = ds.createGroup(group)
+            grp.createVariable('waterTemperature', dtype, ('Location',))[:] = np.full(n, 1)
+            grp.createVariable('salinity', dtype, ('Location',))[:] = np.full(n, 2)
+
+
+def test_concat_insitu_files(tmp_path):
+    # 2025-03-16T09:00:00Z to 2025-03-16T15:00:00Z
+    begin, end = 1742115600, 1742137200
+    file1 = os.path.join(tmp_path, 'a.nc')
+    file2 = os.path.join(tmp_path, 'b.nc')
+    write_insitu(file1, [begin - 86400, begin + 60])
+    write_insitu(file2, [end + 43200], with_depth=False)
+
+    outputs = {'waterTemperature': os.path.join(tmp_path, 'temp.nc'),
+               'salinity': os.path.join(tmp_path, 'salt.nc')}
+    nlocs = concat_insitu_files([file1, file2], outputs,
+                                '2025-03-16T09:00:00Z', '2025-03-16T15:00:00Z', 0.4)
+    assert nlocs == {'waterTemperature': 3, 'salinity': 3}
+
+    with netCDF4.Dataset(outputs['salinity']) as ds:
+        np.testing.assert_array_equal(ds['MetaData/dateTime'][:], [begin + 1, begin + 60, end - 1])
+        np.testing.assert_array_equal(ds['MetaData/originalDateTime'][:], [begin - 86400, begin + 60, end + 43200])
+        np.testing.assert_array_equal(ds['MetaData/depth'][:], [10., 10., 0.])
+        np.testing.assert_allclose(ds['ObsError/salinity'][:], [2.4, 2., 2.2], rtol=1e-6)
+        np.testing.assert_array_equal(ds['ObsValue/salinity'][:], [2., 2., 2.])
+        assert 'waterTemperature' not in ds['ObsValue'].variables
+    with netCDF4.Dataset(outputs['waterTemperature']) as ds:
+        np.testing.assert_allclose(ds['ObsError/waterTemperature'][:], [1.4, 1., 1.2], rtol=1e-6)
+        np.testing.assert_array_equal(ds['PreQC/waterTemperature'][:], [1, 1, 1])
+
+
+def test_summarize_ioda_file(tmp_path):
+    path = os.path.join(tmp_path, "atms_n19.nc")
+    with netCDF4.Dataset(path, "w") as dataset:
+        dataset.createDimension("Location", 4)
+        dataset.createDimension("Channel", 2)
+        meta = dataset.createGroup("MetaData")
+        date_time = meta.createVariable("dateTime", "i8", ("Location",), fill_value=MISSING_LONG)
+        date_time.units = "seconds since 1970-01-01T00:00:00Z"
+        date_time[:] = [1759276800, 1759276860, MISSING_LONG, 1759280400]
+        meta.createVariable("latitude", "f4", ("Location",), fill_value=MISSING_FLOAT)[:] = [10, -20, 30, 0]
+        obs = dataset.createGroup("ObsValue")
+        bt = obs.createVariable("brightnessTemperature", "f4", ("Location", "Channel"), fill_value=MISSING_FLOAT)
+        bt[:] = [[200, 210], [MISSING_FLOAT, 220], [230, np.nan], [240, 250]]
+
+    summary = summarize_ioda_file(path)
+    assert summary["nlocs"] == 4
+    assert summary["dateTime"] == {"min": "2025-10-01T00:00:00Z", "max": "2025-10-01T01:00:00Z"}
+    assert summary["latitude"] == {"min": -20.0, "max": 30.0}
+    assert summary["ObsValue"]["brightnessTemperature"] == {"count": 6, "min": 200.0, "max": 250.0, "mean": 225.0}
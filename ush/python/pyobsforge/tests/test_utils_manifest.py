@@ -0,0 +1,26 @@
+import hashlib
+import os
+
+from pyobsforge.utils.manifest import ResultManifest, file_sha256
+
+
+def test_file_sha256(tmp_path):
+    path = os.path.join(tmp_path, "a.nc")
+    with open(path, "wb") as f:
+        f.write(b"ioda" * 1000)
+    assert file_sha256(path, block_size=7) == hashlib.sha256(b"ioda" * 1000).hexdigest()
+
+
+def test_record_save_load(tmp_path):
+    path = os.path.join(tmp_path, "a.nc")
+    with open(path, "w") as f:
+        f.write("ioda")
+
+    manifest = ResultManifest()
+    entry = manifest.record(path, 12, save_file="gdas.t00z.a.nc")
+    assert entry == {'nlocs': 12, 'size': 4, 'sha256': file_sha256(path), 'save_file': "gdas.t00z.a.nc"}
+    assert path in manifest and len(manifest) == 1
+
+    manifest_file = os.path.join(tmp_path, "manifest.yaml")
+    manifest.save(manifest_file)
+    assert ResultManifest.load(manifest_file).entries == {path: entry}
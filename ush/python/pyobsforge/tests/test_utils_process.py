@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+
+from pyobsforge.utils.process import run_streamed
+
+
+def test_run_streamed_log_file(tmp_path):
+    log_file = os.path.join(tmp_path, "cmd.log")
+    cmd = [sys.executable, "-c", "import sys; print('out 1'); print('err 1', file=sys.stderr); print('out 2')"]
+    returncode, tail = run_streamed(cmd, log_file)
+    assert returncode == 0
+    assert tail == ["err 1"]
+    with open(log_file) as f:
+        lines = f.read().splitlines()
+    assert sorted(lines) == ["err 1", "out 1", "out 2"]
+
+
+def test_run_streamed_stderr_tail(tmp_path):
+    log_file = os.path.join(tmp_path, "cmd.log")
+    cmd = [sys.executable, "-c", "import sys\nfor i in range(100): print(i, file=sys.stderr)\nsys.exit(3)"]
+    returncode, tail = run_streamed(cmd, log_file, tail_lines=5)
+    assert returncode == 3
+    assert tail == ["95", "96", "97", "98", "99"]
+
+
+def test_run_streamed_timeout(tmp_path):
+    log_file = os.path.join(tmp_path, "cmd.log")
+    cmd = [sys.executable, "-c", "import time; print('started', flush=True); time.sleep(60)"]
+    returncode, _ = run_streamed(cmd, log_file, timeout=1)
+    assert returncode == -9
+    with open(log_file) as f:
+        assert f.read().splitlines() == ["started"]
+
+
+def test_run_streamed_timeout_process_tree(tmp_path):
+    log_file = os.path.join(tmp_path, "cmd.log")
+    # the shell waits on a grandchild sharing its output pipes
+    start = time.monotonic()
+    returncode, _ = run_streamed(["sh", "-c", "echo started; sleep 15; echo done"], log_file, timeout=1)
+    assert returncode == -9
+    assert time.monotonic() - start < 5
+    with open(log_file) as f:
+        assert f.read().splitlines() == ["started"]
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from pyobsforge.utils.runtime_history import RuntimeHistory
+
+
+def test_estimate(tmp_path):
+    history = RuntimeHistory(os.path.join(tmp_path, "history.db"))
+    assert history.estimate("atms", 1000, 1) is None
+
+    # 1 s of serial and 8 s of parallel work per 1000 bytes
+    for mpi in (1, 2, 4, 8):
+        history.record("iasi", "2025100100", 1000, 500, mpi, 1 + 8 / mpi)
+    history.record("iasi", "2025100106", 1000, None, 4, 100.0, success=False)
+    assert history.estimate("iasi", 2000, 16) == pytest.approx(2 * (1 + 8 / 16))
+
+    # a single number of ranks, serial_fraction of the time is serial
+    history.record("atms", "2025100100", 1000, 800, 1, 10.0)
+    assert history.estimate("atms", 1000, 2) == pytest.approx(1 + 9 / 2)
+
+    # no history for the type, all the conversions are used
+    assert history.estimate("amsua", 1000, 1) is not None
+
+
+def test_suggest_mpi(tmp_path):
+    history = RuntimeHistory(os.path.join(tmp_path, "history.db"))
+    for mpi in (1, 8):
+        history.record("iasi", "2025100100", 1000, 500, mpi, 1 + 63 / mpi)
+        history.record("mhs", "2025100100", 1000, 500, mpi, 1.0 + 1 / mpi)
+
+    mpi, estimate = history.suggest_mpi({"iasi": (1000, 1), "mhs": (1000, 1)}, budget=16, walltime_limit=600)
+    assert mpi["mhs"] == 1 and mpi["iasi"] > 1
+    assert estimate < history.estimate("iasi", 1000, 1)
+
+    # without history, the current ranks are kept
+    empty = RuntimeHistory(os.path.join(tmp_path, "empty.db"))
+    assert empty.suggest_mpi({"atms": (1000, 2)}, budget=16) == ({"atms": 2}, None)
@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pyobsforge.utils.scheduler import CoreBudgetScheduler, Job
+
+
+def test_core_budget_is_respected(tmp_path):
+    lock = threading.Lock()
+    usage = {'cores': 0, 'peak': 0}
+
+    def work(cores, seconds):
+        with lock:
+            usage['cores'] += cores
+            usage['peak'] = max(usage['peak'], usage['cores'])
+        time.sleep(seconds)
+        with lock:
+            usage['cores'] -= cores
+        return True
+
+    jobs = [Job(f"serial{i}", 1, work, (1, 0.02), weight=i) for i in range(6)]
+    jobs += [Job("cris", 8, work, (8, 0.05)), Job("iasi", 8, work, (8, 0.05)), Job("huge", 20, work, (10, 0.01), weight=10)]
+
+    scheduler = CoreBudgetScheduler(10)
+    with ThreadPoolExecutor(10) as executor:
+        timeline = scheduler.run(executor, jobs)
+
+    assert len(timeline) == len(jobs)
+    assert usage['peak'] <= 10
+    assert all(job.result is True and job.error is None for job in timeline)
+    # the jobs are started by decreasing weight
+    starts = [job.name for job in sorted(timeline, key=lambda job: job.start)]
+    assert starts[0] == "huge"
+    assert [name for name in starts if name.startswith("serial")] == [f"serial{i}" for i in reversed(range(6))]
+
+    summary = scheduler.summary()
+    assert summary['makespan'] > 0 and 0 < summary['utilization'] <= 1
+
+    timeline_file = os.path.join(tmp_path, "timeline.log")
+    scheduler.write_timeline(timeline_file)
+    with open(timeline_file) as f:
+        lines = [line for line in f if not line.startswith("#")]
+    assert len(lines) == len(jobs) and all(line.split()[-1] == "ok" for line in lines)
+
+
+def test_failed_job():
+    def fail():
+        raise RuntimeError("boom")
+
+    scheduler = CoreBudgetScheduler(2)
+    with ThreadPoolExecutor(2) as executor:
+        timeline = scheduler.run(executor, [Job("bad", 1, fail), Job("good", 1, int, ("0",)), Job("exit", 1, int, ("2",))])
+
+    jobs = {job.name: job for job in timeline}
+    assert isinstance(jobs["bad"].error, RuntimeError) and not jobs["bad"].succeeded
+    assert jobs["good"].result == 0 and jobs["good"].succeeded
+    assert jobs["exit"].result == 2 and not jobs["exit"].succeeded
@@ -0,0 +1,110 @@
+import os
+import socket
+import threading
+
+from pyobsforge.utils.staging import (ScratchManager, cache_root, copy_files, link_from_versioned_cache, source_version,
+                                      tmp_name)
+
+
+def test_cache_root():
+    # independent of the per-cycle DATAROOT
+    task_config = {'COMROOT': '/com', 'PSLOT': 'obsforge', 'DATAROOT': '/rundirs/obsforge/gdas.2025100100'}
+    assert cache_root(task_config) == '/com/obsforge/cache'
+    assert cache_root(dict(task_config, CACHEROOT='/cache')) == '/cache'
+
+
+def test_link_from_versioned_cache(tmp_path):
+    src_dir = os.path.join(tmp_path, "src")
+    run_dirs = [os.path.join(tmp_path, f"run{i}") for i in range(3)]
+    for d in [src_dir] + run_dirs:
+        os.makedirs(d)
+    src_files = [os.path.join(src_dir, name) for name in ("amsua.py", "amsua_n19.ACCoeff.nc")]
+    for src_file in src_files:
+        with open(src_file, "w") as f:
+            f.write(os.path.basename(src_file))
+
+    cache_root = os.path.join(tmp_path, "cache")
+    versions = []
+    for run_dir in run_dirs[:2]:
+        src_dst = [[src, os.path.join(run_dir, os.path.basename(src))] for src in src_files]
+        versions.append(link_from_versioned_cache(src_dst, cache_root))
+        for src, dst in src_dst:
+            assert os.path.islink(dst) and os.path.realpath(dst) == os.path.join(versions[-1], os.path.basename(src))
+    assert versions[0] == versions[1] == os.path.join(cache_root, source_version(src_files))
+
+    # an updated source gets a new version, the previous one is left untouched
+    with open(src_files[0], "w") as f:
+        f.write("updated")
+    src_dst = [[src, os.path.join(run_dirs[2], os.path.basename(src))] for src in src_files]
+    assert link_from_versioned_cache(src_dst, cache_root) != versions[0]
+    with open(os.path.join(run_dirs[0], "amsua.py")) as f:
+        assert f.read() == "amsua.py"
+    with open(os.path.join(run_dirs[2], "amsua.py")) as f:
+        assert f.read() == "updated"
+
+
+def test_copy_files(tmp_path):
+    src_dst = []
+    for i in range(5):
+        src = os.path.join(tmp_path, f"atms_n{i}.nc")
+        with open(src, "w") as f:
+            f.write(str(i))
+        src_dst.append([src, os.path.join(tmp_path, "comout", f"gdas.t00z.atms_n{i}.nc")])
+    copy_files(src_dst, max_workers=3)
+    for i, (_, dst) in enumerate(src_dst):
+        with open(dst) as f:
+            assert f.read() == str(i)
+
+
+def test_scratch_manager(tmp_path):
+    def stage(obs_space, nbytes):
+        os.makedirs(os.path.join(tmp_path, obs_space), exist_ok=True)
+        staged_file = os.path.join(obs_space, f"{obs_space}.nc")
+        with open(os.path.join(tmp_path, staged_file), "wb") as f:
+            f.write(b"0" * nbytes)
+        scratch.stage(obs_space, [staged_file])
+        return os.path.join(tmp_path, staged_file)
+
+    scratch = ScratchManager(str(tmp_path), budget=250)
+    files = {obs_space: stage(obs_space, 100) for obs_space in ("sst_a", "sst_b", "adt_a")}
+    # a file shared by two obs spaces is counted once and kept until both are converted
+    scratch.stage("adt_b", [files["adt_a"]])
+    assert scratch.usage == 300
+
+    # the inputs of a failed conversion are kept
+    assert scratch.converted("sst_a", False) == 0
+    # over budget, the inputs of the first converted obs spaces are removed
+    assert scratch.converted("sst_b", True) == 100
+    assert not os.path.exists(files["sst_b"]) and scratch.usage == 200
+
+    scratch.cleanup = True
+    assert scratch.converted("adt_a", True) == 0
+    assert os.path.exists(files["adt_a"])
+    assert scratch.converted("adt_b", True) == 100
+    assert not os.path.exists(files["adt_a"]) and os.path.exists(files["sst_a"])
+
+    report = scratch.write_report(os.path.join(tmp_path, "report", "scratch.yaml"))
+    assert (report['staged'], report['removed'], report['left'], report['peak']) == (300, 200, 100, 300)
+    assert report['obs spaces']['sst_a'] == {'files': 1, 'staged': 100, 'removed': 0, 'converted': False}
+    assert report['obs spaces']['adt_a']['removed'] == 100 and report['obs spaces']['adt_b']['staged'] == 0
+    assert os.path.exists(os.path.join(tmp_path, "report", "scratch.yaml"))
+
+
+def test_tmp_name(tmp_path):
+    path = os.path.join(tmp_path, "granule.nc")
+    names = set()
+    # alive at once, so their idents differ
+    barrier = threading.Barrier(4)
+
+    def name():
+        names.add(tmp_name(path))
+        barrier.wait()
+
+    threads = [threading.Thread(target=name) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # unique per thread, next to the file and tied to the host
+    assert len(names) == 4
+    assert all(os.path.dirname(name) == str(tmp_path) and socket.gethostname() in name for name in names)
@@ -0,0 +1,40 @@
+import os
+from datetime import datetime
+
+from wxflow import parse_j2yaml
+
+from pyobsforge import pyobsforge_directory
+from pyobsforge.utils.templates import clear_template_cache, get_template, parse_j2yaml_cached
+
+HOMEobsforge = os.path.abspath(os.path.join(pyobsforge_directory, '../../../'))
+
+
+def test_parse_j2yaml_cached_matches_parse_j2yaml():
+    template = os.path.join(HOMEobsforge, 'parm', 'nc2ioda', 'nc2ioda.yaml.j2')
+    context = {'provider': 'GHRSST',
+               'window_begin': datetime(2025, 3, 16, 3),
+               'window_end': datetime(2025, 3, 16, 9),
+               'input_files': ['sst/a.nc', 'sst/b.nc'],
+               'output_file': 'gdas.t06z.sst.nc',
+               'bounds_min': -2.0,
+               'bounds_max': 45.0,
+               'binning_stride': 15,
+               'binning_min_number_of_obs': 10}
+    clear_template_cache()
+    for _ in range(2):
+        assert parse_j2yaml_cached(template, context) == parse_j2yaml(template, context)
+
+
+def test_template_cache_invalidation(tmp_path):
+    template = os.path.join(tmp_path, 'test.yaml.j2')
+    with open(template, 'w') as f:
+        f.write("value: {{ value }}\n")
+    compiled = get_template(template)
+    assert get_template(template) is compiled
+    assert parse_j2yaml_cached(template, {'value': 1}) == {'value': 1}
+
+    with open(template, 'w') as f:
+        f.write("other: {{ value }}\n")
+    os.utime(template, ns=(0, os.stat(template).st_mtime_ns + 1_000_000_000))
+    assert get_template(template) is not compiled
+    assert parse_j2yaml_cached(template, {'value': 2}) == {'other': 2}
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+from logging import getLogger
+
+import netCDF4
+import numpy as np
+
+from pyobsforge.utils.staging import tmp_name
+
+logger = getLogger(__name__.split('.')[-1])
+
+# Variables and global attribute of a JRR-AOD granule read by the VIIRS AOD converter
+VARIABLES = ('Longitude', 'Latitude', 'AOD550', 'QCAll', 'QCPath')
+TIME_ATTRIBUTE = 'time_coverage_end'
+# Missing value of AOD550 tested by the converter
+AOD_MISSING = np.float32(-999.999)
+
+# The netCDF/HDF5 libraries are not guaranteed to be thread safe, the platforms are prepared concurrently
+_netcdf_lock = threading.Lock()
+
+
+def valid_pixels(aod550: np.ndarray, qcall: np.ndarray, preqc: int) -> np.ndarray:
+    """
+    Return the mask of the pixels the converter keeps before thinning.
+
+    Args:
+        aod550 (ndarray): AOD at 550 nm, Rows x Columns.
+        qcall (ndarray): Overall quality flag, Rows x Columns.
+        preqc (int): Worst quality flag kept.
+
+    Returns:
+        ndarray: True where the AOD is not missing and the quality flag is at most `preqc`.
+    """
+    return (aod550 != AOD_MISSING) & (qcall <= preqc)
+
+
+def kept_indices(valid: np.ndarray, stride: int = 1) -> np.ndarray:
+    """
+    Return the indices along an axis of the bins holding at least one valid pixel.
+
+    The axis is cut into bins of `stride` pixels starting at 0, as done by the binning of
+    the converter, so dropping the other bins leaves the binned observations unchanged.
+
+    Args:
+        valid (ndarray): Whether each row (or column) has a valid pixel.
+        stride (int): Bin size, 1 without binning.
+
+    Returns:
+        ndarray: Sorted indices of the rows (or columns) kept.
+    """
+    stride = max(1, int(stride))
+    nbins = -(-valid.size // stride)
+    padded = np.zeros(nbins * stride, dtype=bool)
+    padded[:valid.size] = valid
+    kept_bins = padded.reshape(nbins, stride).any(axis=1)
+    return np.flatnonzero(np.repeat(kept_bins, stride)[:valid.size])
+
+
+def prethin_granule(src_file: str, dst_file: str, preqc: int, stride: int = 1) -> int:
+    """
+    Write a compact copy of a JRR-AOD granule holding only what the converter uses.
+
+    Only the converter variables and the `time_coverage_end` attribute are copied, and the
+    rows and columns of the bins without any valid pixel are dropped. The pixel values are
+    left untouched so the converter masks, thins and bins the copy as it would the granule.
+    The copy gets the access and modification times of the granule, so the key of its
+    conversion in the conversion cache does not change from a run to the next.
+    Nothing is written when the granule has no valid pixel.
+
+    Args:
+        src_file (str): Path to the granule.
+        dst_file (str): Path to the compact copy.
+        preqc (int): Worst quality flag kept.
+        stride (int): Binning stride of the converter, 1 without binning.
+
+    Returns:
+        int: Number of valid pixels of the granule.
+    """
+    with _netcdf_lock, netCDF4.Dataset(src_file, 'r') as src:
+        # raw values, as read by the converter
+        src.set_auto_maskandscale(False)
+        data = {name: src.variables[name][:] for name in VARIABLES}
+        valid = valid_pixels(data['AOD550'], data['QCAll'], preqc)
+        nvalid = int(np.count_nonzero(valid))
+        if nvalid == 0:
+            return 0
+        rows = kept_indices(valid.any(axis=1), stride)
+        columns = kept_indices(valid.any(axis=0), stride)
+
+        tmp_file = tmp_name(dst_file)
+        try:
+            with netCDF4.Dataset(tmp_file, 'w', format='NETCDF4') as dst:
+                dst.setncattr(TIME_ATTRIBUTE, src.getncattr(TIME_ATTRIBUTE))
+                dst.createDimension('Rows', rows.size)
+                dst.createDimension('Columns', columns.size)
+                for name in VARIABLES:
+                    variable = src.variables[name]
+                    attrs = {attr: variable.getncattr(attr) for attr in variable.ncattrs()}
+                    out = dst.createVariable(name, variable.dtype, ('Rows', 'Columns'),
+                                             fill_value=attrs.pop('_FillValue', None))
+                    out.set_auto_maskandscale(False)
+                    out.setncatts(attrs)
+                    out[:] = data[name][np.ix_(rows, columns)]
+            src_stat = os.stat(src_file)
+            os.utime(tmp_file, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            os.replace(tmp_file, dst_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return nvalid
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+import sys
+from logging import getLogger
+
+logger = getLogger(__name__.split('.')[-1])
+
+
+def init_worker(b2i_dir: str) -> None:
+    """
+    Initialize a worker process running bufr2ioda converters.
+
+    The converter scripts and their b2iconverter package are made importable, and the
+    package is imported here so numpy, pyiodaconv and pyioda load once per worker
+    instead of once per conversion.
+
+    Args:
+        b2i_dir (str): Directory of the bufr2ioda_<name>.py scripts.
+    """
+    if b2i_dir not in sys.path:
+        sys.path.insert(0, b2i_dir)
+    import b2iconverter.bufr2ioda_converter  # noqa: F401
+
+
+def convert(name: str, config_file: str) -> int:
+    """
+    Run the bufr2ioda converter registered under `name` in the worker process.
+
+    Args:
+        name (str): Name of the converter, the bufr2ioda_<name>.py script registers it.
+        config_file (str): bufr2ioda configuration of the conversion.
+
+    Returns:
+        int: Exit status of the converter, as if its script had been run.
+    """
+    from b2iconverter.registry import run_converter
+    return run_converter(name, config_file)
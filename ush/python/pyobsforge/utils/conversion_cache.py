@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from logging import getLogger
+from typing import List, Optional
+
+from wxflow import vanilla_yaml
+
+from pyobsforge.utils.staging import tmp_name
+
+logger = getLogger(__name__.split('.')[-1])
+
+
+class ConversionCache:
+    """
+    Content-addressed cache of converted ioda files.
+
+    A conversion is identified by a key hashed from its rendered configuration, the names,
+    sizes and modification times of its input files and the identity of the converter.
+    The key of a successful conversion is stamped next to its output (`<output>.key`), so a
+    rerun in the same working directory reuses the output in place. When a cache directory
+    is given, outputs are also stored there under their key and restored from it.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None) -> None:
+        """
+        :param cache_dir: (Optional) Directory shared across runs where outputs are stored.
+        """
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def compute_key(config: dict, input_files: List[str], converter: str, base_dir: str = '.') -> str:
+        """
+        Compute the key of a conversion.
+
+        The output file name is not part of the key: it describes where the result is
+        written, not what it contains.
+
+        :param config: Rendered converter configuration.
+        :param input_files: Input files of the conversion, relative to base_dir or absolute.
+        :param converter: Path to the converter executable or script.
+        :param base_dir: Directory the relative input files are resolved from.
+        :return: Hexadecimal digest of the conversion.
+        """
+        config = {key: value for key, value in vanilla_yaml(config).items() if key != 'output file'}
+        digest = hashlib.sha256()
+        digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+        for input_file in sorted(input_files):
+            stat = os.stat(os.path.join(base_dir, input_file))
+            digest.update(f"{os.path.basename(input_file)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        if os.path.exists(converter):
+            stat = os.stat(converter)
+            digest.update(f"{converter}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        else:
+            digest.update(converter.encode())
+        return digest.hexdigest()
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.nc")
+
+    @staticmethod
+    def _stamp_path(output_file: str) -> str:
+        return f"{output_file}.key"
+
+    def fetch(self, key: str, output_file: str) -> bool:
+        """
+        Make the output of a conversion available at output_file if it was already produced.
+
+        :param key: Key of the conversion.
+        :param output_file: Path where the output is expected.
+        :return: True on a cache hit.
+        """
+        stamp = self._stamp_path(output_file)
+        if os.path.exists(output_file) and os.path.exists(stamp):
+            with open(stamp) as f:
+                if f.read().strip() == key:
+                    logger.info(f"Reusing {output_file}, unchanged since its last conversion")
+                    return True
+
+        if self.cache_dir and os.path.exists(self._cache_path(key)):
+            shutil.copy2(self._cache_path(key), output_file)
+            # Mark the stored output as recently used, see prune
+            os.utime(self._cache_path(key))
+            self._stamp(key, output_file)
+            logger.info(f"Restored {output_file} from {self._cache_path(key)}")
+            return True
+
+        return False
+
+    def store(self, key: str, output_file: str) -> None:
+        """
+        Record the output of a successful conversion.
+
+        :param key: Key of the conversion.
+        :param output_file: Path to the output of the conversion.
+        """
+        if not os.path.exists(output_file):
+            return
+        self._stamp(key, output_file)
+        if self.cache_dir:
+            cache_path = self._cache_path(key)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # Copy under a temporary name so concurrent readers never see a partial file
+            tmp_path = tmp_name(cache_path)
+            shutil.copy2(output_file, tmp_path)
+            os.replace(tmp_path, cache_path)
+            logger.debug(f"Stored {output_file} as {cache_path}")
+
+    def invalidate(self, output_file: str) -> None:
+        """
+        Forget the conversion that produced output_file, before it is overwritten.
+
+        :param output_file: Path to the output of the conversion.
+        """
+        stamp = self._stamp_path(output_file)
+        if os.path.exists(stamp):
+            os.remove(stamp)
+
+    def prune(self, max_age_hours: float) -> int:
+        """
+        Remove the outputs of the cache directory not stored or reused for max_age_hours.
+
+        :param max_age_hours: Age in hours past which the stored outputs are removed.
+        :return: Number of removed outputs.
+        """
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return 0
+        oldest = time.time() - max_age_hours * 3600
+        nremoved = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                cache_path = os.path.join(root, name)
+                try:
+                    if os.stat(cache_path).st_mtime < oldest:
+                        os.remove(cache_path)
+                        nremoved += 1
+                except FileNotFoundError:
+                    # Pruned by a concurrent run
+                    pass
+        if nremoved > 0:
+            logger.info(f"Pruned {nremoved} outputs older than {max_age_hours} hours from {self.cache_dir}")
+        return nremoved
+
+    def _stamp(self, key: str, output_file: str) -> None:
+        with open(self._stamp_path(output_file), 'w') as f:
+            f.write(f"{key}\n")
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+import os
+from datetime import datetime, timezone
+from logging import getLogger
+from typing import Any, Dict, List
+
+import netCDF4
+import numpy as np
+
+from pyobsforge.utils.staging import tmp_name
+
+logger = getLogger(__name__.split('.')[-1])
+
+LOCATION = 'Location'
+SEQUENCE_NUMBER = 'sequenceNumber'
+
+# Missing values of the ioda converters (util::missingValue)
+MISSING_FLOAT = np.float32(-3.3687953e+38)
+MISSING_INT = np.int32(-2147483643)
+MISSING_LONG = np.int64(-9223372036854775801)
+
+
+def count_locations(ioda_file: str) -> int:
+    """
+    Return the number of locations of an ioda file.
+
+    Args:
+        ioda_file (str): Path to the ioda file.
+
+    Returns:
+        int: Size of the Location dimension.
+    """
+    with netCDF4.Dataset(ioda_file, 'r') as dataset:
+        return len(dataset.dimensions[LOCATION])
+
+
+def summarize_ioda_file(ioda_file: str) -> Dict[str, Any]:
+    """
+    Return summary statistics of an ioda file.
+
+    The summary holds the number of locations, the range of the MetaData dateTime, latitude
+    and longitude, and the count of valid values, minimum, maximum and mean of each ObsValue
+    variable. Fill and missing values are left out, the variables are read whole.
+
+    Args:
+        ioda_file (str): Path to the ioda file.
+
+    Returns:
+        dict: Summary of the file.
+    """
+    with netCDF4.Dataset(ioda_file, 'r') as dataset:
+        summary = {'nlocs': len(dataset.dimensions[LOCATION])}
+        meta = dataset.groups.get('MetaData')
+        if meta is not None:
+            if 'dateTime' in meta.variables:
+                date_time = _valid_values(meta.variables['dateTime'])
+                if date_time.size:
+                    units = getattr(meta.variables['dateTime'], 'units', 'seconds since 1970-01-01T00:00:00Z')
+                    epoch = datetime.fromisoformat(units.replace('seconds since ', '').replace('Z', '+00:00'))
+                    epoch = epoch.replace(tzinfo=epoch.tzinfo or timezone.utc).timestamp()
+                    summary['dateTime'] = {
+                        bound: datetime.fromtimestamp(epoch + float(value), timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+                        for bound, value in [('min', date_time.min()), ('max', date_time.max())]}
+            for name in ['latitude', 'longitude']:
+                if name in meta.variables:
+                    values = _valid_values(meta.variables[name])
+                    if values.size:
+                        summary[name] = {'min': float(values.min()), 'max': float(values.max())}
+        obs_value = dataset.groups.get('ObsValue')
+        variables = {}
+        for name, variable in (obs_value.variables.items() if obs_value is not None else []):
+            if variable.dtype.kind not in 'iuf':
+                continue
+            values = _valid_values(variable)
+            variables[name] = {'count': int(values.size)}
+            if values.size:
+                variables[name].update(min=float(values.min()), max=float(values.max()), mean=float(values.mean()))
+        summary['ObsValue'] = variables
+    return summary
+
+
+def _valid_values(variable: netCDF4.Variable) -> np.ndarray:
+    """
+    Return the values of a variable that are neither fill, missing nor NaN, flattened.
+    """
+    values = np.ma.masked_invalid(np.ma.asarray(variable[:]).astype(np.float64))
+    missing = {np.float32: MISSING_FLOAT, np.int32: MISSING_INT, np.int64: MISSING_LONG}.get(variable.dtype.type)
+    if missing is not None:
+        values = np.ma.masked_equal(values, np.float64(missing))
+    return values.compressed()
+
+
+def concat_ioda_files(input_files: List[str], output_file: str) -> int:
+    """
+    Concatenate ioda files along the Location dimension.
+
+    The group, dimension and variable layout as well as the attributes are taken from the
+    first file. Variables along Location are concatenated in the order of `input_files`,
+    the others are copied from the first file. The Location coordinate is renumbered so
+    the output has a single consistent sequence, the `sequenceNumber` of each file is offset
+    past the ones of the files before it, and the `obs_source_files` global
+    attributes are merged. The output is written under a temporary name and moved in place.
+
+    Args:
+        input_files (list): Paths to the ioda files to concatenate.
+        output_file (str): Path to the concatenated ioda file.
+
+    Returns:
+        int: Number of locations in the output.
+    """
+    datasets = [netCDF4.Dataset(input_file, 'r') for input_file in input_files]
+    tmp_file = tmp_name(output_file)
+    try:
+        for dataset in datasets:
+            dataset.set_auto_mask(False)
+        nlocs = sum(len(dataset.dimensions[LOCATION]) for dataset in datasets)
+        with netCDF4.Dataset(tmp_file, 'w', format='NETCDF4') as output:
+            _concat_group(datasets, output, nlocs)
+            source_files = []
+            for dataset in datasets:
+                if 'obs_source_files' in dataset.ncattrs():
+                    source_files.extend(np.atleast_1d(dataset.getncattr('obs_source_files')).tolist())
+            if source_files:
+                output.setncattr_string('obs_source_files', list(dict.fromkeys(source_files)))
+        os.replace(tmp_file, output_file)
+    finally:
+        for dataset in datasets:
+            dataset.close()
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    logger.info(f"Concatenated {len(input_files)} files into {output_file} ({nlocs} locations)")
+    return nlocs
+
+
+def concat_insitu_files(input_files: List[str], output_files: Dict[str, str],
+                        window_begin: str, window_end: str, error_ratio: float) -> Dict[str, int]:
+    """
+    Concatenate in situ ioda files into one ioda file per observed variable.
+
+    This is the Python counterpart of the INSITUOBS provider of obsforge_obsprovider2ioda.x,
+    for all the variables of the inputs at once: each input file is read a single time and
+    every output is written from the same concatenated arrays. As in the converter, the
+    observations outside of the window are moved one second inside of it and their error is
+    inflated by `error_ratio` (per day) times their distance to the window. The original
+    dates are kept in MetaData/originalDateTime.
+
+    Args:
+        input_files (list): Paths to the in situ ioda files, in order.
+        output_files (dict): Path to the output ioda file, keyed by variable name.
+        window_begin (str): Beginning of the window, as an ISO time.
+        window_end (str): End of the window, as an ISO time.
+        error_ratio (float): Error inflation of the observations outside of the window, per day.
+
+    Returns:
+        dict: Number of locations written, keyed by variable name.
+    """
+    if not input_files:
+        logger.warning(f"No input files to concatenate into {list(output_files.values())}")
+        return {}
+
+    variables = list(output_files.keys())
+    metadata = {'latitude': [], 'longitude': [], 'dateTime': [], 'depth': [], 'oceanBasin': []}
+    obs = {variable: {'ObsValue': [], 'ObsError': [], 'PreQC': []} for variable in variables}
+    for input_file in input_files:
+        with netCDF4.Dataset(input_file, 'r') as dataset:
+            dataset.set_auto_mask(False)
+            nlocs = len(dataset.dimensions[LOCATION])
+            meta = dataset.groups['MetaData']
+            metadata['latitude'].append(meta.variables['latitude'][:].astype(np.float32))
+            metadata['longitude'].append(meta.variables['longitude'][:].astype(np.float32))
+            metadata['dateTime'].append(meta.variables['dateTime'][:].astype(np.int64))
+            if 'depth' in meta.variables:
+                metadata['depth'].append(meta.variables['depth'][:].astype(np.float32))
+            else:
+                logger.warning(f"No depth in {input_file}, assuming the observations are at the surface")
+                metadata['depth'].append(np.zeros(nlocs, dtype=np.float32))
+            metadata['oceanBasin'].append(meta.variables['oceanBasin'][:].astype(np.int32))
+            for variable in variables:
+                for group, dtype in [('ObsValue', np.float32), ('ObsError', np.float32), ('PreQC', np.int32)]:
+                    obs[variable][group].append(dataset.groups[group].variables[variable][:].astype(dtype))
+
+    metadata = {name: np.concatenate(values) for name, values in metadata.items()}
+    original_datetime = metadata['dateTime'].copy()
+
+    # Redate the observations outside of the window and inflate their error
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    window = [int((datetime.strptime(time, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc) - epoch).total_seconds())
+              for time in (window_begin, window_end)]
+    # Single precision, as in the converter
+    error_ratio = np.float32(np.float32(error_ratio) / 86400.0)
+    before = original_datetime < window[0]
+    after = original_datetime > window[1]
+    delta_t = np.where(before, window[0] - original_datetime, 0) + np.where(after, original_datetime - window[1], 0)
+    metadata['dateTime'][before] = window[0] + 1
+    metadata['dateTime'][after] = window[1] - 1
+    metadata['originalDateTime'] = original_datetime
+    error_increment = error_ratio * delta_t.astype(np.float32)
+    logger.info(f"Redated {np.count_nonzero(before | after)} of {len(original_datetime)} observations into the window")
+
+    nlocs = {}
+    for variable, output_file in output_files.items():
+        obs_error = np.concatenate(obs[variable]['ObsError']) + error_increment
+        _write_insitu_file(output_file, variable, metadata,
+                           np.concatenate(obs[variable]['ObsValue']), obs_error,
+                           np.concatenate(obs[variable]['PreQC']), input_files)
+        nlocs[variable] = len(obs_error)
+        logger.info(f"Wrote {nlocs[variable]} locations of {variable} into {output_file}")
+    return nlocs
+
+
+def _write_insitu_file(output_file: str, variable: str, metadata: Dict[str, np.ndarray],
+                       obs_value: np.ndarray, obs_error: np.ndarray, preqc: np.ndarray,
+                       input_files: List[str]) -> None:
+    """
+    Write the ioda file of one in situ variable, with the layout of the converter.
+    """
+    tmp_file = tmp_name(output_file)
+    try:
+        with netCDF4.Dataset(tmp_file, 'w', format='NETCDF4') as output:
+            output.createDimension(LOCATION, len(obs_value))
+            output.createVariable(LOCATION, 'i4', (LOCATION,))[:] = np.arange(len(obs_value), dtype=np.int32)
+            output.setncattr_string('obs_source_files', list(input_files))
+
+            def create(group, name, values, fill_value):
+                new_variable = group.createVariable(name, values.dtype, (LOCATION,), zlib=True, fill_value=fill_value)
+                new_variable[:] = values
+                return new_variable
+
+            meta = output.createGroup('MetaData')
+            create(meta, 'dateTime', metadata['dateTime'], MISSING_LONG).units = 'seconds since 1970-01-01T00:00:00Z'
+            create(meta, 'latitude', metadata['latitude'], MISSING_FLOAT)
+            create(meta, 'longitude', metadata['longitude'], MISSING_FLOAT)
+            create(meta, 'oceanBasin', metadata['oceanBasin'], MISSING_INT)
+            create(meta, 'depth', metadata['depth'], MISSING_FLOAT)
+            create(meta, 'originalDateTime', metadata['originalDateTime'], MISSING_LONG)
+            create(output.createGroup('ObsValue'), variable, obs_value, MISSING_FLOAT)
+            create(output.createGroup('ObsError'), variable, obs_error, MISSING_FLOAT)
+            create(output.createGroup('PreQC'), variable, preqc, MISSING_INT)
+        os.replace(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _concat_group(sources: List[netCDF4.Group], output: netCDF4.Group, nlocs: int) -> None:
+    """
+    Recursively concatenate the groups of `sources` into `output`.
+    """
+    first = sources[0]
+    output.setncatts({name: first.getncattr(name) for name in first.ncattrs()})
+
+    for name, dimension in first.dimensions.items():
+        output.createDimension(name, nlocs if name == LOCATION else len(dimension))
+
+    for name, variable in first.variables.items():
+        fill_value = variable.getncattr('_FillValue') if '_FillValue' in variable.ncattrs() else None
+        filters = variable.filters() or {}
+        new_variable = output.createVariable(name, variable.dtype, variable.dimensions,
+                                             zlib=filters.get('zlib', False), fill_value=fill_value)
+        new_variable.setncatts({att: variable.getncattr(att) for att in variable.ncattrs() if att != '_FillValue'})
+
+        if name == LOCATION and variable.dimensions == (LOCATION,):
+            start = variable[0] if len(variable) > 0 else 0
+            new_variable[:] = np.arange(start, start + nlocs, dtype=variable.dtype)
+        elif name == SEQUENCE_NUMBER and variable.dimensions == (LOCATION,):
+            new_variable[:] = _concat_sequence_numbers([source.variables[name][:] for source in sources])
+        elif LOCATION in variable.dimensions:
+            axis = variable.dimensions.index(LOCATION)
+            new_variable[:] = np.concatenate([source.variables[name][:] for source in sources], axis=axis)
+        else:
+            new_variable[:] = variable[:]
+
+    for name in first.groups:
+        _concat_group([source.groups[name] for source in sources], output.createGroup(name), nlocs)
+
+
+def _concat_sequence_numbers(parts: List[np.ndarray]) -> np.ndarray:
+    """
+    Concatenate sequence numbers, offsetting each part past the largest number of the previous ones.
+    """
+    offset = 0
+    shifted = []
+    for part in parts:
+        shifted.append(part + offset)
+        if len(part) > 0:
+            offset = shifted[-1].max() + 1
+    return np.concatenate(shifted)
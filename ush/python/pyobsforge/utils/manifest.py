@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import threading
+from logging import getLogger
+from typing import Any, Dict, Optional
+
+from wxflow import parse_yaml, save_as_yaml
+
+logger = getLogger(__name__.split('.')[-1])
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """
+    Return the sha256 digest of a file, read by blocks.
+
+    Args:
+        path (str): Path to the file.
+        block_size (int): Size of the blocks read at once.
+
+    Returns:
+        str: Hexadecimal digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultManifest:
+    """
+    Manifest of the outputs of a task, recorded by the step that writes them.
+
+    Each output is recorded with its number of observations and its checksum when it is
+    produced, so later steps know which outputs are valid without opening them again.
+    """
+
+    def __init__(self, entries: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+        """
+        Args:
+            entries (dict): (Optional) Entries of the manifest, keyed by output file.
+        """
+        self.entries = dict(entries or {})
+        self._lock = threading.Lock()
+
+    def record(self, output_file: str, nlocs: Optional[int], **attributes) -> Dict[str, Any]:
+        """
+        Record an output that was just written.
+
+        Args:
+            output_file (str): Path to the output.
+            nlocs (int): Number of locations of the output, None if unknown.
+            **attributes: Additional attributes of the entry.
+
+        Returns:
+            dict: Entry of the output.
+        """
+        entry = {'nlocs': None if nlocs is None else int(nlocs),
+                 'size': os.path.getsize(output_file),
+                 'sha256': file_sha256(output_file),
+                 **attributes}
+        with self._lock:
+            self.entries[output_file] = entry
+        logger.debug(f"Recorded {output_file}: {entry}")
+        return entry
+
+    def __contains__(self, output_file: str) -> bool:
+        return output_file in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def items(self):
+        return self.entries.items()
+
+    def save(self, path: str) -> None:
+        """
+        Write the manifest as YAML.
+
+        Args:
+            path (str): Path to the manifest.
+        """
+        with self._lock:
+            save_as_yaml(self.entries, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ResultManifest":
+        """
+        Read a manifest written by save.
+
+        Args:
+            path (str): Path to the manifest.
+
+        Returns:
+            ResultManifest: The manifest.
+        """
+        return cls(dict(parse_yaml(path)))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import os
+import signal
+import subprocess
+import threading
+from collections import deque
+from logging import getLogger, Logger
+from typing import List, Optional, Tuple
+
+logger = getLogger(__name__.split('.')[-1])
+
+
+def run_streamed(cmd: List[str],
+                 log_file: str,
+                 cwd: Optional[str] = None,
+                 timeout: Optional[float] = None,
+                 tail_lines: int = 50,
+                 prefix: str = "",
+                 task_logger: Optional[Logger] = None,
+                 drain_timeout: float = 10,
+                 kill_grace: float = 0) -> Tuple[int, List[str]]:
+    """
+    Run a command while streaming its output line by line.
+
+    Standard output and standard error are written to `log_file` as they are produced and
+    forwarded to the task logger, so nothing is buffered in memory beyond the last `tail_lines`
+    lines of standard error that are kept for the error report.
+
+    The command runs in its own process group, so on timeout its whole process tree is
+    killed, including the processes it started (e.g. the ranks of an MPI launcher), which
+    would otherwise keep its output pipes open. With `kill_grace`, the group is sent SIGTERM
+    first, so a launcher such as srun can cancel its ranks on the other nodes.
+
+    Args:
+        cmd (list): Command and its arguments.
+        log_file (str): Path of the log file receiving both output streams.
+        cwd (str): Working directory of the command.
+        timeout (float): Wall-clock limit in seconds, the command is killed past it. None for no limit.
+        tail_lines (int): Number of trailing standard error lines to return.
+        prefix (str): Prefix of the lines forwarded to the task logger.
+        task_logger (Logger): Logger receiving the output, defaults to the logger of this module.
+        drain_timeout (float): Seconds the output is still read once the command is over, in case
+            a process left behind still holds its pipes.
+        kill_grace (float): Seconds between SIGTERM and SIGKILL on timeout, 0 to kill at once.
+
+    Returns:
+        tuple: Return code of the command (-9 if it was killed) and the trailing standard error lines.
+    """
+    task_logger = task_logger or logger
+    stderr_tail = deque(maxlen=max(1, tail_lines))
+    log_lock = threading.Lock()
+
+    log = open(log_file, 'w')
+    process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, bufsize=1, start_new_session=True)
+
+    def pump(stream, is_stderr: bool) -> None:
+        for line in stream:
+            line = line.rstrip('\n')
+            with log_lock:
+                if log.closed:
+                    break
+                log.write(f"{line}\n")
+                log.flush()
+            if is_stderr:
+                stderr_tail.append(line)
+                task_logger.debug(f"{prefix}{line}")
+            else:
+                task_logger.info(f"{prefix}{line}")
+        stream.close()
+
+    readers = [threading.Thread(target=pump, args=(process.stdout, False), daemon=True),
+               threading.Thread(target=pump, args=(process.stderr, True), daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    try:
+        returncode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        task_logger.error(f"{prefix}{cmd[0]} exceeded the {timeout} s timeout, killing it")
+        if kill_grace > 0:
+            _signal_group(process, signal.SIGTERM)
+            try:
+                process.wait(timeout=kill_grace)
+            except subprocess.TimeoutExpired:
+                pass
+        # the processes of the group still running, whether the command exited or not
+        _signal_group(process, signal.SIGKILL)
+        process.wait()
+        returncode = -9
+
+    for reader in readers:
+        reader.join(timeout=drain_timeout)
+        if reader.is_alive():
+            task_logger.warning(f"{prefix}Output of {cmd[0]} still open after it ended, not reading it anymore")
+    with log_lock:
+        log.close()
+
+    return returncode, list(stderr_tail)
+
+
+def _signal_group(process: subprocess.Popen, sig: int) -> None:
+    """
+    Send a signal to the process group of a command started in its own session.
+    """
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
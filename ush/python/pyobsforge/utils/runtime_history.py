@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import threading
+from datetime import datetime, timezone
+from logging import getLogger
+from statistics import median
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from wxflow.sqlitedb import SQLiteDB
+
+logger = getLogger(__name__.split('.')[-1])
+
+
+class RuntimeHistory(SQLiteDB):
+    """
+    Persistent record of the conversions of past runs.
+
+    Each conversion is recorded with its input size, output number of observations, MPI
+    ranks and wall time. The wall time of a conversion is modeled per observation type as
+    seconds per input byte following Amdahl's law, t / bytes = serial + parallel / mpi.
+    """
+
+    def __init__(self, db_name: str, serial_fraction: float = 0.1) -> None:
+        """
+        Args:
+            db_name (str): Path to the SQLite database, created if it does not exist.
+            serial_fraction (float): Serial fraction assumed for the observation types that
+                only ran with a single number of ranks.
+        """
+        super().__init__(db_name)
+        self.serial_fraction = serial_fraction
+        self._lock = threading.RLock()
+        self.execute_query("""
+        CREATE TABLE IF NOT EXISTS conversions (
+            obs_type TEXT,
+            cycle TEXT,
+            input_bytes INTEGER,
+            nobs INTEGER,
+            mpi INTEGER,
+            walltime REAL,
+            success INTEGER,
+            recorded TEXT
+        )
+        """)
+
+    def execute_query(self, query: str, params: tuple = None) -> list:
+        """Execute a query and return the results."""
+        with self._lock:
+            self.connect()
+            try:
+                cursor = self.connection.cursor()
+                cursor.execute(query, params or [])
+                results = cursor.fetchall()
+                self.connection.commit()
+            finally:
+                self.disconnect()
+        return results
+
+    def record(self, obs_type: str, cycle: str, input_bytes: int, nobs: Optional[int],
+               mpi: int, walltime: float, success: bool = True) -> None:
+        """
+        Record a conversion.
+
+        Args:
+            obs_type (str): Observation type (e.g. atms).
+            cycle (str): Cycle of the conversion.
+            input_bytes (int): Size of the inputs.
+            nobs (int): Number of observations written, None if unknown.
+            mpi (int): Number of MPI ranks.
+            walltime (float): Wall time in seconds.
+            success (bool): Whether the conversion succeeded.
+        """
+        self.execute_query("INSERT INTO conversions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           (obs_type, cycle, int(input_bytes), nobs, int(mpi), float(walltime), int(success),
+                            datetime.now(timezone.utc).isoformat()))
+
+    def samples(self, obs_type: Optional[str] = None, limit: int = 50) -> List[Tuple[int, float]]:
+        """
+        Return the (mpi, seconds per byte) of the last successful conversions.
+
+        Args:
+            obs_type (str): Observation type, None for all of them.
+            limit (int): Maximum number of conversions.
+
+        Returns:
+            list: (mpi, seconds per byte) of the conversions.
+        """
+        query = "SELECT mpi, walltime, input_bytes FROM conversions WHERE success = 1 AND input_bytes > 0"
+        params = ()
+        if obs_type is not None:
+            query += " AND obs_type = ?"
+            params = (obs_type,)
+        query += " ORDER BY recorded DESC LIMIT ?"
+        rows = self.execute_query(query, params + (limit,))
+        return [(mpi, walltime / input_bytes) for mpi, walltime, input_bytes in rows]
+
+    def model(self, obs_type: str) -> Optional[Tuple[float, float]]:
+        """
+        Return the serial and parallel seconds per byte of an observation type.
+
+        With several numbers of ranks in the history, both terms are fitted by least squares.
+        With a single one, `serial_fraction` of the median time is taken as serial. The
+        observation types without history use the median of all the conversions.
+
+        Args:
+            obs_type (str): Observation type.
+
+        Returns:
+            tuple: (serial, parallel) seconds per byte, None without any history.
+        """
+        samples = self.samples(obs_type) or self.samples()
+        if not samples:
+            return None
+        if len({mpi for mpi, _ in samples}) > 1:
+            xs = [1 / mpi for mpi, _ in samples]
+            ys = [rate for _, rate in samples]
+            x_mean, y_mean = sum(xs) / len(xs), sum(ys) / len(ys)
+            slope = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sum((x - x_mean) ** 2 for x in xs)
+            serial = y_mean - slope * x_mean
+            if slope >= 0 and serial >= 0:
+                return serial, slope
+        mpi = median(mpi for mpi, _ in samples)
+        rate = median(rate for _, rate in samples)
+        return self.serial_fraction * rate, (1 - self.serial_fraction) * rate * mpi
+
+    def estimate(self, obs_type: str, input_bytes: int, mpi: int) -> Optional[float]:
+        """
+        Estimate the wall time of a conversion.
+
+        Args:
+            obs_type (str): Observation type.
+            input_bytes (int): Size of the inputs.
+            mpi (int): Number of MPI ranks.
+
+        Returns:
+            float: Wall time in seconds, None without any history.
+        """
+        model = self.model(obs_type)
+        if model is None:
+            return None
+        serial, parallel = model
+        return input_bytes * (serial + parallel / max(1, mpi))
+
+    def suggest_mpi(self, jobs: Dict[str, Tuple[int, int]], budget: int, walltime_limit: Optional[float] = None,
+                    choices: Iterable[int] = (1, 2, 4, 8, 16, 32)) -> Tuple[Dict[str, int], Optional[float]]:
+        """
+        Suggest the number of ranks of each conversion minimizing the total wall time.
+
+        The total wall time is bounded below by the longest conversion and by the core-seconds
+        of all the conversions spread over the budget. Starting from the current ranks, the
+        longest conversion is given more ranks as long as this bound decreases.
+
+        Args:
+            jobs (dict): (input bytes, current ranks) keyed by observation type.
+            budget (int): Number of cores the conversions may use at once.
+            walltime_limit (float): Wall time limit of the task in seconds, a warning is
+                issued if the estimate exceeds it.
+            choices (iterable): Allowed numbers of ranks.
+
+        Returns:
+            tuple: Suggested ranks keyed by observation type, and the estimated total wall
+                time in seconds (None without any history).
+        """
+        mpi = {obs_type: current for obs_type, (_, current) in jobs.items()}
+        models = {obs_type: self.model(obs_type) for obs_type in jobs}
+        if not jobs or any(model is None for model in models.values()):
+            return mpi, None
+        choices = sorted(c for c in choices if c <= budget) or [1]
+
+        def walltime(obs_type: str, ranks: int) -> float:
+            serial, parallel = models[obs_type]
+            return jobs[obs_type][0] * (serial + parallel / ranks)
+
+        def bound(ranks: Dict[str, int]) -> float:
+            longest = max(walltime(obs_type, n) for obs_type, n in ranks.items())
+            core_seconds = sum(n * walltime(obs_type, n) for obs_type, n in ranks.items())
+            return max(longest, core_seconds / budget)
+
+        best = bound(mpi)
+        while True:
+            longest = max(mpi, key=lambda obs_type: walltime(obs_type, mpi[obs_type]))
+            larger = [c for c in choices if c > mpi[longest]]
+            if not larger:
+                break
+            candidate = dict(mpi, **{longest: larger[0]})
+            if bound(candidate) >= best:
+                break
+            mpi, best = candidate, bound(candidate)
+
+        if walltime_limit is not None and best > walltime_limit:
+            logger.warning(f"Estimated wall time {best:.0f} s exceeds the limit of {walltime_limit:.0f} s")
+        return mpi, best
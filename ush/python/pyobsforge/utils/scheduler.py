@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from logging import getLogger
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = getLogger(__name__.split('.')[-1])
+
+
+@dataclass
+class Job:
+    """
+    A job of the scheduler, run as func(*args) on `cores` cores.
+
+    Jobs are started by decreasing weight (e.g. their expected wall time), then decreasing cores.
+    """
+    name: str
+    cores: int
+    func: Callable[..., Any]
+    args: Tuple = ()
+    weight: float = 0
+    start: Optional[float] = field(default=None, repr=False)
+    end: Optional[float] = field(default=None, repr=False)
+    result: Any = field(default=None, repr=False)
+    error: Optional[BaseException] = field(default=None, repr=False)
+
+    @property
+    def succeeded(self) -> bool:
+        """
+        Whether the job raised nothing and returned neither False nor a nonzero exit status.
+        """
+        if self.error is not None or self.result is False:
+            return False
+        if isinstance(self.result, int) and not isinstance(self.result, bool):
+            return self.result == 0
+        return True
+
+    @property
+    def elapsed(self) -> Optional[float]:
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class CoreBudgetScheduler:
+    """
+    Run jobs on an executor without exceeding a budget of cores.
+
+    A job is started only when its cores fit in the cores left by the running jobs. The
+    heaviest pending job that fits is started first, smaller jobs fill the remaining cores.
+    A job larger than the budget runs alone.
+    """
+
+    def __init__(self, budget: int) -> None:
+        """
+        Args:
+            budget (int): Number of cores the jobs may use at once.
+        """
+        self.budget = max(1, int(budget))
+        self.timeline: List[Job] = []
+
+    def run(self, executor: Executor, jobs: List[Job]) -> List[Job]:
+        """
+        Run the jobs and wait for all of them.
+
+        Args:
+            executor (Executor): Executor running the jobs, with at least as many workers
+                as the jobs that can run at once.
+            jobs (list): Jobs to run.
+
+        Returns:
+            list: The jobs, in the order they completed, with their times, result and error.
+        """
+        pending = sorted(jobs, key=lambda job: (job.weight, job.cores), reverse=True)
+        done = threading.Condition()
+        state = {'free': self.budget, 'running': 0}
+
+        def on_done(job: Job, cores: int, future) -> None:
+            job.end = time.time()
+            if future.exception() is not None:
+                job.error = future.exception()
+            else:
+                job.result = future.result()
+            with done:
+                state['free'] += cores
+                state['running'] -= 1
+                self.timeline.append(job)
+                done.notify()
+
+        with done:
+            while pending:
+                job = next((job for job in pending if min(job.cores, self.budget) <= state['free']), None)
+                if job is None:
+                    done.wait()
+                    continue
+                pending.remove(job)
+                cores = min(job.cores, self.budget)
+                state['free'] -= cores
+                state['running'] += 1
+                logger.info(f"Starting {job.name} on {cores} cores, {state['free']}/{self.budget} cores left")
+                job.start = time.time()
+                future = executor.submit(job.func, *job.args)
+                future.add_done_callback(lambda f, job=job, cores=cores: on_done(job, cores, f))
+            while state['running']:
+                done.wait()
+
+        return self.timeline
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Return the makespan and the core utilization of the completed jobs.
+
+        Returns:
+            dict: makespan (s) and utilization (fraction of the budget used over the makespan).
+        """
+        if not self.timeline:
+            return {'makespan': 0.0, 'utilization': 0.0}
+        makespan = max(job.end for job in self.timeline) - min(job.start for job in self.timeline)
+        busy = sum(min(job.cores, self.budget) * job.elapsed for job in self.timeline)
+        return {'makespan': makespan, 'utilization': busy / (self.budget * makespan) if makespan > 0 else 0.0}
+
+    def write_timeline(self, path: str) -> None:
+        """
+        Write one line per completed job: name, cores, start, end, elapsed time and status.
+
+        Args:
+            path (str): Path of the timeline log.
+        """
+        def iso(t: float) -> str:
+            return datetime.fromtimestamp(t, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+        with open(path, 'w') as f:
+            f.write(f"# core budget: {self.budget}\n")
+            f.write("# name cores start end elapsed(s) status\n")
+            for job in sorted(self.timeline, key=lambda job: job.start):
+                status = 'ok' if job.succeeded else 'failed'
+                f.write(f"{job.name} {job.cores} {iso(job.start)} {iso(job.end)} {job.elapsed:.2f} {status}\n")
+            summary = self.summary()
+            f.write(f"# makespan: {summary['makespan']:.2f} s, utilization: {summary['utilization']:.2f}\n")
+        logger.info(f"Wrote the timeline of {len(self.timeline)} jobs to {path}")
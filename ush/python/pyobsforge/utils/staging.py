@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import shutil
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Any, Dict, List, Optional
+
+from wxflow import save_as_yaml
+from wxflow.fsutils import cp
+
+logger = getLogger(__name__.split('.')[-1])
+
+
+def tmp_name(path: str) -> str:
+    """
+    Return a temporary name next to `path` to write it before moving it in place.
+
+    The name is unique to the host, process and thread, as the directories shared by the
+    gdas and gfs jobs are written by processes of different nodes whose pids may collide.
+
+    Args:
+        path (str): Path of the file to write.
+
+    Returns:
+        str: Temporary path in the same directory.
+    """
+    return f"{path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def cache_root(task_config: Dict[str, Any]) -> str:
+    """
+    Return the directory of the caches kept across runs and cycles.
+
+    The workflow sets DATAROOT per cycle and every job removes its DATA, so neither outlives
+    a run. The caches go to `CACHEROOT` if set, else to COMROOT/PSLOT/cache.
+
+    Args:
+        task_config (dict): Task configuration.
+
+    Returns:
+        str: Directory of the caches.
+    """
+    return task_config.get('CACHEROOT') or os.path.join(task_config['COMROOT'], task_config.get('PSLOT', ''), 'cache')
+
+
+def source_version(src_files: List[str]) -> str:
+    """
+    Return a version of a set of source files, from their names, sizes and modification times.
+
+    Args:
+        src_files (list): Paths to the source files.
+
+    Returns:
+        str: Short hexadecimal digest, changing whenever a source file changes.
+    """
+    digest = hashlib.sha256()
+    for src_file in sorted(set(src_files)):
+        stat = os.stat(src_file)
+        digest.update(f"{os.path.abspath(src_file)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def link_from_versioned_cache(src_dst_list: List[List[str]], cache_root: str) -> str:
+    """
+    Link files into their destination from a cache directory named after their version.
+
+    The files are copied once into `<cache_root>/<version>` and the destinations are symbolic
+    links to the copies. A version directory is never modified once complete, so a run keeps
+    using the files it started with while the sources are updated, and the runs using the
+    same sources share a single copy.
+
+    Args:
+        src_dst_list (list): List of [src_file, dst_file].
+        cache_root (str): Directory holding the versions.
+
+    Returns:
+        str: Directory of the version the destinations link to.
+    """
+    version_dir = os.path.join(cache_root, source_version([src for src, _ in src_dst_list]))
+    os.makedirs(version_dir, exist_ok=True)
+    ncopied = 0
+    for src_file, dst_file in src_dst_list:
+        cached_file = os.path.join(version_dir, os.path.basename(src_file))
+        if not os.path.exists(cached_file):
+            # Copy under a temporary name so a concurrent run never links a partial file
+            tmp_file = tmp_name(cached_file)
+            shutil.copy2(src_file, tmp_file)
+            os.replace(tmp_file, cached_file)
+            ncopied += 1
+        if os.path.lexists(dst_file):
+            os.remove(dst_file)
+        os.symlink(cached_file, dst_file)
+    logger.info(f"Linked {len(src_dst_list)} files from {version_dir}, {ncopied} copied from the source")
+    return version_dir
+
+
+def copy_files(src_dst_list: List[List[str]], max_workers: int = 4) -> None:
+    """
+    Copy files concurrently, the destination directories are created as needed.
+
+    Args:
+        src_dst_list (list): List of [src_file, dst_file].
+        max_workers (int): Number of copies run at once.
+    """
+    for dst_dir in {os.path.dirname(dst) for _, dst in src_dst_list}:
+        os.makedirs(dst_dir, exist_ok=True)
+    with ThreadPoolExecutor(max(1, max_workers)) as executor:
+        # list() so an error of any copy is raised here
+        list(executor.map(lambda src_dst: cp(*src_dst), src_dst_list))
+    logger.info(f"Copied {len(src_dst_list)} files with {max_workers} workers")
+
+
+class ScratchManager:
+    """
+    Track the bytes staged per obs space in the working directory of a task and keep them
+    within a budget.
+
+    The staged inputs of an obs space are only removed once it is converted successfully:
+    right away with `cleanup`, else while the staged bytes exceed the budget, the obs spaces
+    converted first being removed first. A file also staged for an obs space not (yet)
+    converted successfully is kept. Symbolic links (e.g. to a shared stage directory) are
+    removed but take no space.
+    """
+
+    def __init__(self, data_dir: str, budget: Optional[int] = None, cleanup: bool = False) -> None:
+        """
+        Args:
+            data_dir (str): Working directory, the relative paths are staged from.
+            budget (int): Bytes the staged files may use, no limit if None.
+            cleanup (bool): Remove the inputs of every obs space once converted.
+        """
+        self.data_dir = data_dir
+        self.budget = budget
+        self.cleanup = cleanup
+        self.obs_spaces: Dict[str, Dict[str, Any]] = {}
+        self.usage = 0
+        self.peak = 0
+        self._converted: List[str] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_task_config(cls, task_config: Dict[str, Any]) -> "ScratchManager":
+        """
+        Create the manager of a task from its `scratch_budget_gb` and `cleanup_staging`.
+        """
+        budget_gb = task_config.get('scratch_budget_gb')
+        budget = int(float(budget_gb) * 2**30) if budget_gb else None
+        return cls(task_config['DATA'], budget=budget, cleanup=task_config.get('cleanup_staging', False))
+
+    def stage(self, obs_space: str, files: List[str]) -> None:
+        """
+        Record files staged for an obs space.
+
+        Args:
+            obs_space (str): Obs space the files are staged for.
+            files (list): Staged files, relative to the working directory or absolute.
+        """
+        with self._lock:
+            entry = self.obs_spaces.setdefault(obs_space, {'files': {}, 'staged': 0, 'removed': 0, 'converted': None})
+            for staged_file in files:
+                staged_path = os.path.join(self.data_dir, staged_file)
+                if staged_path in entry['files'] or not os.path.lexists(staged_path):
+                    continue
+                # a file staged for several obs spaces is counted once
+                shared = any(staged_path in other['files'] for other in self.obs_spaces.values())
+                nbytes = 0 if shared or os.path.islink(staged_path) else os.path.getsize(staged_path)
+                entry['files'][staged_path] = nbytes
+                entry['staged'] += nbytes
+                self.usage += nbytes
+            self.peak = max(self.peak, self.usage)
+
+    def converted(self, obs_space: str, success: bool) -> int:
+        """
+        Record the conversion of an obs space and remove the inputs no longer needed.
+
+        Args:
+            obs_space (str): Converted obs space.
+            success (bool): Whether the conversion succeeded, the inputs are kept otherwise.
+
+        Returns:
+            int: Bytes removed.
+        """
+        with self._lock:
+            entry = self.obs_spaces.setdefault(obs_space, {'files': {}, 'staged': 0, 'removed': 0, 'converted': None})
+            entry['converted'] = bool(success)
+            if not success:
+                return 0
+            self._converted.append(obs_space)
+            if self.cleanup:
+                return self._remove(obs_space)
+            removed = 0
+            for converted in list(self._converted):
+                if self.budget is None or self.usage <= self.budget:
+                    break
+                removed += self._remove(converted)
+            if self.budget is not None and self.usage > self.budget:
+                logger.warning(f"Staged files use {self.usage / 2**20:.1f} MiB, over the budget of "
+                               f"{self.budget / 2**20:.1f} MiB until more obs spaces are converted")
+            return removed
+
+    def _remove(self, obs_space: str) -> int:
+        needed = {staged_path for entry in self.obs_spaces.values() if entry['converted'] is not True
+                  for staged_path in entry['files']}
+        removable = [staged_path for staged_path in self.obs_spaces[obs_space]['files'] if staged_path not in needed]
+        nbytes = 0
+        for staged_path in removable:
+            try:
+                os.remove(staged_path)
+            except FileNotFoundError:
+                pass
+            for entry in self.obs_spaces.values():
+                if staged_path in entry['files']:
+                    size = entry['files'].pop(staged_path)
+                    entry['removed'] += size
+                    nbytes += size
+        self.usage -= nbytes
+        self._converted = [converted for converted in self._converted if self.obs_spaces[converted]['files']]
+        if removable:
+            logger.info(f"Removed {len(removable)} inputs of {obs_space}, {nbytes / 2**20:.1f} MiB reclaimed")
+        return nbytes
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Return the disk usage of the staged files and of the working directory, in bytes.
+
+        Returns:
+            dict: Budget, bytes staged, removed and left, peak of the staged bytes, size of
+                  the working directory and space left on its filesystem, and the files,
+                  bytes staged and removed and conversion status of each obs space.
+        """
+        data_bytes = 0
+        for root, _, files in os.walk(self.data_dir):
+            for name in files:
+                try:
+                    data_bytes += os.lstat(os.path.join(root, name)).st_size
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            obs_spaces = {obs_space: {'files': len(entry['files']), 'staged': entry['staged'],
+                                      'removed': entry['removed'], 'converted': entry['converted']}
+                          for obs_space, entry in sorted(self.obs_spaces.items())}
+            return {'budget': self.budget,
+                    'staged': sum(entry['staged'] for entry in obs_spaces.values()),
+                    'removed': sum(entry['removed'] for entry in obs_spaces.values()),
+                    'left': self.usage,
+                    'peak': self.peak,
+                    'data directory': data_bytes,
+                    'free space': shutil.disk_usage(self.data_dir).free,
+                    'obs spaces': obs_spaces}
+
+    def write_report(self, path: str) -> Dict[str, Any]:
+        """
+        Log the disk usage report and write it to a YAML file.
+
+        Args:
+            path (str): Path of the report.
+
+        Returns:
+            dict: The report.
+        """
+        report = self.report()
+        logger.info(f"Staged {report['staged'] / 2**20:.1f} MiB (peak {report['peak'] / 2**20:.1f} MiB), "
+                    f"removed {report['removed'] / 2**20:.1f} MiB, the working directory uses "
+                    f"{report['data directory'] / 2**20:.1f} MiB, {report['free space'] / 2**30:.1f} GiB left")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        save_as_yaml(report, path)
+        return report
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+from typing import Any, Dict, Tuple
+
+import jinja2
+from wxflow import Jinja, YAMLFile
+
+# Compiled templates keyed by (absolute path, modification time)
+_template_cache: Dict[Tuple[str, int], jinja2.Template] = {}
+_template_cache_lock = threading.Lock()
+
+
+def get_template(path: str) -> jinja2.Template:
+    """
+    Return the compiled Jinja2 template of a file, compiling it only on first use.
+
+    Templates are cached for the lifetime of the process and keyed by their path and
+    modification time, so an edited template is recompiled. The environment (filters,
+    extensions, undefined handling) is the one wxflow.Jinja uses.
+
+    Args:
+        path (str): Path to the Jinja2 template file.
+
+    Returns:
+        jinja2.Template: The compiled template.
+    """
+    path = os.path.abspath(path)
+    key = (path, os.stat(path).st_mtime_ns)
+    with _template_cache_lock:
+        template = _template_cache.get(key)
+        if template is None:
+            jinja = Jinja(path, {})
+            env = jinja.get_set_env(jinja2.FileSystemLoader(jinja.template_searchpath))
+            template = env.get_template(jinja.template_file)
+            # Drop the templates compiled from a previous version of the file
+            for stale_key in [k for k in _template_cache if k[0] == path]:
+                del _template_cache[stale_key]
+            _template_cache[key] = template
+    return template
+
+
+def parse_j2yaml_cached(path: str, data: Dict[str, Any]) -> YAMLFile:
+    """
+    Drop-in replacement of wxflow.parse_j2yaml that renders a cached compiled template.
+
+    Args:
+        path (str): Path to the jinja2 templated yaml file.
+        data (dict): Context for jinja2 templating.
+
+    Returns:
+        YAMLFile: The rendered and parsed configuration.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Input j2yaml file {path} does not exist!")
+
+    try:
+        rendered = get_template(path).render(**data)
+    except jinja2.UndefinedError as ee:
+        raise NameError(f"Undefined variable in Jinja2 template\n{ee}")
+    return YAMLFile(data=rendered)
+
+
+def clear_template_cache() -> None:
+    """
+    Empty the compiled template cache.
+    """
+    with _template_cache_lock:
+        _template_cache.clear()
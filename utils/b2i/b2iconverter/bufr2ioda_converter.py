@@ -37,12 +37,15 @@ class Bufr2ioda_Converter:
 
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-        console_handler = logging.StreamHandler()
-        # console_handler.setLevel(logging.INFO)
-        console_handler.setLevel(logging.DEBUG)
-        console_handler.setFormatter(formatter)
+        # converters built again in the same process share their logger,
+        # only the first one adds the console handler
+        if not self.logger.handlers:
+            console_handler = logging.StreamHandler()
+            # console_handler.setLevel(logging.INFO)
+            console_handler.setLevel(logging.DEBUG)
+            console_handler.setFormatter(formatter)
 
-        self.logger.addHandler(console_handler)
+            self.logger.addHandler(console_handler)
 
         if (logfile):
             self.file_handler = logging.FileHandler(logfile)
@@ -105,6 +108,7 @@ class Bufr2ioda_Converter:
         self.ioda_vars.log(self.logger)
         if (self.logfile):
             self.logger.removeHandler(self.file_handler)
+            self.file_handler.close()
 
         end_time = time.time()
         running_time = end_time - start_time
@@ -0,0 +1,45 @@
+import importlib
+import logging
+import sys
+
+
+# registry of the bufr2ioda converters, so they can be built and run
+# from a library call instead of launching their script
+# each bufr2ioda_<name>.py script registers a factory under <name>,
+# that builds its configuration, its ioda variables and the converter
+# the scripts are imported on demand, from the directory they live in
+
+_factories = {}
+
+
+def register(name):
+    def decorator(factory):
+        _factories[name] = factory
+        return factory
+    return decorator
+
+
+def get_factory(name):
+    if name not in _factories:
+        importlib.import_module(f"bufr2ioda_{name}")
+    return _factories[name]
+
+
+def build_converter(name, config_file, log_file=None):
+    script_name = sys.modules[get_factory(name).__module__].__file__
+    return get_factory(name)(script_name, config_file, log_file)
+
+
+# run a registered converter and return its exit status,
+# the converter exits early when there are no obs to convert
+def run_converter(name, config_file, log_file=None):
+    try:
+        build_converter(name, config_file, log_file).run()
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        return e.code if isinstance(e.code, int) else 1
+    except Exception:
+        logging.getLogger(__name__).exception(f"bufr2ioda {name} failed for {config_file}")
+        return 1
+    return 0
@@ -4,6 +4,7 @@ import sys
 from b2iconverter.util import parse_arguments
 from b2iconverter.bufr2ioda_config import Bufr2iodaConfig
 from b2iconverter.bufr2ioda_converter import Bufr2ioda_Converter
+from b2iconverter.registry import register
 from argo_ioda_variables import ArgoIODAVariables
 
 
@@ -15,10 +16,8 @@ class ArgoConfig(Bufr2iodaConfig):
         return f"{self.cycle_type}.t{self.hh}z.insitu_profile_argo.{self.cycle_datetime}.nc"
 
 
-if __name__ == '__main__':
-
-    script_name, config_file, log_file, test_file = parse_arguments()
-
+@register('insitu_profile_argo')
+def make_converter(script_name, config_file, log_file=None):
     bufr2ioda_config = ArgoConfig(
         script_name,
         config_file,
@@ -30,7 +29,14 @@ if __name__ == '__main__':
     ioda_vars.set_salinity_var_name("salinity")
     ioda_vars.set_salinity_error(0.01)
 
-    argo = Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+    return Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+
+
+if __name__ == '__main__':
+
+    script_name, config_file, log_file, test_file = parse_arguments()
+
+    argo = make_converter(script_name, config_file, log_file)
 
     argo.run()
 
@@ -4,16 +4,15 @@ import sys
 from b2iconverter.util import parse_arguments
 from b2iconverter.bufr2ioda_config import Bufr2iodaConfig
 from b2iconverter.bufr2ioda_converter import Bufr2ioda_Converter
+from b2iconverter.registry import register
 from bathy_ioda_variables import BathyIODAVariables
 
 
 platform_description = 'Profiles from BATHYthermal: temperature'
 
 
-if __name__ == '__main__':
-
-    script_name, config_file, log_file, test_file = parse_arguments()
-
+@register('insitu_profile_bathy')
+def make_converter(script_name, config_file, log_file=None):
     bufr2ioda_config = Bufr2iodaConfig(
         script_name,
         config_file,
@@ -23,7 +22,14 @@ if __name__ == '__main__':
     ioda_vars.set_temperature_error(0.24)
     ioda_vars.set_temperature_var_name("waterTemperature")
 
-    bathy = Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+    return Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+
+
+if __name__ == '__main__':
+
+    script_name, config_file, log_file, test_file = parse_arguments()
+
+    bathy = make_converter(script_name, config_file, log_file)
 
     bathy.run()
 
@@ -4,6 +4,7 @@ import sys
 from b2iconverter.util import parse_arguments
 from b2iconverter.bufr2ioda_config import Bufr2iodaConfig
 from b2iconverter.bufr2ioda_converter import Bufr2ioda_Converter
+from b2iconverter.registry import register
 from mbuoyb_tropical_ioda_variables import MbuoybTropicalIODAVariables
 from wmo_codes import *
 
@@ -25,10 +26,8 @@ class TaotritonIODAVariables(MbuoybTropicalIODAVariables):
         self.saln = self.saln[mask]
 
 
-if __name__ == '__main__':
-
-    script_name, config_file, log_file, test_file = parse_arguments()
-
+@register('insitu_profile_taotriton')
+def make_converter(script_name, config_file, log_file=None):
     bufr2ioda_config = TaotritonConfig(
         script_name,
         config_file,
@@ -40,7 +39,14 @@ if __name__ == '__main__':
     ioda_vars.set_salinity_var_name("salinity")
     ioda_vars.set_salinity_error(0.01)
 
-    tropical = Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+    return Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+
+
+if __name__ == '__main__':
+
+    script_name, config_file, log_file, test_file = parse_arguments()
+
+    tropical = make_converter(script_name, config_file, log_file)
 
     tropical.run()
 
@@ -4,16 +4,15 @@ import sys
 from b2iconverter.util import parse_arguments
 from b2iconverter.bufr2ioda_config import Bufr2iodaConfig
 from b2iconverter.bufr2ioda_converter import Bufr2ioda_Converter
+from b2iconverter.registry import register
 from xbtctd_ioda_variables import XbtctdIODAVariables
 
 
 platform_description = 'Profiles from XBT/CTD: temperature and salinity'
 
 
-if __name__ == '__main__':
-
-    script_name, config_file, log_file, test_file = parse_arguments()
-
+@register('insitu_profile_xbtctd')
+def make_converter(script_name, config_file, log_file=None):
     bufr2ioda_config = Bufr2iodaConfig(
         script_name,
         config_file,
@@ -25,7 +24,14 @@ if __name__ == '__main__':
     ioda_vars.set_salinity_var_name("salinity")
     ioda_vars.set_salinity_error(1.0)
 
-    xbtctd = Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+    return Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+
+
+if __name__ == '__main__':
+
+    script_name, config_file, log_file, test_file = parse_arguments()
+
+    xbtctd = make_converter(script_name, config_file, log_file)
     xbtctd.run()
 
     if test_file:
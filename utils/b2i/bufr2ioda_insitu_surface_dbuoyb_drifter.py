@@ -4,6 +4,7 @@ import sys
 from b2iconverter.util import parse_arguments
 from b2iconverter.bufr2ioda_config import Bufr2iodaConfig
 from b2iconverter.bufr2ioda_converter import Bufr2ioda_Converter
+from b2iconverter.registry import register
 from dbuoyb_drifter_ioda_variables import DbuoybDrifterIODAVariables
 
 
@@ -16,10 +17,8 @@ class DbuoybDrifterConfig(Bufr2iodaConfig):
         return f"{self.cycle_type}.t{self.hh}z.insitu_surface_dbuoyb_drifter.{self.cycle_datetime}.nc"
 
 
-if __name__ == '__main__':
-
-    script_name, config_file, log_file, test_file = parse_arguments()
-
+@register('insitu_surface_dbuoyb_drifter')
+def make_converter(script_name, config_file, log_file=None):
     bufr2ioda_config = DbuoybDrifterConfig(
         script_name,
         config_file,
@@ -30,7 +29,14 @@ if __name__ == '__main__':
     ioda_vars.set_temperature_var_name("seaSurfaceTemperature")
     ioda_vars.set_temperature_error(0.3)
 
-    dbuoyb_drifters = Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+    return Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+
+
+if __name__ == '__main__':
+
+    script_name, config_file, log_file, test_file = parse_arguments()
+
+    dbuoyb_drifters = make_converter(script_name, config_file, log_file)
 
     dbuoyb_drifters.run()
 
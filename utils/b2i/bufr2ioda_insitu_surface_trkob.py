@@ -4,6 +4,7 @@ import sys
 from b2iconverter.util import parse_arguments
 from b2iconverter.bufr2ioda_config import Bufr2iodaConfig
 from b2iconverter.bufr2ioda_converter import Bufr2ioda_Converter
+from b2iconverter.registry import register
 from trkob_ioda_variables import TrkobIODAVariables
 
 
@@ -15,10 +16,8 @@ class TrkobConfig(Bufr2iodaConfig):
         return f"{self.cycle_type}.t{self.hh}z.insitu_surface_{self.data_format}.{self.cycle_datetime}.nc"
 
 
-if __name__ == '__main__':
-
-    script_name, config_file, log_file, test_file = parse_arguments()
-
+@register('insitu_surface_trkob')
+def make_converter(script_name, config_file, log_file=None):
     bufr2ioda_config = TrkobConfig(
         script_name,
         config_file,
@@ -30,7 +29,14 @@ if __name__ == '__main__':
     ioda_vars.set_salinity_var_name("seaSurfaceSalinity")
     ioda_vars.set_salinity_error(1.0)
 
-    trkob = Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+    return Bufr2ioda_Converter(bufr2ioda_config, ioda_vars, log_file)
+
+
+if __name__ == '__main__':
+
+    script_name, config_file, log_file, test_file = parse_arguments()
+
+    trkob = make_converter(script_name, config_file, log_file)
     trkob.run()
 
     if test_file:
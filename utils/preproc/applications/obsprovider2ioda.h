@@ -1,5 +1,7 @@
 #pragma once
 
+#include <cstdio>
+#include <exception>
 #include <string>
 
 #include "eckit/config/LocalConfiguration.h"
@@ -29,6 +31,30 @@ namespace obsforge {
 
 
     int execute(const eckit::Configuration & fullConfig) const {
+      // A batch of obs spaces converted with a single launch of the application
+      if (fullConfig.has("obs spaces")) {
+        int status = 0;
+        for (const eckit::LocalConfiguration & obsSpaceConfig :
+               fullConfig.getSubConfigurations("obs spaces")) {
+          // A failed obs space does not prevent the conversion of the next ones
+          try {
+            if (this->convert(obsSpaceConfig) != 0) status = 1;
+          } catch (const std::exception & e) {
+            const std::string outputFile = obsSpaceConfig.getString("output file", "");
+            oops::Log::error() << "Conversion of " << outputFile << " failed: "
+                               << e.what() << std::endl;
+            // Leave no partial output, a missing output marks the failed obs spaces
+            if (!outputFile.empty()) std::remove(outputFile.c_str());
+            status = 1;
+          }
+        }
+        return status;
+      }
+      return this->convert(fullConfig);
+    }
+    // -----------------------------------------------------------------------------
+   private:
+    int convert(const eckit::Configuration & fullConfig) const {
       // Get the file provider string identifier from the config
       std::string provider;
       fullConfig.get("provider", provider);
@@ -76,7 +102,6 @@ namespace obsforge {
       return 0;
     }
     // -----------------------------------------------------------------------------
-   private:
     std::string appname() const {
       return "obsforge::ObsProvider2IodaApp";
     }